@@ -9,8 +9,11 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+# Unlike runserver, uvicorn does not serve static files: they are served from
+# STATIC_ROOT (filled by collectstatic) unless a reverse proxy serves them first
+application = ASGIStaticFilesHandler(get_asgi_application())
@@ -71,6 +71,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.locale.LocaleMiddleware',
+    'weapondetectapp.profiling.SlowRequestProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -212,3 +213,123 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
 CELERY_TIMEZONE = 'UTC'
+
+# Weapon detection
+
+WEAPONDETECT_MODEL_PATH = str(BASE_DIR / 'weapondetectapp' / 'weights' / 'best.pt')
+
+# Load the model when the web app starts (Celery workers always preload it)
+WEAPONDETECT_PRELOAD_MODEL = False
+# Run a dummy forward pass right after the model is loaded
+WEAPONDETECT_WARMUP = True
+# Number of images in one forward pass for multi-image uploads and folders
+WEAPONDETECT_BATCH_SIZE = 8
+# Run the model on every N-th video frame, boxes are tracked in between
+WEAPONDETECT_VIDEO_STRIDE = 1
+# Also run the model on frames that changed more than this since the last one (0-255), None disables
+WEAPONDETECT_VIDEO_MOTION_THRESHOLD = None
+# Split longer videos into segments of this many frames processed in parallel, 0 disables
+WEAPONDETECT_VIDEO_SEGMENT_FRAMES = 25 * 60 * 5
+# Retries of a failed segment before the whole video fails
+WEAPONDETECT_VIDEO_SEGMENT_RETRIES = 3
+# H.264 encoder preset of annotated videos: fast, balanced or small, slower presets give smaller files
+WEAPONDETECT_VIDEO_ENCODER_PRESET = 'balanced'
+# Copy the audio track of the source into the annotated video
+WEAPONDETECT_VIDEO_KEEP_AUDIO = True
+# Hardware decoder device of PyAV (cuda, vaapi, videotoolbox, ...), None decodes on the CPU
+WEAPONDETECT_VIDEO_HWACCEL = None
+# Videos with more detections than this keep them in a .npz sidecar instead of the database row
+WEAPONDETECT_VIDEO_INLINE_DETECTIONS = 1000
+
+# Result cache of already seen files, keyed by content hash, model version and options
+WEAPONDETECT_CACHE_ENABLED = True
+WEAPONDETECT_CACHE_REDIS_URL = CELERY_BROKER_URL
+WEAPONDETECT_CACHE_TTL = 7 * 24 * 60 * 60
+# In-process LRU in front of Redis, bounded by entries and total bytes
+WEAPONDETECT_CACHE_LOCAL_ENTRIES = 256
+WEAPONDETECT_CACHE_LOCAL_BYTES = 64 * 1024 * 1024
+# Annotated images larger than this are not cached
+WEAPONDETECT_CACHE_MAX_ARTIFACT_BYTES = 8 * 1024 * 1024
+# Maximum width and height of the thumbnails shown in the lists
+WEAPONDETECT_THUMBNAIL_SIZE = (320, 320)
+# Number of uploads on one page of the lists
+WEAPONDETECT_LIST_PAGE_SIZE = 20
+
+# Threads running model calls for the async API views, they mostly wait for the micro-batcher
+WEAPONDETECT_EXECUTOR_WORKERS = 8
+# Running and queued inference tasks before the API answers 429 Too Many Requests
+WEAPONDETECT_EXECUTOR_QUEUE_SIZE = 32
+# Size of the chunks uploaded files are written to the storage in
+WEAPONDETECT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Single-image API requests from concurrent callers are collected into batches of up to N images,
+# the first image waits at most this many milliseconds for the others. Celery tasks never use it
+WEAPONDETECT_MICROBATCH_ENABLED = True
+WEAPONDETECT_MICROBATCH_MAX_SIZE = 8
+WEAPONDETECT_MICROBATCH_MAX_LATENCY_MS = 10
+# Local inference processes, each pinned to its own cores and holding its own model, 0 runs the model in the calling process
+WEAPONDETECT_POOL_WORKERS = 0
+# Intra-op threads of each inference process, None uses the number of its cores
+WEAPONDETECT_POOL_THREADS = None
+# Frames in flight to the inference processes, and the largest frame passed through shared memory
+WEAPONDETECT_POOL_SLOTS = 64
+WEAPONDETECT_POOL_SLOT_BYTES = 1920 * 1080 * 3
+# Maximum time in seconds a batch waits for free frame slots, None waits forever
+WEAPONDETECT_POOL_ACQUIRE_TIMEOUT = 60
+# Lock file taken by the one process on the host that owns the pool, None uses one in the temp directory.
+# Celery prefork children never start a pool, run the pool in a web process or a "celery -P solo/threads" worker
+WEAPONDETECT_POOL_LOCK_PATH = None
+# Inference backend: torch, onnx or openvino. Export the model first with "python manage.py export_detector"
+WEAPONDETECT_BACKEND = 'torch'
+# Use the INT8 model built with "python manage.py quantize_detector" if it passed the accuracy gate
+WEAPONDETECT_QUANTIZED = False
+# Largest drop of the gun recall on held-out images an INT8 model is activated with
+WEAPONDETECT_QUANTIZATION_MAX_RECALL_DROP = 0.01
+# Side of a tile large images are predicted with, so small weapons are seen at full resolution. None disables tiling
+WEAPONDETECT_TILE_SIZE = None
+# Share of a tile covered by its neighbour
+WEAPONDETECT_TILE_OVERLAP = 0.2
+# Longer image side from which the image is tiled
+WEAPONDETECT_TILE_MIN_SIDE = 1920
+# Only predict the tiles around the people and weapons found on the downscaled image
+WEAPONDETECT_TILE_GATE = True
+# Run a cheap person gate first and the full gun detection only on images and frames with people
+WEAPONDETECT_CASCADE_ENABLED = False
+# Input size of the gate pass
+WEAPONDETECT_CASCADE_IMGSZ = 320
+# Smaller model for the gate pass, None runs the main model at WEAPONDETECT_CASCADE_IMGSZ
+WEAPONDETECT_CASCADE_MODEL_PATH = None
+# Publish the progress and detections found so far of the videos being processed
+WEAPONDETECT_PROGRESS_ENABLED = True
+WEAPONDETECT_PROGRESS_REDIS_URL = CELERY_BROKER_URL
+# Minimum time in seconds between two progress updates of a video
+WEAPONDETECT_PROGRESS_INTERVAL = 1.0
+# Lifetime of the progress of a video in seconds after its last update
+WEAPONDETECT_PROGRESS_TTL = 24 * 60 * 60
+# Maximum number of detections published per video while it is processed
+WEAPONDETECT_PROGRESS_MAX_DETECTIONS = 10000
+# Maximum time in seconds a progress stream stays open, the browser reconnects after it
+WEAPONDETECT_PROGRESS_STREAM_SECONDS = 10 * 60
+# Publish an alert to a Redis stream as soon as a weapon is found in a video
+WEAPONDETECT_ALERTS_ENABLED = True
+WEAPONDETECT_ALERTS_REDIS_URL = CELERY_BROKER_URL
+# Classes and minimum confidence score of the boxes that raise an alert
+WEAPONDETECT_ALERTS_CLASSES = ['gun']
+WEAPONDETECT_ALERTS_CONF = 0.5
+# Number of consecutive inferred frames with a weapon before an alert
+WEAPONDETECT_ALERTS_MIN_FRAMES = 2
+# Minimum time in seconds of video between two alerts of the same video
+WEAPONDETECT_ALERTS_COOLDOWN = 5.0
+# Longest side of the thumbnail sent with an alert
+WEAPONDETECT_ALERTS_THUMBNAIL_SIZE = 160
+# Approximate number of alerts kept in the stream
+WEAPONDETECT_ALERTS_STREAM_MAXLEN = 10000
+# Maximum time in seconds an alert stream stays open, the browser reconnects after it
+WEAPONDETECT_ALERTS_STREAM_SECONDS = 10 * 60
+# Serve the metrics of the process on /metrics in the Prometheus text format
+WEAPONDETECT_METRICS_ENABLED = True
+# Save a profile of sampled requests slower than this, needs pyinstrument installed. None disables profiling
+WEAPONDETECT_PROFILE_SLOW_REQUEST_MS = None
+# Share of requests that are profiled
+WEAPONDETECT_PROFILE_SAMPLE_RATE = 0.01
+# Folder the profiles of slow requests are saved to
+WEAPONDETECT_PROFILE_DIR = BASE_DIR / 'profiles'
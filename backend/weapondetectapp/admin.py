@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 
-from weapondetectapp.models import Image, ImagePredict
+from weapondetectapp.models import Camera, Image, ImagePredict
 
 
 @admin.register(Image)
@@ -22,5 +22,18 @@ class ImagePredictAdmin(admin.ModelAdmin):
         verbose_name = _('Image Predict')
         verbose_name_plural = _('Images Predict')
 
-    list_display = ['image_original', 'image_predict', 'boxes']
+    list_display = ['image_original', 'image_predict', 'status', 'boxes']
+    list_filter = ['status']
     search_fields = ['image_original', 'image_predict']
+
+
+@admin.register(Camera)
+class CameraAdmin(admin.ModelAdmin):
+    class Meta:
+        verbose_name = _('Camera')
+        verbose_name_plural = _('Cameras')
+
+    list_display = ['name', 'user', 'url', 'enabled', 'segment_seconds', 'retention_segments', 'created_at']
+    list_filter = ['enabled', 'user']
+    search_fields = ['name', 'url']
+    ordering = ['name']
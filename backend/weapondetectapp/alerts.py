@@ -0,0 +1,249 @@
+import base64
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Sequence, Tuple
+
+import cv2
+import numpy as np
+import redis
+
+from weapondetectapp.metrics import registry
+from weapondetectapp.video import FramePredict
+
+
+ALERTS = registry.counter('weapondetect_alerts_total', 'Weapon alerts published to the alert stream')
+
+
+@dataclass
+class WeaponAlert:
+    """
+    user_id: Owner of the video or camera
+    frame: Frame index in the video or since the camera worker started
+    timestamp: Position of the frame in the video in seconds
+    cls_name: Detected class
+    conf: Confidence score
+    xyxy: Coordinates of the bounding box
+    video_predict_pk: Primary key of the VideoPredict object, None for a camera
+    camera_pk: Primary key of the Camera object, None for a video
+    thumbnail: Base64 JPEG crop around the box
+    created: Unix time the alert was published
+    """
+    user_id: int
+    frame: int
+    timestamp: float
+    cls_name: str
+    conf: float
+    xyxy: List[float]
+    video_predict_pk: int | None = None
+    camera_pk: int | None = None
+    thumbnail: str = ''
+    created: float = field(default_factory=time.time)
+
+
+def crop_thumbnail(frame: np.ndarray, xyxy: Sequence[float], size: int = 160, padding: float = 0.25) -> str:
+    """
+    Crop a box with some context around it and encode it as a base64 JPEG.
+
+    Args:
+        frame: BGR frame.
+        xyxy: Coordinates of the box.
+        size: Longest side of the thumbnail.
+        padding: Context added on every side, relative to the box size.
+
+    Returns:
+        Base64 JPEG, an empty string if the box is outside the frame.
+    """
+    height, width = frame.shape[:2]
+    x1, y1, x2, y2 = xyxy
+    pad_x, pad_y = (x2 - x1) * padding, (y2 - y1) * padding
+    x1, y1 = max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y))
+    x2, y2 = min(width, int(x2 + pad_x)), min(height, int(y2 + pad_y))
+    if x2 <= x1 or y2 <= y1:
+        return ''
+
+    crop = frame[y1:y2, x1:x2]
+    scale = size / max(crop.shape[:2])
+    if scale < 1:
+        crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return base64.b64encode(buffer).decode() if ok else ''
+
+
+class AlertStream:
+    """
+    Weapon alerts of all users in a capped Redis stream.
+
+    Stream entry ids let a client resume from the last alert it received,
+    so nothing published while it reconnects is lost.
+    """
+    KEY = 'weapondetect:alerts'
+
+    def __init__(self, redis_url: str, maxlen: int = 10000) -> None:
+        """
+        Args:
+            redis_url: Redis URL.
+            maxlen: Approximate number of alerts kept in the stream.
+        """
+        self.maxlen = maxlen
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def publish(self, alert: WeaponAlert) -> str | None:
+        """
+        Add an alert to the stream.
+
+        Returns:
+            Stream entry id or None if Redis is unavailable.
+        """
+        try:
+            entry_id = self._redis.xadd(
+                self.KEY, {'alert': json.dumps(asdict(alert))}, maxlen=self.maxlen, approximate=True)
+        except redis.RedisError as e:
+            print(f'Alert stream is unavailable: {e}')
+            return None
+        ALERTS.inc()
+        return entry_id.decode()
+
+    def last_id(self) -> str:
+        """
+        Get the id of the newest alert, to read only the alerts published after it.
+        """
+        try:
+            entries = self._redis.xrevrange(self.KEY, count=1)
+        except redis.RedisError as e:
+            print(f'Alert stream is unavailable: {e}')
+            return '0-0'
+        return entries[0][0].decode() if entries else '0-0'
+
+    def read(self, last_id: str, block_ms: int = 1000, count: int = 100) -> List[Tuple[str, WeaponAlert]] | None:
+        """
+        Wait for alerts published after last_id.
+
+        Args:
+            last_id: Id of the last alert received.
+            block_ms: Maximum time to wait in milliseconds.
+            count: Maximum number of alerts returned.
+
+        Returns:
+            (entry id, alert) pairs, None if Redis is unavailable.
+        """
+        try:
+            response = self._redis.xread({self.KEY: last_id}, count=count, block=block_ms)
+        except redis.RedisError as e:
+            print(f'Alert stream is unavailable: {e}')
+            return None
+        return [
+            (entry_id.decode(), WeaponAlert(**json.loads(fields[b'alert'])))
+            for _, entries in response
+            for entry_id, fields in entries
+        ]
+
+
+class WeaponAlertEmitter:
+    """
+    Frame callback publishing an alert as soon as a weapon is found in a video or camera feed.
+
+    A single-frame false positive does not raise an alert: the weapon has to
+    be detected on min_frames consecutive inferred frames. After an alert the
+    video stays quiet for cooldown seconds of video time, so a weapon in view
+    for a minute is one alert and not one per frame. Boxes carried forward by
+    the tracker are not counted, they repeat the last inferred frame.
+    """
+
+    def __init__(
+        self,
+        stream: AlertStream,
+        user_id: int,
+        fps: float,
+        video_predict_pk: int | None = None,
+        camera_pk: int | None = None,
+        class_names: Sequence[str] = ('gun',),
+        conf: float = 0.5,
+        min_frames: int = 2,
+        cooldown: float = 5.0,
+        thumbnail_size: int = 160,
+    ) -> None:
+        """
+        Args:
+            stream: Alert stream.
+            user_id: Owner of the video or camera.
+            fps: Frame rate of the video, to convert frame indices to timestamps.
+            video_predict_pk: Primary key of the VideoPredict object.
+            camera_pk: Primary key of the Camera object.
+            class_names: Classes that raise an alert.
+            conf: Minimum confidence score of a box that raises an alert.
+            min_frames: Number of consecutive inferred frames with a weapon before an alert.
+            cooldown: Minimum time in seconds of video between two alerts.
+            thumbnail_size: Longest side of the thumbnail.
+        """
+        self.stream = stream
+        self.user_id = user_id
+        self.video_predict_pk = video_predict_pk
+        self.camera_pk = camera_pk
+        self.fps = fps or 25.0
+        self.class_names = class_names
+        self.conf = conf
+        self.min_frames = max(1, min_frames)
+        self.cooldown = cooldown
+        self.thumbnail_size = thumbnail_size
+
+        self._streak = 0
+        self._last_alert: float | None = None
+
+    def __call__(self, frame_predict: FramePredict) -> None:
+        if not frame_predict.inferred:
+            return
+
+        image_predict = frame_predict.image_predict
+        boxes = image_predict.boxes
+        alert_classes = [cls for cls, name in image_predict.cls_names.items() if name in self.class_names]
+        mask = np.isin(boxes.cls, alert_classes) & (boxes.conf >= self.conf)
+        if not mask.any():
+            self._streak = 0
+            return
+
+        self._streak += 1
+        timestamp = frame_predict.index / self.fps
+        if self._streak < self.min_frames:
+            return
+        if self._last_alert is not None and timestamp - self._last_alert < self.cooldown:
+            return
+
+        best = np.flatnonzero(mask)[np.argmax(boxes.conf[mask])]
+        xyxy = [round(float(value), 1) for value in boxes.xyxy[best]]
+        self.stream.publish(WeaponAlert(
+            user_id=self.user_id,
+            frame=frame_predict.index,
+            timestamp=round(timestamp, 2),
+            cls_name=image_predict.cls_names[int(boxes.cls[best])],
+            conf=round(float(boxes.conf[best]), 4),
+            xyxy=xyxy,
+            video_predict_pk=self.video_predict_pk,
+            camera_pk=self.camera_pk,
+            thumbnail=crop_thumbnail(frame_predict.frame, xyxy, self.thumbnail_size),
+        ))
+        self._last_alert = timestamp
+
+
+_alert_stream: AlertStream | None = None
+
+
+def get_alert_stream() -> AlertStream | None:
+    """
+    Get the process-wide alert stream configured from Django settings.
+
+    Returns:
+        Alert stream or None if alerts are disabled.
+    """
+    global _alert_stream
+    from django.conf import settings
+
+    if not settings.WEAPONDETECT_ALERTS_ENABLED:
+        return None
+
+    if _alert_stream is None:
+        _alert_stream = AlertStream(
+            redis_url=settings.WEAPONDETECT_ALERTS_REDIS_URL,
+            maxlen=settings.WEAPONDETECT_ALERTS_STREAM_MAXLEN,
+        )
+    return _alert_stream
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class WeapondetectappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'weapondetectapp'
+
+    def ready(self):
+        import weapondetectapp.signals
+
+        if settings.WEAPONDETECT_PRELOAD_MODEL:
+            weapondetectapp.signals.preload_model()
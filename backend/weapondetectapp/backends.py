@@ -0,0 +1,214 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from weapondetectapp.cache import file_digest
+from weapondetectapp.tracking import box_iou
+
+
+# Inference backend -> ultralytics export format
+BACKENDS = {
+    'torch': None,
+    'onnx': 'onnx',
+    'openvino': 'openvino',
+}
+
+_warned = set()
+
+
+def artifact_path(weights_path: str, backend: str) -> str:
+    """
+    Get the path ultralytics exports a backend artifact to, next to the weights.
+
+    Args:
+        weights_path: Path to the PyTorch weights file.
+        backend: Inference backend.
+
+    Returns:
+        Path to the exported model file or folder.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, expected one of {", ".join(BACKENDS)}')
+
+    stem, _ = os.path.splitext(weights_path)
+    if backend == 'onnx':
+        return f'{stem}.onnx'
+    if backend == 'openvino':
+        return f'{stem}_openvino_model'
+    return weights_path
+
+
+def is_exported(weights_path: str, backend: str) -> bool:
+    """
+    Check that a backend artifact exists and is not older than the weights it was exported from.
+    """
+    path = artifact_path(weights_path, backend)
+    if path == weights_path:
+        return True
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(weights_path) or os.path.getmtime(path) >= os.path.getmtime(weights_path)
+
+
+def verified_path(weights_path: str, backend: str) -> str:
+    stem, _ = os.path.splitext(weights_path)
+    return f'{stem}_{backend}.verified'
+
+
+def mark_verified(weights_path: str, backend: str) -> None:
+    """
+    Activate a backend artifact that passed the parity check against PyTorch.
+
+    The marker holds the SHA-256 of the weights, so it is void once the weights change.
+    """
+    with open(verified_path(weights_path, backend), 'w') as f:
+        f.write(file_digest(weights_path))
+
+
+def unmark_verified(weights_path: str, backend: str) -> None:
+    path = verified_path(weights_path, backend)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def is_verified(weights_path: str, backend: str) -> bool:
+    """
+    Check that a backend artifact passed the parity check against the current weights.
+    """
+    path = verified_path(weights_path, backend)
+    if artifact_path(weights_path, backend) == weights_path:
+        return True
+    if not os.path.exists(path) or not os.path.exists(weights_path):
+        return False
+    with open(path) as f:
+        return f.read().strip() == file_digest(weights_path)
+
+
+def resolve_model_path(weights_path: str, backend: str) -> str:
+    """
+    Get the model path to load for a backend, falling back to the PyTorch weights
+    if it is not exported or did not pass the parity check.
+
+    Args:
+        weights_path: Path to the PyTorch weights file.
+        backend: Inference backend.
+
+    Returns:
+        Path to load with ultralytics.
+    """
+    reason = None
+    if not is_exported(weights_path, backend):
+        reason = 'is not exported'
+    elif not is_verified(weights_path, backend):
+        reason = 'is not checked against PyTorch'
+    else:
+        return artifact_path(weights_path, backend)
+
+    if (weights_path, backend, reason) not in _warned:
+        _warned.add((weights_path, backend, reason))
+        print(f'Model {reason} for the {backend} backend, using PyTorch. '
+              f'Run "python manage.py export_detector --backend {backend}"')
+    return weights_path
+
+
+def export_model(weights_path: str, backend: str, imgsz: int = 640, force: bool = False) -> str:
+    """
+    Export the PyTorch weights for a backend, once.
+
+    Args:
+        weights_path: Path to the PyTorch weights file.
+        backend: Inference backend.
+        imgsz: Input image size of the exported model.
+        force: Export even if an up-to-date artifact exists.
+
+    Returns:
+        Path to the exported model.
+    """
+    from ultralytics import YOLO
+
+    path = artifact_path(weights_path, backend)
+    if BACKENDS[backend] is None or (not force and is_exported(weights_path, backend)):
+        return path
+
+    # Dynamic axes let the model take batches of any size and the cascade gate its smaller images,
+    # OpenVINO is converted from an ONNX export and inherits them
+    exported = YOLO(weights_path).export(format=BACKENDS[backend], imgsz=imgsz, dynamic=True)
+    return str(exported)
+
+
+@dataclass
+class ParityReport:
+    """
+    images: Number of compared images
+    reference_boxes: Number of boxes found by the reference model
+    matched_boxes: Number of reference boxes found by the candidate model with the same class
+    missing_boxes: Number of reference boxes the candidate model did not find
+    extra_boxes: Number of candidate boxes without a reference box
+    min_iou: Lowest IoU of a matched box pair
+    max_conf_diff: Largest confidence difference of a matched box pair
+    """
+    images: int = 0
+    reference_boxes: int = 0
+    matched_boxes: int = 0
+    missing_boxes: int = 0
+    extra_boxes: int = 0
+    min_iou: float = 1.0
+    max_conf_diff: float = 0.0
+
+    def passed(self, min_iou: float = 0.9, max_conf_diff: float = 0.05, max_unmatched: float = 0.02) -> bool:
+        """
+        Check the candidate model against the tolerances.
+
+        Args:
+            min_iou: Lowest acceptable IoU of a matched box pair.
+            max_conf_diff: Largest acceptable confidence difference.
+            max_unmatched: Largest acceptable share of missing or extra boxes.
+
+        Returns:
+            Whether the candidate model is within the tolerances.
+        """
+        unmatched = (self.missing_boxes + self.extra_boxes) / max(self.reference_boxes, 1)
+        return self.min_iou >= min_iou and self.max_conf_diff <= max_conf_diff and unmatched <= max_unmatched
+
+
+def compare_predictions(reference: List['ImagePredict'], candidate: List['ImagePredict'],
+                        iou_threshold: float = 0.5) -> ParityReport:
+    """
+    Compare the boxes of two models on the same images.
+
+    Boxes are matched greedily by IoU within the same class.
+
+    Args:
+        reference: Image predict objects of the reference model.
+        candidate: Image predict objects of the candidate model, in the same order.
+        iou_threshold: Minimum IoU of a box pair to be matched.
+
+    Returns:
+        Parity report.
+    """
+    report = ParityReport()
+    for expected, actual in zip(reference, candidate):
+        report.images += 1
+        report.reference_boxes += len(expected.boxes)
+
+        iou = box_iou(expected.boxes.xyxy, actual.boxes.xyxy)
+        iou[expected.boxes.cls[:, None] != actual.boxes.cls[None, :]] = 0
+
+        matched: Dict[int, int] = {}
+        for flat_index in np.argsort(-iou, axis=None):
+            i, j = np.unravel_index(flat_index, iou.shape)
+            if iou[i, j] < iou_threshold:
+                break
+            if i in matched or j in matched.values():
+                continue
+            matched[i] = j
+            report.min_iou = min(report.min_iou, float(iou[i, j]))
+            report.max_conf_diff = max(
+                report.max_conf_diff, abs(float(expected.boxes.conf[i] - actual.boxes.conf[j])))
+
+        report.matched_boxes += len(matched)
+        report.missing_boxes += len(expected.boxes) - len(matched)
+        report.extra_boxes += len(actual.boxes) - len(matched)
+    return report
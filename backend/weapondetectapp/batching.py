@@ -0,0 +1,190 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+from weapondetectapp.metrics import registry
+
+
+QUEUE_DEPTH = registry.gauge(
+    'weapondetect_microbatch_queue_depth', 'Images waiting for the micro-batcher')
+BATCH_SIZE = registry.histogram(
+    'weapondetect_microbatch_batch_size', 'Images in one micro-batch',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_FILL = registry.histogram(
+    'weapondetect_microbatch_batch_fill', 'Micro-batch size relative to the maximum batch size',
+    buckets=(0.125, 0.25, 0.5, 0.75, 1))
+BATCH_WAIT = registry.histogram(
+    'weapondetect_microbatch_wait_seconds', 'Time the first image of a micro-batch waited for the batch to fill')
+
+
+class MicroBatcher:
+    """
+    Collects single-image requests from many threads into batched forward passes.
+
+    A background thread takes the first waiting image, then keeps collecting
+    until max_batch_size images are gathered or max_latency has passed since
+    the first one, and runs them as one batch. Every caller gets a future
+    resolved with its own image predict object.
+    """
+
+    def __init__(
+        self,
+        get_detector: Callable[[], 'TerroristDetector'],
+        max_batch_size: int = 8,
+        max_latency: float = 0.01,
+    ) -> None:
+        """
+        Args:
+            get_detector: Callable returning the detector to run the batches with.
+            max_batch_size: Maximum number of images in one batch.
+            max_latency: Maximum time in seconds the first image of a batch waits for more.
+        """
+        self.get_detector = get_detector
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self._queue: queue.Queue[Tuple[str | np.ndarray, Future]] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        # Started lazily so a forked worker process gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='microbatcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, source: str | np.ndarray) -> Future:
+        """
+        Queue an image for the next batch.
+
+        Args:
+            source: Path to the image or BGR image array.
+
+        Returns:
+            Future resolved with the image predict object.
+        """
+        self._ensure_started()
+        future: Future = Future()
+        self._queue.put((source, future))
+        QUEUE_DEPTH.inc()
+        return future
+
+    def predict(self, source: str | np.ndarray, timeout: float | None = None) -> 'ImagePredict':
+        """
+        Predict one image as part of a batch.
+
+        Args:
+            source: Path to the image or BGR image array.
+            timeout: Maximum time in seconds to wait for the result.
+
+        Returns:
+            Image predict object.
+        """
+        return self.submit(source).result(timeout)
+
+    def predict_many(self, sources: Sequence[str | np.ndarray],
+                     timeout: float | None = None) -> List['ImagePredict | Exception']:
+        """
+        Predict many images, possibly batched together with other callers.
+
+        Args:
+            sources: Paths to the images or BGR image arrays.
+            timeout: Maximum time in seconds to wait for each result.
+
+        Returns:
+            Image predict objects, or the exception of the images that failed, in input order.
+        """
+        futures = [self.submit(source) for source in sources]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _collect(self) -> List[Tuple[str | np.ndarray, Future]]:
+        batch = [self._queue.get()]
+        started = time.monotonic()
+        deadline = started + self.max_latency
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        QUEUE_DEPTH.dec(len(batch))
+        BATCH_WAIT.observe(time.monotonic() - started)
+        BATCH_SIZE.observe(len(batch))
+        BATCH_FILL.observe(len(batch) / self.max_batch_size)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            batch = [(source, future) for source, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch: List[Tuple[str | np.ndarray, Future]]) -> None:
+        try:
+            detector = self.get_detector()
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        try:
+            results = detector.predict_batch([source for source, _ in batch], len(batch))
+        except Exception:
+            # One broken image must not fail the others
+            for source, future in batch:
+                try:
+                    future.set_result(detector.predict_batch([source], 1)[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+_batcher: MicroBatcher | None = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> MicroBatcher | None:
+    """
+    Get the process-wide micro-batcher configured from Django settings.
+
+    It serves the API views of the web process, where many requests of a few
+    images each run at once; Celery tasks already hold a batch and call
+    predict_batch directly.
+
+    Returns:
+        Micro-batcher or None if micro-batching is disabled.
+    """
+    global _batcher
+    from django.conf import settings
+    from weapondetectapp.registry import get_detector
+
+    if not settings.WEAPONDETECT_MICROBATCH_ENABLED:
+        return None
+
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                get_detector,
+                max_batch_size=settings.WEAPONDETECT_MICROBATCH_MAX_SIZE,
+                max_latency=settings.WEAPONDETECT_MICROBATCH_MAX_LATENCY_MS / 1000,
+            )
+    return _batcher
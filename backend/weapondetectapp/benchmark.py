@@ -0,0 +1,284 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from weapondetectapp.boxes import Boxes
+
+
+# Baseline committed with the code, the benchmark command compares against it by default
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    name: Benchmarked method
+    resolution: Input resolution as WIDTHxHEIGHT
+    runs: Number of measured runs
+    p50_ms: Median latency of one run in milliseconds
+    p95_ms: 95th percentile latency of one run in milliseconds
+    throughput: Images or frames per second
+    unit: What the throughput counts, images or frames
+    peak_rss_mb: Peak growth of the resident memory during the benchmark over the memory before it, in megabytes
+    """
+    name: str
+    resolution: str
+    runs: int
+    p50_ms: float
+    p95_ms: float
+    throughput: float
+    unit: str
+    peak_rss_mb: float
+
+    @property
+    def key(self) -> str:
+        return f'{self.name}@{self.resolution}'
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb() -> float | None:
+    """
+    Get the resident memory of the process now, None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+
+class RSSSampler:
+    """
+    Peak growth of the resident memory while a block runs, over the memory before it.
+
+    The lifetime ru_maxrss only ever grows, so every benchmark after the
+    heaviest one would report the same peak. The current RSS is sampled in
+    a thread instead; without /proc the growth of the lifetime peak is used,
+    which misses peaks below an earlier one.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        """
+        Args:
+            interval: Time in seconds between two samples.
+        """
+        self.interval = interval
+        self.baseline = 0.0
+        self.peak = 0.0
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def growth_mb(self) -> float:
+        return max(0.0, self.peak - self.baseline)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb() or 0.0)
+
+    def __enter__(self) -> 'RSSSampler':
+        rss = current_rss_mb()
+        if rss is None:
+            self.baseline = self.peak = peak_rss_mb()
+            return self
+        self.baseline = self.peak = rss
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._thread is None:
+            self.peak = peak_rss_mb()
+            return
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb() or 0.0)
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """
+    Build a BGR test image with noise and filled shapes, so it compresses and decodes like a photo.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    for _ in range(20):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(10, max(11, min(width, height) // 4)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(image, (x, y), (x + size, y + size), color, -1)
+    return image
+
+
+def synthetic_boxes(width: int, height: int, count: int = 20, seed: int = 0) -> Boxes:
+    """
+    Build random boxes inside an image, to render without a trained model.
+    """
+    rng = np.random.default_rng(seed)
+    x1 = rng.uniform(0, width * 0.9, count)
+    y1 = rng.uniform(0, height * 0.9, count)
+    return Boxes(
+        cls=rng.integers(0, 3, count),
+        conf=rng.uniform(0.25, 1, count),
+        xyxy=np.stack([x1, y1, x1 + rng.uniform(10, width * 0.1, count), y1 + rng.uniform(10, height * 0.1, count)], 1),
+    )
+
+
+def write_video(path: str, width: int, height: int, frames: int, fps: int = 25) -> str:
+    """
+    Write a synthetic video with a moving shape.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    background = synthetic_image(width, height)
+    for index in range(frames):
+        frame = background.copy()
+        x = index * 8 % max(1, width - 50)
+        cv2.rectangle(frame, (x, height // 2), (x + 50, height // 2 + 50), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def measure(run: Callable[[], None], runs: int, warmup: int = 1,
+            prepare: Callable[[], None] | None = None) -> Tuple[List[float], float]:
+    """
+    Time a callable and the memory it takes.
+
+    Args:
+        run: Callable to time.
+        runs: Number of measured runs.
+        warmup: Number of runs before measuring.
+        prepare: Callable invoked before every run, outside of the timing.
+
+    Returns:
+        Seconds of every measured run and the peak growth of the resident memory in megabytes.
+    """
+    timings = []
+    with RSSSampler() as sampler:
+        for index in range(warmup + runs):
+            if prepare is not None:
+                prepare()
+            started = time.perf_counter()
+            run()
+            if index >= warmup:
+                timings.append(time.perf_counter() - started)
+    return timings, sampler.growth_mb
+
+
+def summarize(name: str, resolution: Tuple[int, int], measured: Tuple[Sequence[float], float],
+              items_per_run: int, unit: str) -> BenchmarkResult:
+    timings, rss_growth_mb = measured
+    timings = np.array(timings)
+    return BenchmarkResult(
+        name=name,
+        resolution=f'{resolution[0]}x{resolution[1]}',
+        runs=len(timings),
+        p50_ms=float(np.percentile(timings, 50) * 1000),
+        p95_ms=float(np.percentile(timings, 95) * 1000),
+        throughput=float(items_per_run * len(timings) / timings.sum()) if timings.sum() else 0.0,
+        unit=unit,
+        peak_rss_mb=rss_growth_mb,
+    )
+
+
+def run_benchmarks(detector: 'TerroristDetector', workdir: str, resolutions: Sequence[Tuple[int, int]],
+                   runs: int = 10, folder_images: int = 16, video_frames: int = 50) -> List[BenchmarkResult]:
+    """
+    Benchmark the detection hot paths on synthetic images and videos.
+
+    Args:
+        detector: Detector to benchmark.
+        workdir: Folder for the generated files.
+        resolutions: (width, height) of the generated images and videos.
+        runs: Number of measured runs of every benchmark.
+        folder_images: Number of images in the folder for predict_folder_with_images.
+        video_frames: Number of frames of the generated videos.
+
+    Returns:
+        Result of every benchmark at every resolution.
+    """
+    results = []
+    for width, height in resolutions:
+        resolution = (width, height)
+        folder = os.path.join(workdir, f'{width}x{height}')
+        os.makedirs(folder, exist_ok=True)
+        for index in range(folder_images):
+            cv2.imwrite(os.path.join(folder, f'{index}.jpg'), synthetic_image(width, height, seed=index))
+        image_path = os.path.join(folder, '0.jpg')
+
+        measured = measure(lambda: detector.predict(image_path), runs)
+        results.append(summarize('predict', resolution, measured, 1, 'images'))
+
+        # A random model finds nothing, so the boxes to draw are made up
+        image_predict = detector.predict(image_path)
+        image_predict.boxes = synthetic_boxes(width, height)
+        measured = measure(lambda: detector.draw_bounding_box(image_predict), runs)
+        results.append(summarize('draw_bounding_box', resolution, measured, 1, 'images'))
+
+        measured = measure(lambda: list(detector.predict_folder_with_images(folder)), max(1, runs // 4))
+        results.append(summarize('predict_folder_with_images', resolution, measured, folder_images, 'images'))
+
+        # The video is replaced by its annotated copy, so every run gets a fresh one
+        video_path = os.path.join(workdir, f'{width}x{height}.mp4')
+        measured = measure(
+            lambda: detector.predict_video_and_draw_boxes_on_existing_video(video_path),
+            max(1, runs // 4),
+            prepare=lambda: write_video(video_path, width, height, video_frames),
+        )
+        results.append(summarize(
+            'predict_video_and_draw_boxes_on_existing_video', resolution, measured, video_frames, 'frames'))
+    return results
+
+
+def save_results(results: Sequence[BenchmarkResult], path: str, **meta) -> None:
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': [asdict(result) for result in results]}, f, indent=2)
+
+
+def load_results(path: str) -> Dict[str, BenchmarkResult]:
+    with open(path) as f:
+        data = json.load(f)
+    results = [BenchmarkResult(**result) for result in data['results']]
+    return {result.key: result for result in results}
+
+
+def find_regressions(results: Sequence[BenchmarkResult], baseline: Dict[str, BenchmarkResult],
+                     tolerance: float = 0.2, rss_slack_mb: float = 16.0) -> List[str]:
+    """
+    Compare results against a baseline.
+
+    Args:
+        results: Results of the current run.
+        baseline: Baseline results by key.
+        tolerance: Allowed relative slowdown of p50, p95 and throughput, and growth of the peak memory.
+        rss_slack_mb: Memory growth allowed on top of the tolerance, small peaks vary with the allocator.
+
+    Returns:
+        Descriptions of the regressions.
+    """
+    regressions = []
+    for result in results:
+        expected = baseline.get(result.key)
+        if expected is None:
+            continue
+        for name, slack in (('p50_ms', 0.0), ('p95_ms', 0.0), ('peak_rss_mb', rss_slack_mb)):
+            value, reference = getattr(result, name), getattr(expected, name)
+            if reference and value > reference * (1 + tolerance) + slack:
+                regressions.append(f'{result.key}: {name} {reference:.1f} -> {value:.1f}')
+        if expected.throughput and result.throughput < expected.throughput * (1 - tolerance):
+            regressions.append(
+                f'{result.key}: {result.unit}/s {expected.throughput:.1f} -> {result.throughput:.1f}')
+    return regressions
@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+
+@dataclass
+class BoxPredict:
+    """
+    cls: Box class
+    conf: Confidence score
+
+    xyxy: Coordinates of two floats of the bounding boxes
+    """
+    cls: float
+    conf: float
+
+    xyxy: List[float]
+
+
+@dataclass
+class Boxes:
+    """
+    Array-backed bounding boxes of one image.
+
+    cls: Box classes, shape (N,)
+    conf: Confidence scores, shape (N,)
+    xyxy: Coordinates of the bounding boxes, shape (N, 4)
+    """
+    cls: np.ndarray
+    conf: np.ndarray
+    xyxy: np.ndarray
+
+    def __post_init__(self) -> None:
+        self.cls = np.asarray(self.cls, dtype=np.float32).reshape(-1)
+        self.conf = np.asarray(self.conf, dtype=np.float32).reshape(-1)
+        self.xyxy = np.asarray(self.xyxy, dtype=np.float32).reshape(-1, 4)
+
+    def __len__(self) -> int:
+        return len(self.cls)
+
+    def __iter__(self) -> Iterator[BoxPredict]:
+        for cls, conf, xyxy in zip(self.cls.tolist(), self.conf.tolist(), self.xyxy.tolist()):
+            yield BoxPredict(cls=cls, conf=conf, xyxy=xyxy)
+
+    def __getitem__(self, index) -> 'BoxPredict | Boxes':
+        if isinstance(index, (int, np.integer)):
+            return BoxPredict(
+                cls=float(self.cls[index]),
+                conf=float(self.conf[index]),
+                xyxy=self.xyxy[index].tolist(),
+            )
+        return Boxes(cls=self.cls[index], conf=self.conf[index], xyxy=self.xyxy[index])
+
+    @classmethod
+    def empty(cls) -> 'Boxes':
+        return cls(cls=[], conf=[], xyxy=[])
+
+    @classmethod
+    def concatenate(cls, boxes: List['Boxes']) -> 'Boxes':
+        if not boxes:
+            return cls.empty()
+        return cls(
+            cls=np.concatenate([item.cls for item in boxes]),
+            conf=np.concatenate([item.conf for item in boxes]),
+            xyxy=np.concatenate([item.xyxy for item in boxes]),
+        )
+
+    def shift(self, x: float, y: float) -> 'Boxes':
+        """
+        Get the boxes moved by an offset, e.g. from a crop into the coordinates of the whole image.
+        """
+        return Boxes(cls=self.cls, conf=self.conf, xyxy=self.xyxy + np.array([x, y, x, y], dtype=np.float32))
+
+    @classmethod
+    def from_results(cls, boxes) -> 'Boxes':
+        """
+        Build boxes from ultralytics boxes with a single device-to-host copy.
+
+        Args:
+            boxes: Boxes of an ultralytics result, rows of (x1, y1, x2, y2, [track id,] conf, cls).
+
+        Returns:
+            Boxes object.
+        """
+        if boxes is None:
+            return cls.empty()
+
+        data = boxes.data
+        if hasattr(data, 'cpu'):
+            data = data.cpu().numpy()
+        data = np.asarray(data, dtype=np.float32)
+        return cls(cls=data[:, -1], conf=data[:, -2], xyxy=data[:, :4])
+
+    @classmethod
+    def from_list(cls, boxes: List[BoxPredict]) -> 'Boxes':
+        return cls(
+            cls=[box.cls for box in boxes],
+            conf=[box.conf for box in boxes],
+            xyxy=[box.xyxy for box in boxes],
+        )
+
+    @classmethod
+    def from_json(cls, boxes: List[Dict]) -> 'Boxes':
+        """
+        Build boxes from the dicts stored in ImagePredict.boxes.
+        """
+        return cls(
+            cls=[box['cls'] for box in boxes],
+            conf=[box['conf'] for box in boxes],
+            xyxy=[box['xyxy'] for box in boxes],
+        )
+
+    def to_json(self, cls_names: Dict[float, str]) -> List[Dict]:
+        """
+        Get the bounding boxes as JSON-serializable dicts.
+
+        Args:
+            cls_names: Dict of classes and their names.
+
+        Returns:
+            List of dicts with class, class name, confidence score and coordinates.
+        """
+        classes = self.cls.astype(int).tolist()
+        confs = np.round(self.conf.astype(np.float64), 4).tolist()
+        coordinates = np.round(self.xyxy.astype(np.float64), 1).tolist()
+        return [
+            {'cls': cls, 'name': cls_names.get(cls), 'conf': conf, 'xyxy': xyxy}
+            for cls, conf, xyxy in zip(classes, confs, coordinates)
+        ]
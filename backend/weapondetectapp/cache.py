@@ -0,0 +1,255 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
+
+import redis
+
+from weapondetectapp.metrics import registry
+
+
+CACHE_LOOKUPS = registry.counter(
+    'weapondetect_cache_lookups_total', 'Result cache lookups by whether the result was found',
+    labelnames=('result',))
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Compute the SHA-256 of a file without reading it into memory at once.
+
+    Args:
+        path: Path to the file.
+        chunk_size: Number of bytes read at a time.
+
+    Returns:
+        Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    """
+    boxes: Detections, as stored in ImagePredict.boxes / VideoPredict.boxes
+    cls_names: Dict of classes and their names
+
+    artifact: Annotated image bytes
+    artifact_path: Path to the annotated video, relative to MEDIA_ROOT
+    """
+    boxes: List | Dict = field(default_factory=list)
+    cls_names: Dict[int, str] = field(default_factory=dict)
+
+    artifact: bytes | None = None
+    artifact_path: str | None = None
+
+    @property
+    def size(self) -> int:
+        return len(self.artifact or b'') + len(json.dumps(self.boxes))
+
+
+class ResultCache:
+    """
+    Content-addressed cache of detection results.
+
+    Entries are keyed by the hash of the file contents, the model version and
+    the inference options. A small in-process LRU sits in front of Redis;
+    Redis entries expire after ttl seconds and the local LRU is bounded by
+    both the number of entries and their total size. When Redis fails the
+    cache keeps working in process only and tries Redis again after
+    retry_after seconds, reporting the outage once.
+    """
+    PREFIX = 'weapondetect:result:'
+
+    def __init__(
+        self,
+        redis_url: str | None = None,
+        ttl: int = 7 * 24 * 60 * 60,
+        max_entries: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_artifact_bytes: int = 8 * 1024 * 1024,
+        retry_after: float = 30.0,
+    ) -> None:
+        """
+        Args:
+            redis_url: Redis URL, None keeps the cache in process only.
+            ttl: Lifetime of an entry in seconds.
+            max_entries: Maximum number of entries in the local LRU.
+            max_bytes: Maximum total size of the entries in the local LRU.
+            max_artifact_bytes: Annotated images larger than this are not cached.
+            retry_after: Time in seconds Redis is skipped after it failed.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_artifact_bytes = max_artifact_bytes
+        self.retry_after = retry_after
+
+        self._redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self._redis_down_until: float | None = None
+        self._local: OrderedDict[str, Tuple[float, CacheEntry]] = OrderedDict()
+        self._local_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(digest: str, model_version: str, **options) -> str:
+        """
+        Build the cache key of a file.
+
+        Args:
+            digest: SHA-256 of the file contents.
+            model_version: Version of the model weights.
+            options: Inference options that change the result.
+
+        Returns:
+            Cache key.
+        """
+        payload = json.dumps([digest, model_version, options], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _get_local(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at < time.monotonic():
+                self._pop_local(key)
+                return None
+            self._local.move_to_end(key)
+            return entry
+
+    def _pop_local(self, key: str) -> None:
+        _, entry = self._local.pop(key)
+        self._local_bytes -= entry.size
+
+    def _set_local(self, key: str, entry: CacheEntry) -> None:
+        with self._lock:
+            if key in self._local:
+                self._pop_local(key)
+            self._local[key] = (time.monotonic() + self.ttl, entry)
+            self._local_bytes += entry.size
+
+            # Evict the least recently used entries
+            while self._local and (len(self._local) > self.max_entries or self._local_bytes > self.max_bytes):
+                self._pop_local(next(iter(self._local)))
+
+    def _remote(self) -> redis.Redis | None:
+        # Skip Redis for a while after it failed instead of waiting for it on every lookup
+        if self._redis is None or (
+                self._redis_down_until is not None and time.monotonic() < self._redis_down_until):
+            return None
+        return self._redis
+
+    def _remote_failed(self, error: redis.RedisError) -> None:
+        if self._redis_down_until is None:
+            print(f'Result cache is unavailable, using the local cache only: {error}')
+        self._redis_down_until = time.monotonic() + self.retry_after
+
+    def _remote_succeeded(self) -> None:
+        if self._redis_down_until is not None:
+            print('Result cache is available again')
+        self._redis_down_until = None
+
+    def get(self, key: str) -> CacheEntry | None:
+        """
+        Get a cached result.
+
+        Args:
+            key: Cache key.
+
+        Returns:
+            Cache entry or None if the result is not cached.
+        """
+        entry = self._get_local(key)
+
+        remote = self._remote() if entry is None else None
+        if remote is not None:
+            try:
+                data = remote.hgetall(self.PREFIX + key)
+                self._remote_succeeded()
+            except redis.RedisError as e:
+                self._remote_failed(e)
+                data = None
+            if data:
+                fields = json.loads(data[b'entry'])
+                fields['cls_names'] = {int(cls): name for cls, name in fields['cls_names'].items()}
+                entry = CacheEntry(artifact=data.get(b'artifact'), **fields)
+                self._set_local(key, entry)
+
+        if entry is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result='miss')
+        else:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result='hit')
+        return entry
+
+    def set(self, key: str, entry: CacheEntry) -> None:
+        """
+        Cache a result.
+
+        Args:
+            key: Cache key.
+            entry: Cache entry.
+        """
+        if entry.artifact is not None and len(entry.artifact) > self.max_artifact_bytes:
+            entry = CacheEntry(**{**asdict(entry), 'artifact': None})
+
+        self._set_local(key, entry)
+
+        remote = self._remote()
+        if remote is None:
+            return
+
+        fields = asdict(entry)
+        artifact = fields.pop('artifact')
+        mapping = {'entry': json.dumps(fields)}
+        if artifact is not None:
+            mapping['artifact'] = artifact
+
+        try:
+            with remote.pipeline() as pipe:
+                pipe.delete(self.PREFIX + key)
+                pipe.hset(self.PREFIX + key, mapping=mapping)
+                pipe.expire(self.PREFIX + key, self.ttl)
+                pipe.execute()
+            self._remote_succeeded()
+        except redis.RedisError as e:
+            self._remote_failed(e)
+
+
+_result_cache: ResultCache | None = None
+
+
+def get_result_cache() -> ResultCache | None:
+    """
+    Get the process-wide result cache configured from Django settings.
+
+    Returns:
+        Result cache or None if caching is disabled.
+    """
+    global _result_cache
+    from django.conf import settings
+
+    if not settings.WEAPONDETECT_CACHE_ENABLED:
+        return None
+
+    if _result_cache is None:
+        _result_cache = ResultCache(
+            redis_url=settings.WEAPONDETECT_CACHE_REDIS_URL,
+            ttl=settings.WEAPONDETECT_CACHE_TTL,
+            max_entries=settings.WEAPONDETECT_CACHE_LOCAL_ENTRIES,
+            max_bytes=settings.WEAPONDETECT_CACHE_LOCAL_BYTES,
+            max_artifact_bytes=settings.WEAPONDETECT_CACHE_MAX_ARTIFACT_BYTES,
+        )
+    return _result_cache
@@ -0,0 +1,297 @@
+import glob
+import os
+import threading
+import time
+from dataclasses import replace
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from weapondetectapp.alerts import WeaponAlertEmitter
+from weapondetectapp.metrics import registry
+from weapondetectapp.video import FramePredict, TrackRecorder
+from weapondetectapp.videoio import VideoWriter, open_video_writer
+
+
+CAMERA_FRAMES = registry.counter(
+    'weapondetect_camera_frames_total', 'Camera frames by whether they were processed or dropped',
+    labelnames=('camera', 'outcome'))
+CAMERA_LAG_SECONDS = registry.gauge(
+    'weapondetect_camera_lag_seconds', 'Time from capturing the last processed camera frame to the end of its processing',
+    labelnames=('camera',))
+CAMERA_CONNECTED = registry.gauge(
+    'weapondetect_camera_connected', 'Whether the camera stream is open', labelnames=('camera',))
+
+
+class LatestFrameReader:
+    """
+    Read a stream continuously in a thread and keep only its newest frame.
+
+    A frame the consumer did not take before the next one arrived is dropped,
+    so a slow consumer always gets a fresh frame and the latency stays bounded
+    instead of frames queuing up. A lost stream is reopened after
+    reconnect_delay seconds. A local file is read at its own frame rate, to
+    replay it like a live camera, and optionally looped.
+    """
+
+    def __init__(self, url: str, label: str = '', reconnect_delay: float = 5.0, loop: bool = True) -> None:
+        """
+        Args:
+            url: Stream URL or path to a local file.
+            label: Camera label of the metrics.
+            reconnect_delay: Time in seconds to wait before reopening a lost stream.
+            loop: Replay a local file from the start when it ends.
+        """
+        self.url = url
+        self.label = label
+        self.reconnect_delay = reconnect_delay
+        self.loop = loop
+        self.is_file = os.path.isfile(url)
+
+        self.fps = 0.0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.ended = False
+
+        self._frame: Tuple[int, np.ndarray, float] | None = None
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=f'camera-{self.label}', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        CAMERA_CONNECTED.set(0, camera=self.label)
+
+    def _run(self) -> None:
+        index = 0
+        while not self._stop.is_set():
+            cap = cv2.VideoCapture(self.url)
+            if not cap.isOpened():
+                print(f'Camera {self.label} is unavailable, retrying in {self.reconnect_delay:.0f} s')
+                self._stop.wait(self.reconnect_delay)
+                continue
+
+            CAMERA_CONNECTED.set(1, camera=self.label)
+            self.fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+            next_frame_at = time.monotonic()
+            try:
+                while not self._stop.is_set():
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    if self.is_file:
+                        next_frame_at += 1 / self.fps
+                        self._stop.wait(max(0.0, next_frame_at - time.monotonic()))
+
+                    with self._condition:
+                        if self._frame is not None:
+                            self.frames_dropped += 1
+                            CAMERA_FRAMES.inc(camera=self.label, outcome='dropped')
+                        self._frame = (index, frame, time.time())
+                        self.frames_read += 1
+                        self._condition.notify()
+                    index += 1
+            finally:
+                cap.release()
+                CAMERA_CONNECTED.set(0, camera=self.label)
+
+            if self.is_file and not self.loop:
+                break
+            if not self._stop.is_set() and not self.is_file:
+                print(f'Camera {self.label} stream is lost, reconnecting in {self.reconnect_delay:.0f} s')
+                self._stop.wait(self.reconnect_delay)
+
+        with self._condition:
+            self.ended = True
+            self._condition.notify()
+
+    def read(self, timeout: float = 1.0) -> Tuple[int, np.ndarray, float] | None:
+        """
+        Take the newest frame.
+
+        Args:
+            timeout: Maximum time in seconds to wait for a frame.
+
+        Returns:
+            (frame index, BGR frame, Unix time it was captured) or None if no frame arrived.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame is not None or self.ended, timeout)
+            item, self._frame = self._frame, None
+            return item
+
+
+class SegmentWriter:
+    """
+    Rolling recording split into segments of a fixed length.
+
+    Only the newest retention segments are kept on disk, together with the
+    detection track saved next to every segment.
+    """
+
+    def __init__(self, directory: str, segment_seconds: float = 60, retention: int = 60,
+                 preset: str = 'balanced') -> None:
+        """
+        Args:
+            directory: Folder of the segments.
+            segment_seconds: Length of one segment in seconds of wall time.
+            retention: Number of segments kept.
+            preset: Encoder preset, one of videoio.ENCODER_PRESETS.
+        """
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.retention = max(1, retention)
+        self.preset = preset
+
+        self.path: str | None = None
+        self._writer: VideoWriter | None = None
+        self._opened_at = 0.0
+        self._size: Tuple[int, int] | None = None
+
+    def write(self, frame: np.ndarray, fps: float) -> str | None:
+        """
+        Append a frame, starting a new segment when the current one is full.
+
+        Args:
+            frame: BGR frame.
+            fps: Frame rate of a new segment.
+
+        Returns:
+            Path to the segment finished by this frame, if any.
+        """
+        size = (frame.shape[1], frame.shape[0])
+        finished = None
+        # The stream may come back with another resolution after a reconnect
+        if self._writer is None or size != self._size or \
+                time.monotonic() - self._opened_at >= self.segment_seconds:
+            finished = self.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._prune()
+            self.path = os.path.join(self.directory, f'{time.strftime("%Y%m%d-%H%M%S")}.mp4')
+            self._writer = open_video_writer(self.path, fps, size, self.preset)
+            self._opened_at = time.monotonic()
+            self._size = size
+
+        self._writer.write(frame)
+        return finished
+
+    def close(self) -> str | None:
+        """
+        Finish the current segment.
+
+        Returns:
+            Path to the finished segment, None if no segment is open.
+        """
+        if self._writer is None:
+            return None
+        self._writer.close()
+        self._writer = None
+        return self.path
+
+    def _prune(self) -> None:
+        # Make room for the segment about to be opened
+        segments = sorted(glob.glob(os.path.join(self.directory, '*.mp4')))
+        for path in segments[:len(segments) - (self.retention - 1)]:
+            for stale in (path, f'{path}.track.npz'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+
+class CameraWorker:
+    """
+    Detect weapons on a live camera feed.
+
+    The newest frame is taken from a LatestFrameReader, run through the
+    model, annotated, appended to the rolling recording and passed to the
+    alert emitter. Frames arriving while the model is busy are dropped, so
+    the recording holds the processed frames only; each segment is written
+    at the processing rate measured over the previous one, so it plays back
+    at roughly real-time speed.
+    """
+
+    def __init__(
+        self,
+        camera: 'Camera',
+        detector: 'TerroristDetector',
+        reader: LatestFrameReader | None = None,
+        writer: SegmentWriter | None = None,
+        emitter: WeaponAlertEmitter | None = None,
+    ) -> None:
+        """
+        Args:
+            camera: Camera to process.
+            detector: Terrorist detector.
+            reader: Frame reader, by default one reading camera.url.
+            writer: Segment writer, by default one writing to camera.recording_dir.
+            emitter: Alert emitter, None to publish no alerts.
+        """
+        self.camera = camera
+        self.detector = detector
+        self.label = str(camera.pk)
+        self.reader = reader or LatestFrameReader(camera.url, label=self.label)
+        self.writer = writer or SegmentWriter(
+            camera.recording_dir, camera.segment_seconds, camera.retention_segments)
+        self.emitter = emitter
+
+        self.frames_processed = 0
+
+    def run(self, stop: threading.Event | None = None, max_frames: int | None = None) -> None:
+        """
+        Process the feed until stopped.
+
+        Args:
+            stop: Event that stops the worker, None to run until the stream ends.
+            max_frames: Stop after processing this many frames.
+        """
+        stop = stop or threading.Event()
+        recorder = TrackRecorder()
+        segment_frames = 0
+        segment_started = time.monotonic()
+        fps = 0.0
+
+        self.reader.start()
+        try:
+            while not stop.is_set() and (max_frames is None or self.frames_processed < max_frames):
+                item = self.reader.read(timeout=1.0)
+                if item is None:
+                    if self.reader.ended:
+                        break
+                    continue
+                index, frame, captured_at = item
+
+                image_predict = self.detector.predict_batch([frame], batch_size=1)[0]
+                self.detector.draw_bounding_box_on_array(frame, image_predict)
+                frame_predict = FramePredict(index=index, frame=frame, image_predict=image_predict)
+
+                finished = self.writer.write(frame, fps or self.reader.fps or 25.0)
+                if finished is not None:
+                    elapsed = time.monotonic() - segment_started
+                    fps = segment_frames / elapsed if elapsed > 0 else fps
+                    recorder.track.save(f'{finished}.track.npz')
+                    recorder = TrackRecorder()
+                    segment_frames = 0
+                    segment_started = time.monotonic()
+
+                # The track of a segment indexes the frames of its recording
+                recorder(replace(frame_predict, index=segment_frames))
+                segment_frames += 1
+                if self.emitter is not None:
+                    # The frame rate is only known once the stream is open
+                    self.emitter.fps = self.reader.fps or self.emitter.fps
+                    self.emitter(frame_predict)
+
+                self.frames_processed += 1
+                CAMERA_FRAMES.inc(camera=self.label, outcome='processed')
+                CAMERA_LAG_SECONDS.set(time.time() - captured_at, camera=self.label)
+        finally:
+            self.reader.stop()
+            finished = self.writer.close()
+            if finished is not None:
+                recorder.track.save(f'{finished}.track.npz')
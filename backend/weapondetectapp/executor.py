@@ -0,0 +1,185 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from weapondetectapp.metrics import registry
+
+
+IN_FLIGHT = registry.gauge(
+    'weapondetect_executor_in_flight', 'Inference tasks running or queued in the executor')
+
+
+class ExecutorBusy(Exception):
+    """
+    Raised when the inference executor has no free slot for another task.
+    """
+
+
+class InferenceExecutor:
+    """
+    Bounded thread pool running model calls off the event loop.
+
+    At most max_workers tasks run at once and at most max_pending tasks are
+    accepted in total (running plus queued). Once full, submit() fails
+    immediately instead of growing the queue, so the caller can answer
+    429 Too Many Requests and let the client back off.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 32) -> None:
+        """
+        Args:
+            max_workers: Number of threads running tasks.
+            max_pending: Maximum number of running and queued tasks.
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _acquire(self) -> None:
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusy(f'{self.max_pending} inference tasks are already pending')
+        with self._lock:
+            self._pending += 1
+        IN_FLIGHT.inc()
+
+    def _release(self, _: Future | None = None) -> None:
+        with self._lock:
+            self._pending -= 1
+        IN_FLIGHT.dec()
+        self._slots.release()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Run a callable in the pool without waiting for a free slot.
+
+        Args:
+            fn: Callable to run.
+            args: Positional arguments of the callable.
+            kwargs: Keyword arguments of the callable.
+
+        Returns:
+            Future of the result.
+
+        Raises:
+            ExecutorBusy: If max_pending tasks are already accepted.
+        """
+        self._acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """
+        Run a callable in the pool and await its result.
+
+        Args:
+            fn: Callable to run.
+            args: Positional arguments of the callable.
+            kwargs: Keyword arguments of the callable.
+
+        Returns:
+            Result of the callable.
+
+        Raises:
+            ExecutorBusy: If max_pending tasks are already accepted.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def reserve(self) -> 'Reservation':
+        """
+        Take a slot for a series of tasks without waiting for it.
+
+        A request accepted with a reservation runs all its tasks in the slot,
+        so it is either rejected upfront or admitted for all of them.
+
+        Returns:
+            Reservation holding the slot until it is released.
+
+        Raises:
+            ExecutorBusy: If max_pending tasks are already accepted.
+        """
+        self._acquire()
+        return Reservation(self)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+class Reservation:
+    """
+    Executor slot held by one request, its tasks run one after another.
+    """
+
+    def __init__(self, executor: InferenceExecutor) -> None:
+        self._executor = executor
+        self._future: Future | None = None
+        self._released = False
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """
+        Run a callable in the pool in the reserved slot and await its result.
+
+        Args:
+            fn: Callable to run.
+            args: Positional arguments of the callable.
+            kwargs: Keyword arguments of the callable.
+
+        Returns:
+            Result of the callable.
+        """
+        if self._released:
+            raise RuntimeError('The reservation is already released')
+        self._future = self._executor._executor.submit(fn, *args, **kwargs)
+        return await asyncio.wrap_future(self._future)
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self._future is None:
+            self._executor._release()
+        else:
+            # A task abandoned by a disconnected client keeps running and its slot with it
+            self._future.add_done_callback(self._executor._release)
+
+    async def __aenter__(self) -> 'Reservation':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+
+_inference_executor: InferenceExecutor | None = None
+_inference_executor_lock = threading.Lock()
+
+
+def get_inference_executor() -> InferenceExecutor:
+    """
+    Get the process-wide inference executor configured from Django settings.
+
+    Returns:
+        Inference executor.
+    """
+    global _inference_executor
+    from django.conf import settings
+
+    with _inference_executor_lock:
+        if _inference_executor is None:
+            _inference_executor = InferenceExecutor(
+                max_workers=settings.WEAPONDETECT_EXECUTOR_WORKERS,
+                max_pending=settings.WEAPONDETECT_EXECUTOR_QUEUE_SIZE,
+            )
+    return _inference_executor
@@ -0,0 +1,70 @@
+import os
+import platform
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from weapondetectapp.benchmark import BASELINE_PATH, find_regressions, load_results, run_benchmarks, save_results
+from weapondetectapp.utils import TerroristDetector
+
+
+def resolution(value: str):
+    width, _, height = value.partition('x')
+    return int(width), int(height)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the detection hot paths on synthetic images and videos and compare with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', default='yolov8n.yaml',
+            help='Weights to benchmark, the default builds a randomly initialized model without downloading')
+        parser.add_argument(
+            '--resolutions', nargs='+', type=resolution, default=[(640, 480), (1280, 720), (1920, 1080)],
+            help='Resolutions as WIDTHxHEIGHT')
+        parser.add_argument('--runs', type=int, default=10)
+        parser.add_argument('--folder-images', type=int, default=16)
+        parser.add_argument('--video-frames', type=int, default=50)
+        parser.add_argument('--output', help='Save the results to a JSON file')
+        parser.add_argument(
+            '--baseline', default=BASELINE_PATH,
+            help='JSON file of a previous run to compare with, the committed baseline by default')
+        parser.add_argument('--no-baseline', action='store_true', help='Do not compare with a baseline')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2, help='Allowed relative slowdown before it is a regression')
+
+    def handle(self, *args, **options):
+        detector = TerroristDetector(options['model'], warmup=True)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(
+                detector, workdir, options['resolutions'],
+                runs=options['runs'],
+                folder_images=options['folder_images'],
+                video_frames=options['video_frames'],
+            )
+
+        self.stdout.write(f'{"benchmark":<48} {"resolution":>10} {"p50 ms":>9} {"p95 ms":>9} '
+                          f'{"throughput":>16} {"RSS growth MB":>14}')
+        for result in results:
+            self.stdout.write(
+                f'{result.name:<48} {result.resolution:>10} {result.p50_ms:>9.1f} {result.p95_ms:>9.1f} '
+                f'{result.throughput:>9.1f} {result.unit + "/s":>6} {result.peak_rss_mb:>14.1f}'
+            )
+
+        if options['output']:
+            save_results(
+                results, options['output'],
+                model=options['model'], machine=platform.machine(), processor=platform.processor(),
+                python=platform.python_version(),
+            )
+            self.stdout.write(f'Results saved to {options["output"]}')
+
+        if not options['no_baseline']:
+            if not os.path.isfile(options['baseline']):
+                raise CommandError(f'Baseline {options["baseline"]} does not exist, save one with --output')
+            regressions = find_regressions(results, load_results(options['baseline']), options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
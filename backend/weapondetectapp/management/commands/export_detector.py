@@ -0,0 +1,82 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from weapondetectapp.backends import (
+    BACKENDS, compare_predictions, export_model, mark_verified, unmark_verified,
+)
+from weapondetectapp.utils import TerroristDetector
+
+
+def remove_artifact(path: str) -> None:
+    # An artifact next to the weights is picked up by the backend, so a failed one must go
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class Command(BaseCommand):
+    help = 'Export the detector weights for a CPU inference backend and check it against PyTorch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backend', choices=[backend for backend in BACKENDS if BACKENDS[backend]], default='onnx')
+        parser.add_argument('--weights', default=settings.WEAPONDETECT_MODEL_PATH)
+        parser.add_argument('--imgsz', type=int, default=640)
+        parser.add_argument('--force', action='store_true', help='Export even if the artifact is up to date')
+        parser.add_argument(
+            '--images', default=os.path.join(settings.MEDIA_ROOT, 'images'),
+            help='Folder with the images the exported model is checked on')
+        parser.add_argument('--limit', type=int, default=64, help='Maximum number of images to check')
+        parser.add_argument('--min-iou', type=float, default=0.9)
+        parser.add_argument('--max-conf-diff', type=float, default=0.05)
+        parser.add_argument(
+            '--skip-check', action='store_true',
+            help='Only export, the model is not used by the detector until it is checked')
+
+    def handle(self, *args, **options):
+        weights, backend = options['weights'], options['backend']
+        if not os.path.isfile(weights):
+            raise CommandError(f'Weights file does not exist: {weights}')
+
+        # The detector uses the artifact only once it passed the check below
+        unmark_verified(weights, backend)
+        try:
+            path = export_model(weights, backend, imgsz=options['imgsz'], force=options['force'])
+        except Exception as e:
+            raise CommandError(f'Model cannot be exported for {backend}: {e}')
+        self.stdout.write(f'{backend} model: {path}')
+
+        if options['skip_check']:
+            self.stdout.write(self.style.WARNING(f'Parity is not checked, the {backend} model is not activated'))
+            return
+
+        images = TerroristDetector.list_images(options['images'], recursive=True)[:options['limit']] \
+            if os.path.isdir(options['images']) else []
+        if not images:
+            raise CommandError(f'No images in {options["images"]} to check the {backend} model on, '
+                               f'it is not activated')
+
+        reference = TerroristDetector(weights).predict_batch(images)
+        try:
+            candidate = TerroristDetector(path).predict_batch(images)
+        except Exception as e:
+            remove_artifact(path)
+            raise CommandError(f'{backend} model cannot run a batch of {len(images)} images, '
+                               f'the export is removed: {e}')
+        report = compare_predictions(reference, candidate)
+        self.stdout.write(
+            f'{report.images} images, {report.reference_boxes} boxes: {report.matched_boxes} matched, '
+            f'{report.missing_boxes} missing, {report.extra_boxes} extra, '
+            f'min IoU {report.min_iou:.3f}, max confidence difference {report.max_conf_diff:.3f}'
+        )
+
+        if not report.passed(options['min_iou'], options['max_conf_diff']):
+            remove_artifact(path)
+            raise CommandError(f'{backend} model does not match PyTorch, the export is removed')
+
+        mark_verified(weights, backend)
+        self.stdout.write(self.style.SUCCESS(f'{backend} model matches PyTorch and is activated'))
@@ -0,0 +1,112 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from weapondetectapp.backends import export_model
+from weapondetectapp.cache import file_digest
+from weapondetectapp.quantization import (
+    QUANTIZATION_MODES, QuantizationManifest, class_metrics, load_yolo_labels, manifest_path, quantize_model,
+    quantized_model_path,
+)
+from weapondetectapp.utils import TerroristDetector
+
+
+def image_shape(path: str) -> tuple:
+    # Only the header is read, the file is closed right away
+    with Image.open(path) as image:
+        return image.size[::-1]
+
+
+class Command(BaseCommand):
+    help = 'Build an INT8 detector and activate it only if it keeps the recall of a class on held-out images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=QUANTIZATION_MODES, default='static')
+        parser.add_argument('--weights', default=settings.WEAPONDETECT_MODEL_PATH)
+        parser.add_argument(
+            '--calibration', default=os.path.join(settings.MEDIA_ROOT, 'images'),
+            help='Folder with the images static quantization is calibrated on')
+        parser.add_argument(
+            '--holdout', required=True,
+            help='Folder with the held-out images, YOLO labels in a sibling labels folder are used if present')
+        parser.add_argument('--class-name', default='gun', help='Class the accuracy gate is checked on')
+        parser.add_argument(
+            '--max-recall-drop', type=float, default=settings.WEAPONDETECT_QUANTIZATION_MAX_RECALL_DROP)
+        parser.add_argument('--imgsz', type=int, default=640)
+        parser.add_argument('--limit', type=int, default=256, help='Maximum number of calibration images')
+
+    def handle(self, *args, **options):
+        weights = options['weights']
+        if not os.path.isfile(weights):
+            raise CommandError(f'Weights file does not exist: {weights}')
+        if not os.path.isdir(options['holdout']):
+            raise CommandError(f'Held-out folder does not exist: {options["holdout"]}')
+
+        class_ids = [cls for cls, name in TerroristDetector.CLASS_NAMES.items() if name == options['class_name']]
+        if not class_ids:
+            raise CommandError(f'Unknown class {options["class_name"]}')
+
+        calibration = []
+        if options['mode'] == 'static':
+            calibration = TerroristDetector.list_images(options['calibration'], recursive=True)[:options['limit']] \
+                if os.path.isdir(options['calibration']) else []
+            if not calibration:
+                raise CommandError(f'No calibration images in {options["calibration"]}')
+
+        try:
+            fp32_path = export_model(weights, 'onnx', imgsz=options['imgsz'])
+            path = quantize_model(
+                fp32_path, quantized_model_path(weights), options['mode'], calibration, imgsz=options['imgsz'])
+        except Exception as e:
+            raise CommandError(f'Model cannot be quantized: {e}')
+        self.stdout.write(f'INT8 model: {path} ({len(calibration)} calibration images)')
+
+        # Recall is measured at the confidence threshold the detector runs with
+        conf = TerroristDetector(weights).conf
+        reference = self.evaluate(weights, options['holdout'])
+        quantized = self.evaluate(path, options['holdout'])
+
+        image_paths = [image_predict.path for image_predict in reference]
+        truths = [load_yolo_labels(image_path, image_shape(image_path)) for image_path in image_paths]
+        if any(truth is None for truth in truths):
+            # Without labels the FP32 model at its operating threshold is the ground truth
+            self.stdout.write(self.style.WARNING('Held-out images are not labeled, comparing against FP32'))
+            truths = [image_predict.boxes[image_predict.boxes.conf >= conf] for image_predict in reference]
+
+        manifest = QuantizationManifest(
+            model=os.path.basename(path),
+            mode=options['mode'],
+            source_version=file_digest(weights),
+            class_name=options['class_name'],
+            max_recall_drop=options['max_recall_drop'],
+            reference=class_metrics([image_predict.boxes for image_predict in reference], truths, class_ids, conf),
+            quantized=class_metrics([image_predict.boxes for image_predict in quantized], truths, class_ids, conf),
+        )
+
+        self.stdout.write(
+            f'{options["class_name"]} on {len(image_paths)} images, {manifest.reference.true_boxes} boxes: '
+            f'recall {manifest.reference.recall:.3f} -> {manifest.quantized.recall:.3f}, '
+            f'AP50 {manifest.reference.ap50:.3f} -> {manifest.quantized.ap50:.3f}'
+        )
+
+        manifest.activated = manifest.reference.true_boxes > 0 and manifest.recall_drop <= options['max_recall_drop']
+        manifest.save(manifest_path(weights))
+
+        if not manifest.reference.true_boxes:
+            raise CommandError(f'No {options["class_name"]} boxes in the held-out images, the INT8 model is not activated')
+        if not manifest.activated:
+            raise CommandError(
+                f'{options["class_name"]} recall drops by {manifest.recall_drop:.3f}, more than '
+                f'{options["max_recall_drop"]:.3f}, the INT8 model is not activated')
+
+        self.stdout.write(self.style.SUCCESS(
+            'INT8 model is activated, set WEAPONDETECT_QUANTIZED = True to use it'))
+
+    @staticmethod
+    def evaluate(model_path: str, folder: str):
+        detector = TerroristDetector(model_path)
+        # Low-confidence boxes are kept so the whole precision-recall curve is measured
+        detector.conf = 0.001
+        return list(detector.predict_folder_with_images(folder))
@@ -0,0 +1,90 @@
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from weapondetectapp.alerts import WeaponAlertEmitter, get_alert_stream
+from weapondetectapp.camera import CameraWorker
+from weapondetectapp.metrics import registry
+from weapondetectapp.models import Camera
+from weapondetectapp.registry import get_detector
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Detect weapons on the live feeds of the enabled cameras until interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--camera', type=int, nargs='+', help='Primary keys of the cameras, all enabled by default')
+        parser.add_argument('--max-frames', type=int, help='Stop every camera after processing this many frames')
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help='Serve the metrics of this process, including the per-camera lag and drops, on this port')
+
+    def alert_emitter(self, camera: Camera) -> WeaponAlertEmitter | None:
+        stream = get_alert_stream()
+        if stream is None:
+            return None
+        return WeaponAlertEmitter(
+            stream, camera.user_id, 0, camera_pk=camera.pk,
+            class_names=settings.WEAPONDETECT_ALERTS_CLASSES,
+            conf=settings.WEAPONDETECT_ALERTS_CONF,
+            min_frames=settings.WEAPONDETECT_ALERTS_MIN_FRAMES,
+            cooldown=settings.WEAPONDETECT_ALERTS_COOLDOWN,
+            thumbnail_size=settings.WEAPONDETECT_ALERTS_THUMBNAIL_SIZE,
+        )
+
+    def handle(self, *args, **options):
+        cameras = Camera.objects.filter(enabled=True)
+        if options['camera']:
+            cameras = cameras.filter(pk__in=options['camera'])
+        cameras = list(cameras)
+        if not cameras:
+            raise CommandError('No enabled cameras to process')
+
+        if options['metrics_port']:
+            server = ThreadingHTTPServer(('', options['metrics_port']), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+            self.stdout.write(f'Metrics are served on port {options["metrics_port"]}')
+
+        # All cameras share one model, the detector is safe to call from several threads
+        detector = get_detector()
+        stop = threading.Event()
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+        workers = [
+            CameraWorker(camera, detector, emitter=self.alert_emitter(camera))
+            for camera in cameras
+        ]
+        threads = [
+            threading.Thread(
+                target=worker.run, args=(stop, options['max_frames']), name=f'camera-worker-{worker.label}')
+            for worker in workers
+        ]
+        for camera, thread in zip(cameras, threads):
+            self.stdout.write(f'Processing camera {camera.pk} ({camera.name}): {camera.url}')
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for worker in workers:
+            reader = worker.reader
+            self.stdout.write(
+                f'Camera {worker.label}: {worker.frames_processed} frames processed, '
+                f'{reader.frames_dropped} of {reader.frames_read} dropped'
+            )
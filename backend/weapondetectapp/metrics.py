@@ -0,0 +1,216 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+
+class Metric:
+    """
+    Process-local metric with optional labels.
+
+    Values are kept per combination of label values, in the order of labelnames.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        """
+        Args:
+            name: Metric name.
+            documentation: Help text of the metric.
+            labelnames: Names of the labels the values are split by.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: counts of every bucket (last one is +Inf), sum, count
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        item = self._values.get(self._key(labels))
+        return item[2] if item else 0
+
+    def sum(self, **labels: str) -> float:
+        item = self._values.get(self._key(labels))
+        return item[1] if item else 0.0
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                    cumulative += bucket_count
+                    samples.append((f'{self.name}_bucket', (*key, bound), cumulative))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    All metrics of the process, registered by name.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class: type, name: str, documentation: str, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, documentation, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f'Metric {name} is already registered as a {metric.type}')
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames=labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames=labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def collect(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def exposition(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Returns:
+            Metrics text, one sample per line.
+        """
+        lines = []
+        for metric in sorted(self.collect(), key=lambda metric: metric.name):
+            lines.append(f'# HELP {metric.name} {_escape(metric.documentation, quote=False)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, key, value in metric.samples():
+                labelnames = (*metric.labelnames, 'le') if name.endswith('_bucket') else metric.labelnames
+                labels = ','.join(
+                    f'{label}="{_escape(_format_value(label_value))}"'
+                    for label, label_value in zip(labelnames, key)
+                )
+                lines.append(f'{name}{{{labels}}} {_format_value(value)}' if labels else
+                             f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+
+def _format_value(value) -> str:
+    if isinstance(value, str):
+        return value
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    'weapondetect_stage_seconds', 'Time spent in a stage of the detection hot path', labelnames=('stage',))
+
+_local = threading.local()
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """
+    Record the time of a stage, also into the stage totals of the current thread if they are being recorded.
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    totals = getattr(_local, 'totals', None)
+    if totals is not None:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time the enclosed block as a stage of the hot path, e.g. decode, inference or encode.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+@contextmanager
+def record_stages() -> Iterator[Dict[str, float]]:
+    """
+    Sum the stage times of the enclosed block in the current thread, e.g. for one Celery task.
+
+    Yields:
+        Dict of stage name and seconds, filled while the block runs.
+    """
+    previous = getattr(_local, 'totals', None)
+    _local.totals = totals = {}
+    try:
+        yield totals
+    finally:
+        _local.totals = previous
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weapondetectapp', '0001_initial'),
+    ]
+
+    operations = [
+        # Predictions made before the async pipeline were processed inline
+        migrations.AddField(
+            model_name='imagepredict',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='done', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='imagepredict',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.6 on 2026-10-17 02:02
+
+from django.db import migrations, models
+import weapondetectapp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weapondetectapp', '0002_imagepredict_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to=weapondetectapp.models.images_thumbnail_directory_path),
+        ),
+        migrations.AddField(
+            model_name='imagepredict',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to=weapondetectapp.models.images_predict_thumbnail_directory_path),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', '-id'], name='weapondetec_user_id_d1bd06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['user', '-id'], name='weapondetec_user_id_5447ec_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.6 on 2026-10-17 02:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('weapondetectapp', '0003_thumbnails_and_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Camera',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.CharField(help_text='RTSP/HTTP stream URL or path to a local file replayed as a stream', max_length=1024)),
+                ('enabled', models.BooleanField(default=True)),
+                ('segment_seconds', models.PositiveIntegerField(default=60, help_text='Length of one recording segment in seconds')),
+                ('retention_segments', models.PositiveIntegerField(default=60, help_text='Number of recent segments kept, older ones are deleted')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cameras', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Camera',
+                'verbose_name_plural': 'Cameras',
+            },
+        ),
+    ]
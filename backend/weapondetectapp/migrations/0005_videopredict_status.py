@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weapondetectapp', '0004_camera'),
+    ]
+
+    operations = [
+        # Videos processed before the status was tracked are finished
+        migrations.AddField(
+            model_name='videopredict',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='done', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='videopredict',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+    ]
@@ -1,20 +1,131 @@
+import asyncio
+import os
+
+import numpy as np
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.fields.files import FieldFile
 from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
 
+from weapondetectapp.metrics import span
+from weapondetectapp.video import DetectionTrack
+
+
+def reserve_file(field_file: FieldFile, filename: str) -> None:
+    """
+    Assign an available storage name to a file field without copying any content into it.
+
+    An empty placeholder is created so concurrent reservations cannot get the
+    same name; the processing task writes the real content straight to it.
+
+    Args:
+        field_file: File of the model field.
+        filename: Name of the uploaded file.
+    """
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, filename)
+
+    while True:
+        name = storage.get_available_name(name, max_length=field_file.field.max_length)
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, 'xb'):
+                break
+        except FileExistsError:
+            continue
+
+    field_file.name = name
+
+
+def is_video_header(header: bytes) -> bool:
+    """
+    Check the first bytes of a file against the signatures of common video containers.
+    """
+    return (
+        header[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'wide')  # MP4, MOV, 3GP
+        or header[:4] == b'\x1a\x45\xdf\xa3'  # Matroska, WebM
+        or (header[:4] == b'RIFF' and header[8:12] == b'AVI ')
+        or header[:3] == b'FLV'
+        or header[:4] == b'\x00\x00\x01\xba'  # MPEG program stream
+        or header[:1] == header[188:189] == b'\x47'  # MPEG transport stream, 188-byte packets
+    )
+
+
+def validate_uploaded_file(field_file: FieldFile, uploaded_file) -> None:
+    """
+    Check an uploaded file holds the kind of media its field stores.
+
+    Args:
+        field_file: File of the model field.
+        uploaded_file: Uploaded file.
+
+    Raises:
+        ValidationError: If an image field gets a file Pillow cannot open
+            or a file field gets a file that is not a video container.
+    """
+    if isinstance(field_file.field, models.ImageField):
+        # Pillow reads the file and rewinds it
+        forms.ImageField().clean(uploaded_file)
+        return
+
+    header = uploaded_file.read(189)
+    uploaded_file.seek(0)
+    if not is_video_header(header):
+        raise ValidationError(f'{uploaded_file.name} is not a video', code='invalid_video')
+
+
+async def write_uploaded_file(field_file: FieldFile, uploaded_file, chunk_size: int = 1024 * 1024) -> None:
+    """
+    Save an uploaded file into a file field chunk by chunk without blocking the event loop.
+
+    Args:
+        field_file: File of the model field.
+        uploaded_file: Uploaded file.
+        chunk_size: Number of bytes written at a time.
+
+    Raises:
+        ValidationError: If the file is not the kind of media the field stores,
+            nothing is written then.
+    """
+    await asyncio.to_thread(validate_uploaded_file, field_file, uploaded_file)
+
+    with span('storage_write'):
+        await asyncio.to_thread(reserve_file, field_file, uploaded_file.name)
+
+        chunks = uploaded_file.chunks(chunk_size)
+        f = await asyncio.to_thread(open, field_file.path, 'wb')
+        try:
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+
 
 def images_directory_path(instance: 'Image', filename: str) -> str:
     return 'images/{0}/{1}'.format(instance.user.username, filename)
 
 
+def images_thumbnail_directory_path(instance: 'Image', filename: str) -> str:
+    return 'thumbnails/images/{0}/{1}'.format(instance.user.username, filename)
+
+
 class Image(models.Model):
     class Meta:
         verbose_name = _('Image')
         verbose_name_plural = _('Images')
+        indexes = [
+            models.Index(fields=['user', '-id']),
+        ]
 
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to=images_directory_path)
+    thumbnail = models.ImageField(
+        upload_to=images_thumbnail_directory_path, blank=True)
     name = models.CharField(max_length=255, null=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
@@ -29,15 +140,29 @@ def images_predict_directory_path(instance: 'ImagePredict', filename: str) -> st
     return 'images_predict/{0}/{1}'.format(instance.image_original.user.username, filename)
 
 
+def images_predict_thumbnail_directory_path(instance: 'ImagePredict', filename: str) -> str:
+    return 'thumbnails/images_predict/{0}/{1}'.format(instance.image_original.user.username, filename)
+
+
 class ImagePredict(models.Model):
     class Meta:
         verbose_name = _('Image Predict')
         verbose_name_plural = _('Images Predict')
 
+    class Status(models.TextChoices):
+        QUEUED = 'queued', _('Queued')
+        RUNNING = 'running', _('Running')
+        DONE = 'done', _('Done')
+        FAILED = 'failed', _('Failed')
+
     image_original = models.ForeignKey(
         Image, on_delete=models.CASCADE, related_name='image_original')
     image_predict = models.ImageField(upload_to=images_predict_directory_path)
+    thumbnail = models.ImageField(
+        upload_to=images_predict_thumbnail_directory_path, blank=True)
     boxes = models.JSONField(default=list)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.QUEUED)
 
 
 def videos_directory_path(instance: 'Video', filename: str) -> str:
@@ -48,6 +173,9 @@ class Video(models.Model):
     class Meta:
         verbose_name = _('Video')
         verbose_name_plural = _('Videos')
+        indexes = [
+            models.Index(fields=['user', '-id']),
+        ]
 
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='videos')
@@ -68,10 +196,75 @@ class VideoPredict(models.Model):
         verbose_name = _('Video Predict')
         verbose_name_plural = _('Videos Predict')
 
+    Status = ImagePredict.Status
+
     video_original = models.ForeignKey(
         Video, on_delete=models.CASCADE, related_name='video_original')
     video_predict = models.FileField(upload_to=videos_predict_directory_path)
     boxes = models.JSONField(default=list)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.QUEUED)
 
     def __str__(self):
         return self.video_predict.name
+
+    def set_track(self, track: DetectionTrack, track_path: str) -> None:
+        """
+        Store the per-frame detections of the video.
+
+        Small tracks are kept inline in boxes, larger ones are saved to a
+        columnar sidecar file and boxes only points to it.
+
+        Args:
+            track: Detection track of the video.
+            track_path: Absolute path to save the sidecar file.
+        """
+        cls_ids, counts = np.unique(track.cls, return_counts=True)
+        self.boxes = {
+            'count': len(track),
+            'classes': {str(cls): int(count) for cls, count in zip(cls_ids, counts)},
+        }
+
+        if len(track) <= settings.WEAPONDETECT_VIDEO_INLINE_DETECTIONS:
+            self.boxes['detections'] = track.to_rows()
+        else:
+            track.save(track_path)
+            self.boxes['track'] = os.path.relpath(track_path, settings.MEDIA_ROOT)
+
+    def load_track(self) -> DetectionTrack:
+        """
+        Get the per-frame detections of the video.
+
+        Returns:
+            Detection track, empty if the video was not processed yet.
+        """
+        if not self.boxes:
+            return DetectionTrack.from_rows([])
+        if 'track' in self.boxes:
+            return DetectionTrack.load(os.path.join(settings.MEDIA_ROOT, self.boxes['track']))
+        return DetectionTrack.from_json_rows(self.boxes['detections'])
+
+
+class Camera(models.Model):
+    class Meta:
+        verbose_name = _('Camera')
+        verbose_name_plural = _('Cameras')
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='cameras')
+    name = models.CharField(max_length=255)
+    url = models.CharField(
+        max_length=1024, help_text=_('RTSP/HTTP stream URL or path to a local file replayed as a stream'))
+    enabled = models.BooleanField(default=True)
+    segment_seconds = models.PositiveIntegerField(
+        default=60, help_text=_('Length of one recording segment in seconds'))
+    retention_segments = models.PositiveIntegerField(
+        default=60, help_text=_('Number of recent segments kept, older ones are deleted'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def recording_dir(self) -> str:
+        return os.path.join(settings.MEDIA_ROOT, 'cameras', str(self.pk))
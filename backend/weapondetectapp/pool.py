@@ -0,0 +1,509 @@
+import atexit
+import itertools
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing import connection, shared_memory
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import Dict, List, Sequence, Set, Tuple
+
+import numpy as np
+
+from weapondetectapp.boxes import Boxes
+
+
+# Detector attributes a batch may set for itself, all of them change the result
+TASK_OPTIONS = ('conf', 'augment', 'cascade')
+
+
+class SharedFrameRing:
+    """
+    Fixed number of equally sized frame slots in one shared memory block.
+
+    The owner hands out free slots, writes frames into them and sends only
+    the slot index, shape and dtype to the other process, which maps the
+    same memory instead of unpickling a copy of the frame.
+    """
+
+    def __init__(self, slots: int, slot_bytes: int, name: str | None = None) -> None:
+        """
+        Args:
+            slots: Number of frame slots.
+            slot_bytes: Size of one slot in bytes.
+            name: Name of an existing block to attach to, None creates a new one.
+        """
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=slots * slot_bytes)
+
+        self._free: List[int] = list(range(slots)) if self.owner else []
+        self._condition = threading.Condition()
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def acquire(self, count: int, timeout: float | None = None) -> List[int]:
+        """
+        Take several free slots at once, waiting until enough are released.
+
+        The slots of a batch are taken all together or not at all, so two
+        batches each holding part of the ring cannot wait for each other.
+
+        Args:
+            count: Number of slots.
+            timeout: Maximum time in seconds to wait, None waits forever.
+
+        Returns:
+            Slot indices.
+
+        Raises:
+            TimeoutError: If the slots are not released in time.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._free) >= count, timeout):
+                raise TimeoutError(f'{count} frame slots are not released in {timeout} s')
+            slots, self._free = self._free[:count], self._free[count:]
+            return slots
+
+    def release(self, slots: Sequence[int]) -> None:
+        with self._condition:
+            self._free.extend(slots)
+            self._condition.notify_all()
+
+    def view(self, slot: int, shape: Tuple[int, ...], dtype: str = 'uint8') -> np.ndarray:
+        """
+        Get a slot as an array without copying it.
+        """
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def write(self, slot: int, frame: np.ndarray) -> Tuple[int, Tuple[int, ...], str]:
+        """
+        Copy a frame into a slot.
+
+        Returns:
+            (slot, shape, dtype) describing the frame to the other process.
+        """
+        self.view(slot, frame.shape, frame.dtype.str)[...] = frame
+        return slot, frame.shape, frame.dtype.str
+
+    def close(self) -> None:
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker_main(model_path: str, cores: List[int] | None, threads: int, ring_name: str,
+                 slots: int, slot_bytes: int, conf: float, options: Dict, conn: Connection) -> None:
+    """
+    Entry point of an inference process: load the model once and serve batches until told to stop.
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    from weapondetectapp.utils import TerroristDetector
+
+    torch.set_num_threads(threads)
+
+    detector = TerroristDetector(model_path, warmup=True)
+    detector.conf = conf
+    for name, value in options.items():
+        setattr(detector, name, value)
+    defaults = {name: getattr(detector, name) for name in TASK_OPTIONS}
+    ring = SharedFrameRing(slots, slot_bytes, name=ring_name)
+
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+
+            task_id, sources, task_options = task
+            task_options = {**defaults, **task_options}
+            # A batch may skip the cascade, but not run it without a gate model set up for the pool
+            task_options['cascade'] = defaults['cascade'] and task_options['cascade']
+            for name, value in task_options.items():
+                setattr(detector, name, value)
+            try:
+                # Frames are read straight from shared memory, paths and oversized frames come as they are
+                frames = [
+                    ring.view(*source) if isinstance(source, tuple) else source
+                    for source in sources
+                ]
+                image_predicts = detector.predict_batch(frames, len(frames))
+                conn.send((task_id, [
+                    (image_predict.boxes.cls, image_predict.boxes.conf, image_predict.boxes.xyxy)
+                    for image_predict in image_predicts
+                ], image_predicts[0].cls_names if image_predicts else {}, None))
+            except Exception as e:
+                conn.send((task_id, None, None, repr(e)))
+    finally:
+        ring.close()
+
+
+@dataclass
+class _Worker:
+    """
+    process: Inference process
+    conn: Parent end of the pipe to the process
+    send_lock: Lock serializing the tasks sent from several threads
+    tasks: Ids of the batches sent to the process and not answered yet
+    """
+    process: BaseProcess
+    conn: Connection
+    send_lock: threading.Lock = field(default_factory=threading.Lock)
+    tasks: Set[int] = field(default_factory=set)
+
+
+class InferencePool:
+    """
+    Local pool of inference processes, each with its own model.
+
+    Every process is pinned to its own subset of the available cores and
+    runs torch with that many intra-op threads, so N processes use the box
+    without fighting over cores. Frames travel through a shared memory ring
+    and only small task descriptors and box arrays are pickled. A batch goes
+    to the process with the fewest batches in flight.
+
+    Every process has its own pipe, so a process that dies takes down only
+    the batches sent to it; it is replaced, and after max_restarts
+    replacements the pool gives up and closes.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        workers: int = 2,
+        threads: int | None = None,
+        slots: int = 64,
+        slot_bytes: int = 1920 * 1080 * 3,
+        conf: float = 0.25,
+        options: Dict | None = None,
+        acquire_timeout: float | None = 60.0,
+        max_restarts: int = 5,
+    ) -> None:
+        """
+        Args:
+            model_path: Path to the weights file.
+            workers: Number of inference processes.
+            threads: Intra-op threads of each process, None uses the number of its cores.
+            slots: Number of frames that can be in flight at once.
+            slot_bytes: Largest frame passed through shared memory, bigger frames are pickled.
+            conf: Confidence threshold of the batches that do not pass their own.
+            options: Detector attributes set in every process, e.g. the cascade settings.
+            acquire_timeout: Maximum time in seconds a batch waits for free frame slots, None waits forever.
+            max_restarts: Number of dead processes replaced before the pool closes.
+        """
+        self.workers = workers
+        self.ring = SharedFrameRing(slots, slot_bytes)
+        self.acquire_timeout = acquire_timeout
+        self.max_restarts = max_restarts
+        self.restarts = 0
+
+        self._context = mp.get_context('spawn')
+        self._pending: Dict[int, Tuple[Future, List[int], List[str]]] = {}
+        self._pending_lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._closed = False
+        self._shut_down = False
+
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        core_groups = [cores[i::workers] for i in range(workers)] if len(cores) >= workers else [None] * workers
+
+        self._worker_args = [
+            (
+                model_path, core_group,
+                threads or (len(core_group) if core_group else max(1, (os.cpu_count() or 1) // workers)),
+                self.ring.name, slots, slot_bytes, conf, options or {},
+            )
+            for core_group in core_groups
+        ]
+        self._workers = [self._start_worker(args) for args in self._worker_args]
+
+        self._collector = threading.Thread(target=self._collect, name='inference-pool', daemon=True)
+        self._collector.start()
+        atexit.register(self.close)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _start_worker(self, args: Tuple) -> _Worker:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(*args, child_conn), daemon=True)
+        process.start()
+        # Only the process holds the other end now, so its death shows as EOF on ours
+        child_conn.close()
+        return _Worker(process=process, conn=conn)
+
+    def submit(self, sources: Sequence[str | np.ndarray], names: Sequence[str] | None = None,
+               options: Dict | None = None) -> Future:
+        """
+        Send one batch to the pool.
+
+        Args:
+            sources: Paths to the images or BGR image arrays.
+            names: Paths reported in the image predict objects, defaults to image<i>.jpg for arrays.
+            options: Detector attributes of the batch, see TASK_OPTIONS, e.g. the conf and augment
+                of the calling detector. Missing ones keep the values the processes were started with;
+                cascade=False lets every image skip the person gate.
+
+        Returns:
+            Future resolved with the image predict objects of the batch.
+
+        Raises:
+            TimeoutError: If the frame slots of the batch are not released in acquire_timeout.
+        """
+        if self._closed:
+            raise RuntimeError('Inference pool is closed')
+        options = options or {}
+        if set(options) - set(TASK_OPTIONS):
+            raise ValueError(f'Unknown batch options {", ".join(set(options) - set(TASK_OPTIONS))}')
+        if len(sources) > self.ring.slots:
+            raise ValueError(f'Batch of {len(sources)} frames does not fit into {self.ring.slots} slots')
+
+        names = list(names) if names is not None else [
+            source if isinstance(source, str) else f'image{i}.jpg' for i, source in enumerate(sources)]
+
+        shared = [isinstance(source, np.ndarray) and source.nbytes <= self.ring.slot_bytes for source in sources]
+        slots = self.ring.acquire(sum(shared), self.acquire_timeout)
+        free_slots = iter(slots)
+        descriptors = []
+        for source, is_shared in zip(sources, shared):
+            if is_shared:
+                descriptors.append(self.ring.write(next(free_slots), source))
+            else:
+                descriptors.append(source if isinstance(source, np.ndarray) else str(source))
+
+        future: Future = Future()
+        task_id = next(self._task_ids)
+        with self._pending_lock:
+            worker = min(self._workers, key=lambda worker: len(worker.tasks))
+            self._pending[task_id] = (future, slots, names)
+            worker.tasks.add(task_id)
+        try:
+            with worker.send_lock:
+                worker.conn.send((task_id, descriptors, options))
+        except (OSError, ValueError):
+            # The process is dead, the collector fails its batches and replaces it
+            pass
+        return future
+
+    def predict_batch(self, sources: Sequence[str | np.ndarray], batch_size: int = 8,
+                      names: Sequence[str] | None = None, options: Dict | None = None) -> List['ImagePredict']:
+        """
+        Predict many images, spreading their batches over the processes.
+
+        Args:
+            sources: Paths to the images or BGR image arrays.
+            batch_size: Number of images in one forward pass.
+            names: Paths reported in the image predict objects.
+            options: Detector attributes of the batches, see submit().
+
+        Returns:
+            Image predict objects in the same order as the input.
+        """
+        futures = [
+            self.submit(
+                sources[start:start + batch_size],
+                names[start:start + batch_size] if names is not None else None,
+                options,
+            )
+            for start in range(0, len(sources), batch_size)
+        ]
+        return [image_predict for future in futures for image_predict in future.result()]
+
+    def _collect(self) -> None:
+        from weapondetectapp.utils import ImagePredict
+
+        while not self._closed:
+            workers = {worker.conn: worker for worker in self._workers}
+            ready = connection.wait(list(workers), timeout=1)
+            dead = [worker for worker in self._workers if worker.conn not in ready and not worker.process.is_alive()]
+
+            for conn in ready:
+                try:
+                    task_id, boxes, cls_names, error = conn.recv()
+                except (EOFError, OSError):
+                    dead.append(workers[conn])
+                    continue
+
+                with self._pending_lock:
+                    workers[conn].tasks.discard(task_id)
+                    item = self._pending.pop(task_id, None)
+                if item is None:
+                    # The batch already failed when the pool closed
+                    continue
+                future, slots, names = item
+                self.ring.release(slots)
+
+                if error is not None:
+                    future.set_exception(RuntimeError(f'Batch cannot be predicted: {error}'))
+                    continue
+
+                future.set_result([
+                    ImagePredict(
+                        source_predict=None,
+                        path=name,
+                        name_file=os.path.basename(name),
+                        cls_names=cls_names,
+                        boxes=Boxes(cls=cls, conf=conf, xyxy=xyxy),
+                    )
+                    for name, (cls, conf, xyxy) in zip(names, boxes)
+                ])
+
+            if dead and not self._closed:
+                self._replace(dead)
+
+    def _replace(self, dead: List[_Worker]) -> None:
+        """
+        Fail the batches of dead processes and start new processes in their place.
+        """
+        error = RuntimeError(f'{len(dead)} inference processes died')
+        if self.restarts + len(dead) > self.max_restarts:
+            print(f'Inference pool is closed after {self.restarts} restarts: {error}')
+            self._closed = True
+            self._fail_pending(error)
+            return
+
+        # Swapped under the lock, so no batch is sent to a dead process after its batches are collected
+        with self._pending_lock:
+            task_ids = set()
+            for worker in dead:
+                worker.conn.close()
+                task_ids |= worker.tasks
+                index = self._workers.index(worker)
+                self._workers[index] = self._start_worker(self._worker_args[index])
+        self._fail_pending(error, task_ids)
+        self.restarts += len(dead)
+        print(f'Inference pool replaced {len(dead)} dead processes')
+
+    def _fail_pending(self, error: Exception, task_ids: Set[int] | None = None) -> None:
+        with self._pending_lock:
+            task_ids = set(self._pending) if task_ids is None else task_ids
+            pending = [self._pending.pop(task_id) for task_id in task_ids if task_id in self._pending]
+            for worker in self._workers:
+                worker.tasks -= task_ids
+        for future, slots, _ in pending:
+            self.ring.release(slots)
+            future.set_exception(error)
+
+    def close(self) -> None:
+        """
+        Stop the processes and free the shared memory.
+        """
+        if self._shut_down:
+            return
+        self._shut_down = True
+        self._closed = True
+        self._collector.join()
+
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+
+        self._fail_pending(RuntimeError('Inference pool is closed'))
+        self.ring.close()
+
+
+_inference_pool: InferencePool | None = None
+_inference_pool_lock = threading.Lock()
+_inference_pool_disabled = False
+_owner_lock_file = None
+
+
+def disable_inference_pool() -> None:
+    """
+    Never start an inference pool in this process, e.g. in a Celery prefork child.
+    """
+    global _inference_pool_disabled
+    _inference_pool_disabled = True
+
+
+def _acquire_owner_lock(path: str) -> bool:
+    """
+    Take the host-wide lock of the pool owner, it is held until the process exits.
+
+    Returns:
+        False if another process on the host owns a pool.
+    """
+    global _owner_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        return True
+
+    if _owner_lock_file is not None:
+        return True
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _owner_lock_file = lock_file
+    return True
+
+
+def get_inference_pool() -> InferencePool | None:
+    """
+    Get the process-wide inference pool configured from Django settings.
+
+    The pool sizes its processes for the whole host, so only one process on
+    the host may own one: the first to take WEAPONDETECT_POOL_LOCK_PATH.
+    Other web processes and Celery prefork children run the model themselves.
+    A pool closed after its processes kept dying is replaced by a fresh one.
+
+    Returns:
+        Inference pool or None if WEAPONDETECT_POOL_WORKERS is 0 or another process owns the pool.
+    """
+    global _inference_pool
+    from django.conf import settings
+    from weapondetectapp.registry import get_model_path
+
+    if not settings.WEAPONDETECT_POOL_WORKERS:
+        return None
+    if _inference_pool_disabled:
+        return None
+
+    with _inference_pool_lock:
+        if _inference_pool is not None and _inference_pool.closed:
+            _inference_pool.close()
+            _inference_pool = None
+
+        if _inference_pool is None:
+            lock_path = settings.WEAPONDETECT_POOL_LOCK_PATH or os.path.join(
+                tempfile.gettempdir(), 'weapondetect-pool.lock')
+            if not _acquire_owner_lock(lock_path):
+                print(f'Inference pool is owned by another process ({lock_path}), the model runs in this one')
+                return None
+            _inference_pool = InferencePool(
+                get_model_path(),
+                workers=settings.WEAPONDETECT_POOL_WORKERS,
+                threads=settings.WEAPONDETECT_POOL_THREADS,
+                slots=settings.WEAPONDETECT_POOL_SLOTS,
+                slot_bytes=settings.WEAPONDETECT_POOL_SLOT_BYTES,
+                acquire_timeout=settings.WEAPONDETECT_POOL_ACQUIRE_TIMEOUT,
+                options=dict(
+                    cascade=settings.WEAPONDETECT_CASCADE_ENABLED,
+                    cascade_imgsz=settings.WEAPONDETECT_CASCADE_IMGSZ,
+                    cascade_model_path=settings.WEAPONDETECT_CASCADE_MODEL_PATH,
+                ),
+            )
+    return _inference_pool
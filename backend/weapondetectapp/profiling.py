@@ -0,0 +1,82 @@
+import os
+import random
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+class SlowRequestProfilerMiddleware:
+    """
+    Profile a sample of requests with pyinstrument and save the profile of the slow ones.
+
+    Enabled by WEAPONDETECT_PROFILE_SLOW_REQUEST_MS, needs pyinstrument installed.
+    The saved HTML page shows the call tree and timeline of the request. Streaming
+    responses are timed until the response object is returned, not until the
+    last chunk is sent.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        if settings.WEAPONDETECT_PROFILE_SLOW_REQUEST_MS is None:
+            raise MiddlewareNotUsed
+        try:
+            import pyinstrument
+        except ImportError:
+            print('Slow requests are not profiled: pyinstrument is not installed')
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+        self.threshold = settings.WEAPONDETECT_PROFILE_SLOW_REQUEST_MS / 1000
+        self.sample_rate = settings.WEAPONDETECT_PROFILE_SAMPLE_RATE
+        self.output_dir = str(settings.WEAPONDETECT_PROFILE_DIR)
+
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profiler = self._profiler(async_mode='disabled')
+        profiler.start()
+        try:
+            return self.get_response(request)
+        finally:
+            self._finish(profiler, request)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        profiler = self._profiler(async_mode='enabled')
+        profiler.start()
+        try:
+            return await self.get_response(request)
+        finally:
+            self._finish(profiler, request)
+
+    @staticmethod
+    def _profiler(async_mode: str):
+        from pyinstrument import Profiler
+
+        return Profiler(interval=0.001, async_mode=async_mode)
+
+    def _finish(self, profiler, request) -> None:
+        session = profiler.stop()
+        if session.duration < self.threshold:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+        path = os.path.join(
+            self.output_dir, f'{time.strftime("%Y%m%d-%H%M%S")}_{request.method}_{slug}_{session.duration * 1000:.0f}ms.html')
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+        print(f'Slow request {request.method} {request.path} took {session.duration * 1000:.0f} ms, profile: {path}')
@@ -0,0 +1,248 @@
+import json
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+import redis
+
+from weapondetectapp.video import FramePredict, TrackRecorder
+
+
+@dataclass
+class VideoProgress:
+    """
+    state: queued, running, done or failed
+    total_frames: Estimated number of frames of the video
+    frames_done: Number of processed frames, summed over all segments
+    started: Unix time processing started
+    updated: Unix time of the last update
+    """
+    state: str = 'queued'
+    total_frames: int = 0
+    frames_done: int = 0
+    started: float = 0.0
+    updated: float = 0.0
+
+    @property
+    def percent(self) -> float:
+        if self.state == 'done':
+            return 100.0
+        return min(100.0, 100.0 * self.frames_done / self.total_frames) if self.total_frames else 0.0
+
+    @property
+    def fps(self) -> float:
+        seconds = self.updated - self.started
+        return self.frames_done / seconds if seconds > 0 else 0.0
+
+    @property
+    def eta_seconds(self) -> float | None:
+        if self.state != 'running' or not self.fps:
+            return None
+        return max(0.0, self.total_frames - self.frames_done) / self.fps
+
+    def to_json(self) -> Dict:
+        return {
+            **asdict(self),
+            'percent': round(self.percent, 1),
+            'fps': round(self.fps, 1),
+            'eta_seconds': round(self.eta_seconds) if self.eta_seconds is not None else None,
+        }
+
+
+class ProgressStore:
+    """
+    Progress and detections found so far of the videos being processed, kept in Redis.
+
+    Segments of one video run in different workers, so their frame counts
+    are summed with HINCRBY into one hash. Detections are appended to a list
+    that clients read incrementally from the last index they have seen.
+    A retried segment reports its frames again, so every frame is claimed
+    with HSETNX and only the first report of a frame adds its detections.
+    """
+    PREFIX = 'weapondetect:progress:'
+
+    def __init__(self, redis_url: str, ttl: int = 24 * 60 * 60, max_detections: int = 10000) -> None:
+        """
+        Args:
+            redis_url: Redis URL.
+            ttl: Lifetime of the progress of a video in seconds after its last update.
+            max_detections: Maximum number of detections kept per video, the earliest are kept.
+        """
+        self.ttl = ttl
+        self.max_detections = max_detections
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def _keys(self, video_predict_pk: int):
+        key = f'{self.PREFIX}{video_predict_pk}'
+        return key, f'{key}:detections', f'{key}:frames'
+
+    def start(self, video_predict_pk: int, total_frames: int) -> None:
+        key, detections_key, frames_key = self._keys(video_predict_pk)
+        now = time.time()
+        try:
+            with self._redis.pipeline() as pipe:
+                pipe.delete(key, detections_key, frames_key)
+                pipe.hset(key, mapping={
+                    'state': 'running', 'total_frames': total_frames, 'frames_done': 0,
+                    'started': now, 'updated': now,
+                })
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            print(f'Progress store is unavailable: {e}')
+
+    def advance(self, video_predict_pk: int, frames: int, rows: List[list]) -> None:
+        """
+        Add processed frames and the detections found on them.
+
+        Args:
+            video_predict_pk: Primary key of the VideoPredict object.
+            frames: Number of frames processed since the last call.
+            rows: Detections as [frame, cls, conf, x1, y1, x2, y2, inferred] rows.
+        """
+        key, detections_key, frames_key = self._keys(video_predict_pk)
+        try:
+            if rows:
+                row_frames = sorted({row[0] for row in rows})
+                with self._redis.pipeline() as pipe:
+                    for frame in row_frames:
+                        pipe.hsetnx(frames_key, frame, 1)
+                    pipe.expire(frames_key, self.ttl)
+                    claimed = pipe.execute()[:-1]
+                new_frames = {frame for frame, is_new in zip(row_frames, claimed) if is_new}
+                rows = [row for row in rows if row[0] in new_frames]
+
+            with self._redis.pipeline() as pipe:
+                pipe.hincrby(key, 'frames_done', frames)
+                pipe.hset(key, 'updated', time.time())
+                pipe.expire(key, self.ttl)
+                if rows:
+                    pipe.rpush(detections_key, *(json.dumps(row) for row in rows))
+                    pipe.ltrim(detections_key, 0, self.max_detections - 1)
+                    pipe.expire(detections_key, self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            print(f'Progress store is unavailable: {e}')
+
+    def finish(self, video_predict_pk: int, state: str = 'done') -> None:
+        key, _, _ = self._keys(video_predict_pk)
+        try:
+            with self._redis.pipeline() as pipe:
+                pipe.hset(key, mapping={'state': state, 'updated': time.time()})
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            print(f'Progress store is unavailable: {e}')
+
+    def get(self, video_predict_pk: int) -> VideoProgress | None:
+        key, _, _ = self._keys(video_predict_pk)
+        try:
+            data = self._redis.hgetall(key)
+        except redis.RedisError as e:
+            print(f'Progress store is unavailable: {e}')
+            return None
+        if not data:
+            return None
+        # Videos restored from the result cache are finished without being started
+        return VideoProgress(
+            state=data[b'state'].decode(),
+            total_frames=int(data.get(b'total_frames', 0)),
+            frames_done=int(data.get(b'frames_done', 0)),
+            started=float(data.get(b'started', 0)),
+            updated=float(data.get(b'updated', 0)),
+        )
+
+    def detections(self, video_predict_pk: int, start: int = 0) -> List[list]:
+        """
+        Get the detections found so far.
+
+        Args:
+            video_predict_pk: Primary key of the VideoPredict object.
+            start: Index of the first detection to return, to skip the ones already seen.
+
+        Returns:
+            Detections as [frame, cls, conf, x1, y1, x2, y2, inferred] rows.
+        """
+        _, detections_key, _ = self._keys(video_predict_pk)
+        try:
+            return [json.loads(row) for row in self._redis.lrange(detections_key, start, -1)]
+        except redis.RedisError as e:
+            print(f'Progress store is unavailable: {e}')
+            return []
+
+
+class ProgressReporter:
+    """
+    Frame callback publishing the progress of a video at most once per interval.
+
+    Only detections of frames that went through the model are published,
+    the tracker-carried boxes in between add nothing new.
+    """
+
+    def __init__(self, store: ProgressStore, video_predict_pk: int, interval: float = 1.0) -> None:
+        """
+        Args:
+            store: Progress store.
+            video_predict_pk: Primary key of the VideoPredict object.
+            interval: Minimum time in seconds between two updates.
+        """
+        self.store = store
+        self.video_predict_pk = video_predict_pk
+        self.interval = interval
+
+        self._frames = 0
+        self._recorder = TrackRecorder()
+        self._last_flush = time.monotonic()
+        self.reported_frames = 0
+
+    def __call__(self, frame_predict: FramePredict) -> None:
+        self._frames += 1
+        if frame_predict.inferred:
+            self._recorder(frame_predict)
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._frames or self._recorder.tracks:
+            self.store.advance(self.video_predict_pk, self._frames, self._recorder.track.to_rows())
+            self.reported_frames += self._frames
+        self._frames = 0
+        self._recorder = TrackRecorder()
+        self._last_flush = time.monotonic()
+
+    def rollback(self) -> None:
+        """
+        Take back the frames reported so far, e.g. before a failed segment is retried.
+
+        Their detections stay, the retry reports the same frames and the store skips them.
+        """
+        if self.reported_frames:
+            self.store.advance(self.video_predict_pk, -self.reported_frames, [])
+        self.reported_frames = 0
+        self._frames = 0
+        self._recorder = TrackRecorder()
+
+
+_progress_store: ProgressStore | None = None
+
+
+def get_progress_store() -> ProgressStore | None:
+    """
+    Get the process-wide progress store configured from Django settings.
+
+    Returns:
+        Progress store or None if progress reporting is disabled.
+    """
+    global _progress_store
+    from django.conf import settings
+
+    if not settings.WEAPONDETECT_PROGRESS_ENABLED:
+        return None
+
+    if _progress_store is None:
+        _progress_store = ProgressStore(
+            redis_url=settings.WEAPONDETECT_PROGRESS_REDIS_URL,
+            ttl=settings.WEAPONDETECT_PROGRESS_TTL,
+            max_detections=settings.WEAPONDETECT_PROGRESS_MAX_DETECTIONS,
+        )
+    return _progress_store
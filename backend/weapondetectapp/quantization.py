@@ -0,0 +1,306 @@
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Sequence
+
+import cv2
+import numpy as np
+
+from weapondetectapp.boxes import Boxes
+from weapondetectapp.cache import file_digest
+from weapondetectapp.tracking import box_iou
+
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+_warned = set()
+
+
+def quantized_model_path(weights_path: str) -> str:
+    stem, _ = os.path.splitext(weights_path)
+    return f'{stem}_int8.onnx'
+
+
+def manifest_path(weights_path: str) -> str:
+    stem, _ = os.path.splitext(weights_path)
+    return f'{stem}_int8.json'
+
+
+@dataclass
+class ClassMetrics:
+    """
+    Detection quality of one class.
+
+    recall: Share of the true boxes found at the operating confidence threshold
+    ap50: Average precision at IoU 0.5 over all confidence thresholds
+    true_boxes: Number of true boxes
+    """
+    recall: float = 0.0
+    ap50: float = 0.0
+    true_boxes: int = 0
+
+
+@dataclass
+class QuantizationManifest:
+    """
+    Result of a quantization build, stored next to the weights.
+
+    model: File name of the quantized model
+    mode: Quantization mode, dynamic or static
+    source_version: SHA-256 of the weights the model was built from
+    class_name: Class the accuracy gate was checked on
+    reference: Metrics of the FP32 model
+    quantized: Metrics of the INT8 model
+    max_recall_drop: Largest recall drop the gate accepted
+    activated: Whether the gate passed and the detector may use the model
+    """
+    model: str
+    mode: str
+    source_version: str
+    class_name: str
+    reference: ClassMetrics = field(default_factory=ClassMetrics)
+    quantized: ClassMetrics = field(default_factory=ClassMetrics)
+    max_recall_drop: float = 0.0
+    activated: bool = False
+
+    @property
+    def recall_drop(self) -> float:
+        return self.reference.recall - self.quantized.recall
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> 'QuantizationManifest':
+        with open(path) as f:
+            data = json.load(f)
+        data['reference'] = ClassMetrics(**data['reference'])
+        data['quantized'] = ClassMetrics(**data['quantized'])
+        return cls(**data)
+
+
+def resolve_quantized_model_path(weights_path: str) -> str | None:
+    """
+    Get the quantized model if it was built from the current weights and passed the accuracy gate.
+
+    Args:
+        weights_path: Path to the PyTorch weights file.
+
+    Returns:
+        Path to the quantized model or None.
+    """
+    path = manifest_path(weights_path)
+    reason = None
+    if not os.path.exists(path):
+        reason = 'is not built'
+    else:
+        manifest = QuantizationManifest.load(path)
+        if not manifest.activated:
+            reason = f'did not pass the accuracy gate ({manifest.class_name} recall drop {manifest.recall_drop:.3f})'
+        elif not os.path.exists(weights_path) or file_digest(weights_path) != manifest.source_version:
+            reason = 'was built from other weights'
+        else:
+            return os.path.join(os.path.dirname(path), manifest.model)
+
+    if (weights_path, reason) not in _warned:
+        _warned.add((weights_path, reason))
+        print(f'Quantized model {reason}, using FP32. Run "python manage.py quantize_detector"')
+    return None
+
+
+def preprocess(image: np.ndarray, imgsz: int = 640) -> np.ndarray:
+    """
+    Turn a BGR image into the model input the way ultralytics does for a fixed-size model.
+
+    Args:
+        image: BGR image array.
+        imgsz: Input image size of the model.
+
+    Returns:
+        Float32 array of shape (1, 3, imgsz, imgsz) scaled to 0-1.
+    """
+    from ultralytics.data.augment import LetterBox
+
+    image = LetterBox((imgsz, imgsz), auto=False)(image=image)
+    image = image[..., ::-1].transpose(2, 0, 1)[None]
+    return np.ascontiguousarray(image, dtype=np.float32) / 255
+
+
+def calibration_data_reader(image_paths: List[str], input_name: str, imgsz: int = 640):
+    """
+    Build an ONNX Runtime calibration data reader over images.
+
+    Args:
+        image_paths: Paths to the calibration images.
+        input_name: Name of the model input.
+        imgsz: Input image size of the model.
+
+    Returns:
+        Calibration data reader feeding one image at a time.
+    """
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class FolderCalibrationDataReader(CalibrationDataReader):
+        def __init__(self) -> None:
+            self._inputs = self._read()
+
+        def _read(self) -> Iterator[Dict[str, np.ndarray]]:
+            for path in image_paths:
+                image = cv2.imread(path)
+                if image is not None:
+                    yield {input_name: preprocess(image, imgsz)}
+
+        def get_next(self) -> Dict[str, np.ndarray] | None:
+            return next(self._inputs, None)
+
+        def rewind(self) -> None:
+            self._inputs = self._read()
+
+    return FolderCalibrationDataReader()
+
+
+def _head_nodes(model) -> List[str]:
+    # The detection head (the last '/model.N/' block) regresses box coordinates
+    # and loses the most accuracy in INT8, so it stays in FP32
+    blocks = [
+        (int(match.group(1)), node.name)
+        for node in model.graph.node
+        if (match := re.match(r'/model\.(\d+)/', node.name))
+    ]
+    if not blocks:
+        return []
+    head = max(index for index, _ in blocks)
+    return [name for index, name in blocks if index == head]
+
+
+def quantize_model(fp32_path: str, output_path: str, mode: str = 'static',
+                   calibration_images: List[str] | None = None, imgsz: int = 640) -> str:
+    """
+    Quantize an FP32 ONNX model to INT8.
+
+    Args:
+        fp32_path: Path to the FP32 ONNX model.
+        output_path: Path to save the INT8 model.
+        mode: dynamic quantizes weights only, static also activations using calibration images.
+        calibration_images: Paths to the calibration images, required for static mode.
+        imgsz: Input image size of the model.
+
+    Returns:
+        Path to the INT8 model.
+    """
+    import onnx
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f'Unknown quantization mode {mode}, expected one of {", ".join(QUANTIZATION_MODES)}')
+
+    model = onnx.load(fp32_path)
+    nodes_to_exclude = _head_nodes(model)
+
+    if mode == 'dynamic':
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QUInt8, nodes_to_exclude=nodes_to_exclude)
+    else:
+        if not calibration_images:
+            raise ValueError('Static quantization needs calibration images')
+        quantize_static(
+            fp32_path, output_path,
+            calibration_data_reader(calibration_images, model.graph.input[0].name, imgsz),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            nodes_to_exclude=nodes_to_exclude,
+        )
+
+    # Ultralytics reads the class names and stride from the model metadata
+    quantized = onnx.load(output_path)
+    if not quantized.metadata_props:
+        quantized.metadata_props.extend(model.metadata_props)
+        onnx.save(quantized, output_path)
+    return output_path
+
+
+def load_yolo_labels(image_path: str, shape) -> Boxes | None:
+    """
+    Read the YOLO-format ground truth of an image, from the labels folder next to the images folder.
+
+    Args:
+        image_path: Path to the image.
+        shape: Shape of the image array.
+
+    Returns:
+        Ground truth boxes or None if the image has no labels file.
+    """
+    head, images_dir, name = image_path.rpartition(f'{os.sep}images{os.sep}')
+    if not images_dir:
+        return None
+    label_path = os.path.join(f'{head}{os.sep}labels', f'{os.path.splitext(name)[0]}.txt')
+    if not os.path.exists(label_path):
+        return None
+
+    rows = np.loadtxt(label_path, ndmin=2, dtype=np.float32).reshape(-1, 5)
+    height, width = shape[:2]
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    return Boxes(
+        cls=rows[:, 0],
+        conf=np.ones(len(rows)),
+        xyxy=np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1),
+    )
+
+
+def class_metrics(predictions: List[Boxes], truths: List[Boxes], classes: Sequence[int],
+                  conf: float = 0.25, iou_threshold: float = 0.5) -> ClassMetrics:
+    """
+    Measure the recall and AP50 of one class.
+
+    Args:
+        predictions: Predicted boxes of every image, with low-confidence boxes kept for AP.
+        truths: True boxes of every image.
+        classes: Ids of the class to measure, a class name may have several.
+        conf: Operating confidence threshold the recall is measured at.
+        iou_threshold: Minimum IoU of a true positive.
+
+    Returns:
+        Class metrics.
+    """
+    scores, hits = [], []
+    true_boxes = 0
+    for predicted, truth in zip(predictions, truths):
+        predicted = predicted[np.isin(predicted.cls, classes)]
+        truth = truth[np.isin(truth.cls, classes)]
+        true_boxes += len(truth)
+
+        # Match the most confident predictions first, each true box at most once
+        order = np.argsort(-predicted.conf)
+        iou = box_iou(predicted.xyxy[order], truth.xyxy)
+        used = np.zeros(len(truth), dtype=bool)
+        for row, score in zip(iou, predicted.conf[order]):
+            candidates = np.where(~used & (row >= iou_threshold))[0]
+            hit = len(candidates) > 0
+            if hit:
+                used[candidates[np.argmax(row[candidates])]] = True
+            scores.append(float(score))
+            hits.append(hit)
+
+    if not true_boxes:
+        return ClassMetrics()
+
+    order = np.argsort(-np.array(scores))
+    hits = np.array(hits, dtype=bool)[order]
+    scores = np.array(scores)[order]
+    true_positives = np.cumsum(hits)
+    recall_curve = true_positives / true_boxes
+    precision_curve = true_positives / np.arange(1, len(hits) + 1)
+
+    # All-point interpolated average precision
+    precision_envelope = np.maximum.accumulate(np.concatenate([precision_curve, [0]])[::-1])[::-1]
+    recall_steps = np.diff(np.concatenate([[0], recall_curve]))
+    ap50 = float(np.sum(recall_steps * precision_envelope[:-1]))
+
+    return ClassMetrics(
+        recall=float(hits[scores >= conf].sum() / true_boxes),
+        ap50=ap50,
+        true_boxes=true_boxes,
+    )
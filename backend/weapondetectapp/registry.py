@@ -0,0 +1,240 @@
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, List, Tuple
+
+import numpy as np
+from ultralytics import YOLO
+
+from weapondetectapp.cache import file_digest, get_result_cache
+from weapondetectapp.metrics import registry as metrics_registry
+
+
+MODEL_LOAD_SECONDS = metrics_registry.histogram(
+    'weapondetect_model_load_seconds', 'Time to load a model into the registry',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+@dataclass
+class ModelHandle:
+    """
+    model: Loaded YOLO model
+    path: Path to the weights file
+    mtime: Modification time of the weights file when it was loaded
+    version: SHA-256 of the weights file, or its name if the model is not loaded from a file
+
+    lock: Lock serializing calls into the model (the ultralytics predictor is not thread-safe)
+    """
+    model: YOLO
+    path: str
+    mtime: float | None
+    version: str
+
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False)
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            return self.model(*args, **kwargs)
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded YOLO models.
+
+    Each model is loaded once per process and keyed by its weights path and
+    the config it was built with. The weights file is re-checked on access and
+    the model is reloaded when the file changes on disk.
+    """
+    WARMUP_SHAPE = (640, 640, 3)
+
+    def __init__(self) -> None:
+        self._handles: Dict[Tuple, ModelHandle] = {}
+        self._lock = threading.Lock()
+        self._reload_hooks: List[Callable[[ModelHandle], None]] = []
+
+    @staticmethod
+    def _resolve_path(model_path: str) -> str:
+        model_path = str(model_path)
+        # Model names like 'yolov8n.yaml' are resolved by ultralytics itself
+        return os.path.abspath(model_path) if os.path.exists(model_path) else model_path
+
+    @staticmethod
+    def _get_mtime(model_path: str) -> float | None:
+        try:
+            return os.path.getmtime(model_path)
+        except OSError:
+            return None
+
+    def make_key(self, model_path: str, **config: Hashable) -> Tuple:
+        """
+        Build the registry key of a model.
+
+        Args:
+            model_path: Path to the weights file.
+            config: Keyword arguments the model is built with.
+
+        Returns:
+            Hashable registry key.
+        """
+        return self._resolve_path(model_path), tuple(sorted(config.items()))
+
+    def _is_stale(self, handle: ModelHandle) -> bool:
+        return self._get_mtime(handle.path) != handle.mtime
+
+    @staticmethod
+    def _get_version(model_path: str) -> str:
+        if not os.path.isdir(model_path):
+            return file_digest(model_path)
+
+        # Exported models like OpenVINO are folders of files
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(model_path)):
+            if os.path.isfile(os.path.join(model_path, name)):
+                digest.update(f'{name}:{file_digest(os.path.join(model_path, name))}'.encode())
+        return digest.hexdigest()
+
+    def _load(self, model_path: str, config: Dict) -> ModelHandle:
+        model_path = self._resolve_path(model_path)
+        mtime = self._get_mtime(model_path)
+        version = self._get_version(model_path) if mtime is not None else model_path
+        started = time.perf_counter()
+        model = YOLO(model_path, **config)
+        MODEL_LOAD_SECONDS.observe(time.perf_counter() - started)
+        return ModelHandle(model=model, path=model_path, mtime=mtime, version=version)
+
+    def warmup(self, handle: ModelHandle) -> None:
+        """
+        Run a dummy forward pass so the first real request does not pay for lazy initialization.
+
+        Args:
+            handle: Model handle to warm up.
+        """
+        handle(np.zeros(self.WARMUP_SHAPE, dtype=np.uint8), verbose=False)
+
+    def get(self, model_path: str, warmup: bool = False, **config: Hashable) -> ModelHandle:
+        """
+        Get a loaded model, loading it on first access or when the weights file has changed.
+
+        Args:
+            model_path: Path to the weights file.
+            warmup: Run a dummy forward pass right after loading.
+            config: Keyword arguments passed to the YOLO constructor.
+
+        Returns:
+            Thread-safe model handle.
+        """
+        key = self.make_key(model_path, **config)
+
+        handle = self._handles.get(key)
+        if handle is not None and not self._is_stale(handle):
+            return handle
+
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and not self._is_stale(handle):
+                return handle
+
+            reloaded = handle is not None
+            handle = self._load(model_path, config)
+            if warmup:
+                self.warmup(handle)
+            self._handles[key] = handle
+
+        if reloaded:
+            for hook in self._reload_hooks:
+                hook(handle)
+
+        return handle
+
+    def reload(self, model_path: str, warmup: bool = False, **config: Hashable) -> ModelHandle:
+        """
+        Drop a cached model and load it again.
+
+        Args:
+            model_path: Path to the weights file.
+            warmup: Run a dummy forward pass right after loading.
+            config: Keyword arguments passed to the YOLO constructor.
+
+        Returns:
+            Thread-safe model handle.
+        """
+        with self._lock:
+            self._handles.pop(self.make_key(model_path, **config), None)
+        handle = self.get(model_path, warmup=warmup, **config)
+        for hook in self._reload_hooks:
+            hook(handle)
+        return handle
+
+    def register_reload_hook(self, hook: Callable[[ModelHandle], None]) -> None:
+        """
+        Register a callable invoked with the new handle every time a model is reloaded.
+
+        Args:
+            hook: Callable taking the reloaded model handle.
+        """
+        self._reload_hooks.append(hook)
+
+    def clear(self) -> None:
+        """
+        Drop all cached models.
+        """
+        with self._lock:
+            self._handles.clear()
+
+
+model_registry = ModelRegistry()
+
+
+def get_model_path() -> str:
+    """
+    Get the path of the model for the inference backend chosen in Django settings.
+
+    Returns:
+        Path to the activated INT8 model if quantization is enabled, otherwise to the exported model,
+        or to the PyTorch weights if it is not exported.
+    """
+    from django.conf import settings
+    from weapondetectapp.backends import resolve_model_path
+    from weapondetectapp.quantization import resolve_quantized_model_path
+
+    if settings.WEAPONDETECT_QUANTIZED:
+        quantized_path = resolve_quantized_model_path(settings.WEAPONDETECT_MODEL_PATH)
+        if quantized_path is not None:
+            return quantized_path
+
+    return resolve_model_path(settings.WEAPONDETECT_MODEL_PATH, settings.WEAPONDETECT_BACKEND)
+
+
+def get_detector(**kwargs) -> 'TerroristDetector':
+    """
+    Build a detector configured from Django settings and backed by the shared registry.
+
+    Args:
+        kwargs: Extra keyword arguments passed to TerroristDetector.
+
+    Returns:
+        Terrorist detector object.
+    """
+    from django.conf import settings
+    from weapondetectapp.pool import get_inference_pool
+    from weapondetectapp.utils import TerroristDetector
+
+    # The defaults are only built when missing, building the pool spawns its workers
+    if 'model_path' not in kwargs:
+        kwargs['model_path'] = get_model_path()
+    kwargs.setdefault('warmup', settings.WEAPONDETECT_WARMUP)
+    if 'cache' not in kwargs:
+        kwargs['cache'] = get_result_cache()
+    if 'pool' not in kwargs:
+        kwargs['pool'] = get_inference_pool()
+    detector = TerroristDetector(**kwargs)
+    detector.tile_size = settings.WEAPONDETECT_TILE_SIZE
+    detector.tile_overlap = settings.WEAPONDETECT_TILE_OVERLAP
+    detector.tile_min_side = settings.WEAPONDETECT_TILE_MIN_SIDE
+    detector.tile_gate = settings.WEAPONDETECT_TILE_GATE
+    detector.cascade = settings.WEAPONDETECT_CASCADE_ENABLED
+    detector.cascade_imgsz = settings.WEAPONDETECT_CASCADE_IMGSZ
+    detector.cascade_model_path = settings.WEAPONDETECT_CASCADE_MODEL_PATH
+    return detector
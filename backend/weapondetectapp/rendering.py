@@ -0,0 +1,133 @@
+from functools import lru_cache
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from weapondetectapp.boxes import Boxes
+
+
+@lru_cache(maxsize=None)
+def load_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Load a TrueType font once per process.
+
+    Args:
+        font_path: Path to the font file.
+        size: Font size.
+
+    Returns:
+        Font object.
+    """
+    return ImageFont.truetype(font_path, size)
+
+
+class BoxRenderer:
+    """
+    Draws bounding boxes and labels onto images in place.
+
+    Colors are resolved and the font is loaded once, when the renderer is
+    built, so drawing a box costs only the drawing calls themselves.
+    """
+    FONT_PATH = 'weapondetectapp/weights/arial.ttf'
+    FONT_SIZE = 20
+
+    def __init__(
+        self,
+        colors: Dict[int, str],
+        default_color: str = 'white',
+        line_width: int = 2,
+        font_path: str = FONT_PATH,
+        font_size: int = FONT_SIZE,
+    ) -> None:
+        """
+        Args:
+            colors: Dict of classes and their box colors.
+            default_color: Color of the classes missing from colors.
+            line_width: Bounding box thickness (pixels).
+            font_path: Path to the TrueType font of the labels on images.
+            font_size: Font size of the labels on images.
+        """
+        self.line_width = line_width
+        self.font_path = font_path
+        self.font_size = font_size
+
+        self._rgb = {int(cls): ImageColor.getrgb(color) for cls, color in colors.items()}
+        self._default_rgb = ImageColor.getrgb(default_color)
+        self._labels: Dict[Tuple[int, str], str] = {}
+
+    def rgb(self, cls: int) -> Tuple[int, int, int]:
+        return self._rgb.get(cls, self._default_rgb)
+
+    def bgr(self, cls: int) -> Tuple[int, int, int]:
+        r, g, b = self.rgb(cls)
+        return b, g, r
+
+    def label(self, cls: int, cls_names: Dict[float, str], conf: float) -> str:
+        name = cls_names.get(cls)
+        prefix = self._labels.get((cls, name))
+        if prefix is None:
+            prefix = f'{name} '
+            prefix = self._labels[(cls, name)] = prefix[:1].upper() + prefix[1:]
+        return f'{prefix}{conf:.2f}'
+
+    @property
+    def font(self) -> ImageFont.FreeTypeFont:
+        return load_font(self.font_path, self.font_size)
+
+    def draw_on_image(self, img: Image.Image, boxes: Boxes, cls_names: Dict[float, str]) -> Image.Image:
+        """
+        Draw bounding boxes and labels onto a PIL image.
+
+        Args:
+            img: Image, modified in place.
+            boxes: Bounding boxes.
+            cls_names: Dict of classes and their names.
+
+        Returns:
+            The same image with the bounding boxes drawn on it.
+        """
+        if not len(boxes):
+            return img
+
+        draw = ImageDraw.Draw(img)
+        font = self.font
+        for cls, conf, (x1, y1, x2, y2) in zip(
+                boxes.cls.astype(int).tolist(), boxes.conf.tolist(), boxes.xyxy.tolist()):
+            color_box = self.rgb(cls)
+            draw.rectangle((x1, y1, x2, y2), outline=color_box, width=self.line_width)
+            draw.text(
+                (x1 + self.line_width, y1 + self.line_width), self.label(cls, cls_names, conf),
+                fill=color_box, font=font,
+            )
+        return img
+
+    def draw_on_array(self, frame: np.ndarray, boxes: Boxes, cls_names: Dict[float, str]) -> np.ndarray:
+        """
+        Draw bounding boxes and labels straight onto a BGR frame.
+
+        Args:
+            frame: BGR image array, modified in place.
+            boxes: Bounding boxes.
+            cls_names: Dict of classes and their names.
+
+        Returns:
+            The same frame with the bounding boxes drawn on it.
+        """
+        if not len(boxes):
+            return frame
+
+        for cls, conf, (x1, y1, x2, y2) in zip(
+                boxes.cls.astype(int).tolist(), boxes.conf.tolist(),
+                np.rint(boxes.xyxy).astype(int).tolist()):
+            color_box = self.bgr(cls)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color_box, self.line_width)
+
+            text = self.label(cls, cls_names, conf)
+            (_, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
+            cv2.putText(
+                frame, text, (x1 + self.line_width, y1 + self.line_width + text_height),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, color_box, self.line_width, cv2.LINE_AA,
+            )
+        return frame
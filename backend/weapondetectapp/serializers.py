@@ -0,0 +1,76 @@
+import os
+
+from django.conf import settings
+from rest_framework import serializers
+
+from weapondetectapp.models import Image, ImagePredict
+from weapondetectapp.utils import TerroristDetector
+
+
+class DetectRequestSerializer(serializers.Serializer):
+    files = serializers.ListField(
+        child=serializers.FileField(),
+        required=False,
+        help_text="Images to detect objects on",
+    )
+    paths = serializers.ListField(
+        child=serializers.CharField(),
+        required=False,
+        help_text="Paths or URLs of images already uploaded by the user, originals or predictions",
+    )
+
+    def validate_paths(self, paths):
+        """
+        Resolve the paths of the images of the requesting user inside MEDIA_ROOT.
+
+        Returns:
+            (path as sent, absolute path) tuples.
+        """
+        media_root = os.path.realpath(settings.MEDIA_ROOT)
+        request = self.context.get("request")
+        if request is None or not request.user.is_authenticated:
+            raise serializers.ValidationError("Paths are only accepted from an authenticated user")
+
+        resolved = []
+        for name in paths:
+            # Accept both 'images/user/x.jpg' and '/media/images/user/x.jpg'
+            path = name[len(settings.MEDIA_URL):] if name.startswith(settings.MEDIA_URL) else name
+            full_path = os.path.realpath(os.path.join(media_root, path.lstrip("/")))
+
+            if os.path.commonpath([media_root, full_path]) != media_root:
+                raise serializers.ValidationError(f"Path is outside the media storage: {path}")
+            if os.path.splitext(full_path)[1].lower() not in TerroristDetector.IMAGE_EXTENSIONS:
+                raise serializers.ValidationError(f"Path is not an image: {path}")
+            if not os.path.isfile(full_path):
+                raise serializers.ValidationError(f"File does not exist: {path}")
+
+            resolved.append((name, full_path))
+
+        # Any file in the storage could be read through its path, so only the user's own images are allowed
+        names = {os.path.relpath(full_path, media_root) for _, full_path in resolved}
+        owned = set(Image.objects.filter(user=request.user, image__in=names).values_list("image", flat=True))
+        owned.update(ImagePredict.objects.filter(
+            image_original__user=request.user, image_predict__in=names).values_list("image_predict", flat=True))
+        for name, full_path in resolved:
+            if os.path.relpath(full_path, media_root) not in owned:
+                raise serializers.ValidationError(f"Image is not one of yours: {name}")
+        return resolved
+
+    def validate(self, attrs):
+        if not attrs.get("files") and not attrs.get("paths"):
+            raise serializers.ValidationError("Pass at least one file or path")
+        return attrs
+
+
+class DetectionSerializer(serializers.Serializer):
+    cls = serializers.IntegerField()
+    name = serializers.CharField(allow_null=True)
+    conf = serializers.FloatField()
+    xyxy = serializers.ListField(child=serializers.FloatField(), min_length=4, max_length=4)
+
+
+class DetectResultSerializer(serializers.Serializer):
+    index = serializers.IntegerField(help_text="Position of the image in the request, files first")
+    name = serializers.CharField()
+    boxes = DetectionSerializer(many=True, required=False)
+    error = serializers.CharField(required=False)
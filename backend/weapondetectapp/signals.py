@@ -0,0 +1,57 @@
+import time
+from typing import Dict, Tuple
+
+from celery.signals import task_postrun, task_prerun, worker_process_init
+
+from weapondetectapp.metrics import record_stages
+from weapondetectapp.pool import disable_inference_pool
+from weapondetectapp.registry import get_detector
+
+
+# Stage recorders of the running tasks by task id
+_task_stages: Dict[str, Tuple[object, Dict[str, float], float]] = {}
+
+
+def preload_model() -> None:
+    """
+    Load the detection model into the process-wide registry.
+    """
+    get_detector(warmup=True)
+
+
+@worker_process_init.connect
+def preload_model_in_worker(**kwargs) -> None:
+    # Every prefork child would start inference processes sized for the whole host
+    disable_inference_pool()
+    preload_model()
+
+
+@task_prerun.connect
+def start_task_stages(task_id=None, **kwargs) -> None:
+    recorder = record_stages()
+    _task_stages[task_id] = (recorder, recorder.__enter__(), time.perf_counter())
+
+
+@task_postrun.connect
+def send_task_stages(task_id=None, task=None, state=None, **kwargs) -> None:
+    """
+    Report the stage times of a finished task as a task-metrics event for Flower and other monitors.
+    """
+    item = _task_stages.pop(task_id, None)
+    if item is None:
+        return
+    recorder, stages, started = item
+    recorder.__exit__(None, None, None)
+
+    # Events are only sent by workers started with -E
+    if task.request.is_eager or not task.app.conf.worker_send_task_events:
+        return
+    try:
+        task.send_event(
+            'task-metrics',
+            state=state,
+            seconds=time.perf_counter() - started,
+            stages={stage: round(seconds, 6) for stage, seconds in stages.items()},
+        )
+    except Exception as e:
+        print(f'Task metrics cannot be sent: {e}')
@@ -1,9 +1,355 @@
-from celery import shared_task
-from weapondetectapp.utils import TerroristDetector
+import os
+import shutil
+from typing import Callable, List
+
+from celery import chord, shared_task
+from django.conf import settings
+
+from weapondetectapp.alerts import WeaponAlertEmitter, get_alert_stream
+from weapondetectapp.cache import CacheEntry, get_result_cache
+from weapondetectapp.models import ImagePredict, VideoPredict, reserve_file
+from weapondetectapp.progress import ProgressReporter, get_progress_store
+from weapondetectapp.registry import get_detector
+from weapondetectapp.utils import IMAGES, save_thumbnail
+from weapondetectapp.video import DetectionTrack, TrackRecorder, count_frames, video_fps
+from weapondetectapp.videoio import concat_videos
+
+
+def _video_options() -> dict:
+    return {
+        'batch_size': settings.WEAPONDETECT_BATCH_SIZE,
+        'stride': settings.WEAPONDETECT_VIDEO_STRIDE,
+        'motion_threshold': settings.WEAPONDETECT_VIDEO_MOTION_THRESHOLD,
+        'preset': settings.WEAPONDETECT_VIDEO_ENCODER_PRESET,
+        'keep_audio': settings.WEAPONDETECT_VIDEO_KEEP_AUDIO,
+    }
+
+
+def _video_run_options() -> dict:
+    # Hardware decoding does not change the result, so it is not part of the cache key
+    return {**_video_options(), 'hwaccel': settings.WEAPONDETECT_VIDEO_HWACCEL}
+
+
+def _chain(*callbacks: Callable | None) -> Callable:
+    callbacks = [callback for callback in callbacks if callback is not None]
+
+    def on_frame(frame_predict) -> None:
+        for callback in callbacks:
+            callback(frame_predict)
+    return on_frame
+
+
+def _progress_reporter(video_predict_pk: int | None) -> ProgressReporter | None:
+    store = get_progress_store()
+    if store is None or video_predict_pk is None:
+        return None
+    return ProgressReporter(store, video_predict_pk, settings.WEAPONDETECT_PROGRESS_INTERVAL)
+
+
+def _alert_emitter(video_predict_pk: int | None, video_path: str) -> WeaponAlertEmitter | None:
+    stream = get_alert_stream()
+    if stream is None or video_predict_pk is None:
+        return None
+    user_id = VideoPredict.objects.filter(pk=video_predict_pk)\
+        .values_list('video_original__user_id', flat=True).first()
+    if user_id is None:
+        return None
+    return WeaponAlertEmitter(
+        stream, user_id, video_fps(video_path), video_predict_pk=video_predict_pk,
+        class_names=settings.WEAPONDETECT_ALERTS_CLASSES,
+        conf=settings.WEAPONDETECT_ALERTS_CONF,
+        min_frames=settings.WEAPONDETECT_ALERTS_MIN_FRAMES,
+        cooldown=settings.WEAPONDETECT_ALERTS_COOLDOWN,
+        thumbnail_size=settings.WEAPONDETECT_ALERTS_THUMBNAIL_SIZE,
+    )
+
+
+def _finish_video(video_predict_pk: int | None, state: str = VideoPredict.Status.DONE) -> None:
+    if video_predict_pk is None:
+        return
+    VideoPredict.objects.filter(pk=video_predict_pk).update(status=state)
+    store = get_progress_store()
+    if store is not None:
+        store.finish(video_predict_pk, state)
+
+
+def _fail_video(video_predict_pk: int | None, segments_dir: str | None = None) -> None:
+    _finish_video(video_predict_pk, VideoPredict.Status.FAILED)
+    if segments_dir is not None:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+
+def _save_video_track(video_predict_pk: int | None, video_path: str, track: DetectionTrack,
+                      cache_key: str | None = None) -> None:
+    if video_predict_pk is None:
+        return
+
+    video_predict = VideoPredict.objects.get(pk=video_predict_pk)
+    video_predict.set_track(track, f'{video_path}.track.npz')
+    video_predict.save(update_fields=['boxes'])
+
+    cache = get_result_cache()
+    if cache is not None and cache_key is not None:
+        cache.set(cache_key, CacheEntry(
+            boxes=video_predict.boxes,
+            artifact_path=os.path.relpath(video_path, settings.MEDIA_ROOT),
+        ))
+
+
+def _restore_cached_video(video_predict_pk: int | None, video_path: str, cache_key: str | None) -> bool:
+    """
+    Put the annotated video of the same content processed before at video_path.
+
+    Returns:
+        Whether the video was found in the result cache.
+    """
+    cache = get_result_cache()
+    if cache is None or cache_key is None or video_predict_pk is None:
+        return False
+
+    entry = cache.get(cache_key)
+    if entry is None or entry.artifact_path is None:
+        return False
+
+    artifact_path = os.path.join(settings.MEDIA_ROOT, entry.artifact_path)
+    if not os.path.isfile(artifact_path):
+        return False
+
+    # Annotated videos are never modified, so a hard link is enough when the filesystem allows it
+    tmp_path = f'{video_path}.tmp'
+    try:
+        os.link(artifact_path, tmp_path)
+    except OSError:
+        shutil.copyfile(artifact_path, tmp_path)
+    os.replace(tmp_path, video_path)
+
+    VideoPredict.objects.filter(pk=video_predict_pk).update(boxes=entry.boxes)
+    return True
+
+
+@shared_task
+def process_predict_video(video_path, video_predict_pk=None, output_path=None):
+    """
+    Draw bounding boxes on an existing video, splitting long videos into segments
+    that are processed in parallel by the workers.
+
+    Args:
+        video_path: Path to the source video.
+        video_predict_pk: Primary key of the VideoPredict object to store the detections in.
+        output_path: Path to save the annotated video, None to overwrite the source video.
+    """
+    output_path = output_path or video_path
+
+    detector = get_detector()
+    cache_key = detector.cache_key(video_path, **_video_options())
+    if _restore_cached_video(video_predict_pk, output_path, cache_key):
+        _finish_video(video_predict_pk)
+        return
+
+    segment_frames = settings.WEAPONDETECT_VIDEO_SEGMENT_FRAMES
+    num_frames = count_frames(video_path)
+
+    store = get_progress_store()
+    if store is not None and video_predict_pk is not None:
+        store.start(video_predict_pk, num_frames)
+    if video_predict_pk is not None:
+        VideoPredict.objects.filter(pk=video_predict_pk).update(status=VideoPredict.Status.RUNNING)
+
+    if not segment_frames or num_frames <= segment_frames:
+        recorder = TrackRecorder()
+        reporter = _progress_reporter(video_predict_pk)
+        emitter = _alert_emitter(video_predict_pk, video_path)
+        try:
+            if output_path == video_path:
+                detector.predict_video_and_draw_boxes_on_existing_video(
+                    video_path, on_frame=_chain(recorder, reporter, emitter), **_video_run_options())
+            else:
+                # The encoder writes straight into the output file, the source is never copied
+                detector.predict_video(
+                    video_path, output_path, on_frame=_chain(recorder, reporter, emitter), **_video_run_options())
+            if reporter is not None:
+                reporter.flush()
+            _save_video_track(video_predict_pk, output_path, recorder.track, cache_key)
+        except Exception:
+            _fail_video(video_predict_pk)
+            raise
+        _finish_video(video_predict_pk)
+        return
+
+    segments_dir = f'{output_path}.segments'
+    os.makedirs(segments_dir, exist_ok=True)
+
+    starts = range(0, num_frames, segment_frames)
+    segments = [
+        process_predict_video_segment.s(
+            video_path,
+            os.path.join(segments_dir, f'{i:05d}.mp4'),
+            start,
+            # The frame count is an estimate, so the last segment reads until the end
+            start + segment_frames if i < len(starts) - 1 else None,
+            video_predict_pk,
+        )
+        for i, start in enumerate(starts)
+    ]
+    merge = merge_video_segments.s(output_path, segments_dir, video_predict_pk, cache_key, video_path)
+    # A segment out of retries fails the chord and the merge never runs
+    merge.on_error(fail_video_segments.s(video_predict_pk=video_predict_pk, segments_dir=segments_dir))
+    try:
+        chord(segments)(merge)
+    except Exception:
+        # Eager mode raises the segment error here instead of calling the error callback
+        _fail_video(video_predict_pk, segments_dir)
+        raise
+
+
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=settings.WEAPONDETECT_VIDEO_SEGMENT_RETRIES,
+)
+def process_predict_video_segment(video_path: str, segment_path: str, start_frame: int,
+                                  end_frame: int | None, video_predict_pk: int | None = None) -> str:
+    """
+    Draw bounding boxes on a range of video frames and save them as a separate video.
+
+    Args:
+        video_path: Path to the source video.
+        segment_path: Path to save the annotated segment.
+        start_frame: Index of the first frame of the segment.
+        end_frame: Index of the frame to stop before, None to process until the end.
+        video_predict_pk: Primary key of the VideoPredict object to report the progress of.
+
+    Returns:
+        Path to the annotated segment, its detection track is saved next to it with a .npz suffix.
+    """
+    recorder = TrackRecorder()
+    reporter = _progress_reporter(video_predict_pk)
+    # Every segment debounces its own alerts, one may repeat across a segment boundary
+    emitter = _alert_emitter(video_predict_pk, video_path)
+    detector = get_detector()
+    try:
+        detector.predict_video(
+            video_path, segment_path, start_frame, end_frame,
+            on_frame=_chain(recorder, reporter, emitter), **_video_run_options())
+    except Exception:
+        # The retry processes the segment again from its start
+        if reporter is not None:
+            reporter.rollback()
+        raise
+    if reporter is not None:
+        reporter.flush()
+    recorder.track.save(f'{segment_path}.npz')
+    return segment_path
+
+
+@shared_task
+def merge_video_segments(segment_paths: List[str], video_path: str, segments_dir: str,
+                         video_predict_pk: int | None = None, cache_key: str | None = None,
+                         source_path: str | None = None) -> None:
+    """
+    Join the annotated segments in order and save the result.
+
+    Args:
+        segment_paths: Paths to the annotated segments, in order.
+        video_path: Path to save the annotated video.
+        segments_dir: Folder with the segments, deleted afterwards.
+        video_predict_pk: Primary key of the VideoPredict object to store the detections in.
+        cache_key: Key of the source video in the result cache.
+        source_path: Path to the source video to copy the audio track from.
+    """
+    new_name = os.path.basename(video_path)
+    merged_path = os.path.join(os.path.dirname(video_path), f'new_{new_name}')
+
+    try:
+        # The segments are H.264 already, they are joined without encoding them again
+        audio_source = source_path if settings.WEAPONDETECT_VIDEO_KEEP_AUDIO else None
+        concat_videos(segment_paths, merged_path, audio_source)
+        os.replace(merged_path, video_path)
+
+        track = DetectionTrack.concatenate(
+            [DetectionTrack.load(f'{segment_path}.npz') for segment_path in segment_paths])
+        _save_video_track(video_predict_pk, video_path, track, cache_key)
+    except Exception:
+        _fail_video(video_predict_pk, segments_dir)
+        raise
+    shutil.rmtree(segments_dir, ignore_errors=True)
+    _finish_video(video_predict_pk)
 
 
 @shared_task
-def process_predict_video(video_path):
-    detector = TerroristDetector()
-    detector.predict_video_and_draw_boxes_on_existing_video(video_path)
-    
\ No newline at end of file
+def fail_video_segments(request, exc, traceback, video_predict_pk: int | None = None,
+                        segments_dir: str | None = None) -> None:
+    """
+    Error callback of the segment chord: mark the video as failed and delete its segments.
+
+    Args:
+        request: Request of the failed task.
+        exc: Exception raised by the failed task.
+        traceback: Traceback of the exception.
+        video_predict_pk: Primary key of the VideoPredict object.
+        segments_dir: Folder with the segments.
+    """
+    print(f'Video segments of {video_predict_pk} failed: {exc}')
+    _fail_video(video_predict_pk, segments_dir)
+
+
+def _save_thumbnails(image_predict: ImagePredict) -> None:
+    image = image_predict.image_original
+    for field_file, source_path in (
+        (image.thumbnail, image.image.path),
+        (image_predict.thumbnail, image_predict.image_predict.path),
+    ):
+        if not field_file:
+            reserve_file(field_file, os.path.basename(source_path))
+            save_thumbnail(source_path, field_file.path, settings.WEAPONDETECT_THUMBNAIL_SIZE)
+    image.save(update_fields=['thumbnail'])
+
+
+@shared_task
+def process_predict_images(image_predict_pks: List[int]) -> None:
+    """
+    Draw bounding boxes on a batch of uploaded images and track their processing status.
+
+    Args:
+        image_predict_pks: Primary keys of the ImagePredict objects to process.
+    """
+    image_predicts = ImagePredict.objects.filter(pk__in=image_predict_pks)
+    image_predicts.update(status=ImagePredict.Status.RUNNING)
+    image_predicts = list(image_predicts.select_related('image_original__user'))
+
+    # The originals are read in place and the results go straight to the reserved files
+    source_paths = [image_predict.image_original.image.path for image_predict in image_predicts]
+
+    # The task already holds a whole batch, the micro-batcher is only for the API requests
+    detector = get_detector()
+    try:
+        image_results = detector.predict_batch(
+            source_paths,
+            batch_size=settings.WEAPONDETECT_BATCH_SIZE,
+        )
+    except Exception as e:
+        # Fall back to single images so a broken file fails only itself
+        print(f'Batch cannot be predicted: {e}')
+        image_results = [None] * len(image_predicts)
+
+    for image_predict, source_path, image_result in zip(image_predicts, source_paths, image_results):
+        try:
+            if image_result is None:
+                image_result = detector.predict(source_path)
+            detector.save_annotated_image(image_result, image_predict.image_predict.path)
+        except Exception as e:
+            print(f'Image {source_path} cannot be processed: {e}')
+            image_predict.status = ImagePredict.Status.FAILED
+            image_predict.save(update_fields=['status'])
+            IMAGES.inc(status='failed')
+            continue
+
+        try:
+            _save_thumbnails(image_predict)
+        except Exception as e:
+            print(f'Thumbnails of {source_path} cannot be saved: {e}')
+
+        image_predict.status = ImagePredict.Status.DONE
+        image_predict.boxes = image_result.boxes_to_json()
+        image_predict.save(update_fields=['status', 'boxes', 'thumbnail'])
+        IMAGES.inc(status='done')
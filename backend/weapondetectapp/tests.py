@@ -1,3 +1,1530 @@
-from django.test import TestCase
+import asyncio
+import gc
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from fractions import Fraction
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import cv2
+import numpy as np
+import torch
+from PIL import Image as PILImage
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from weapondetectapp.alerts import WeaponAlertEmitter
+from weapondetectapp.backends import artifact_path, mark_verified, resolve_model_path
+from weapondetectapp.batching import MicroBatcher
+from weapondetectapp.benchmark import BenchmarkResult, find_regressions, load_results, save_results
+from weapondetectapp.boxes import BoxPredict, Boxes
+from weapondetectapp.cache import CacheEntry, ResultCache, file_digest
+from weapondetectapp.camera import LatestFrameReader, SegmentWriter
+from weapondetectapp.executor import ExecutorBusy, InferenceExecutor
+from weapondetectapp.metrics import MetricsRegistry, record_stages, span
+from weapondetectapp.management.commands.quantize_detector import image_shape
+from weapondetectapp.models import Image, ImagePredict, Video, VideoPredict
+from weapondetectapp.pool import InferencePool, SharedFrameRing
+from weapondetectapp.progress import ProgressReporter, ProgressStore
+from weapondetectapp.quantization import (
+    ClassMetrics, QuantizationManifest, class_metrics, manifest_path, resolve_quantized_model_path,
+)
+from weapondetectapp.registry import get_detector
+from weapondetectapp.serializers import DetectRequestSerializer
+from weapondetectapp.tasks import (
+    fail_video_segments, merge_video_segments, process_predict_images, process_predict_video,
+)
+from weapondetectapp.tiling import cut_by_tile, make_tiles, nms, select_tiles
+from weapondetectapp.tracking import IoUTracker, box_iou
+from weapondetectapp.utils import ImagePredict as DetectorImagePredict, TerroristDetector
+from weapondetectapp.video import FramePredict, count_frames, video_fps
+from weapondetectapp.videoio import concat_videos, has_pyav, open_video_reader, open_video_writer
+from weapondetectapp.views import ReservedStream, VideoProgressMixin, queue_images
+
+
+def make_boxes(*rows) -> Boxes:
+    # Rows of (x1, y1, x2, y2, conf, cls), like ultralytics boxes
+    data = np.array(rows, dtype=np.float32).reshape(-1, 6)
+    return Boxes(cls=data[:, 5], conf=data[:, 4], xyxy=data[:, :4])
+
+
+class TempMediaMixin:
+    """
+    Keep the files saved by a test in a temporary MEDIA_ROOT.
+    """
+
+    def setUp(self):
+        super().setUp()
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        media_root = override_settings(MEDIA_ROOT=folder.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+
+class BoxesTests(SimpleTestCase):
+    def test_from_results_reads_rows_of_ultralytics_boxes(self):
+        results = SimpleNamespace(data=np.array([[1, 2, 3, 4, 0.5, 2], [5, 6, 7, 8, 0.75, 0]]))
+
+        boxes = Boxes.from_results(results)
+
+        np.testing.assert_allclose(boxes.xyxy, [[1, 2, 3, 4], [5, 6, 7, 8]])
+        np.testing.assert_allclose(boxes.conf, [0.5, 0.75])
+        np.testing.assert_allclose(boxes.cls, [2, 0])
+
+    def test_from_results_skips_track_ids(self):
+        results = SimpleNamespace(data=torch.tensor([[1, 2, 3, 4, 17, 0.5, 2]]))
+
+        boxes = Boxes.from_results(results)
+
+        np.testing.assert_allclose(boxes.xyxy, [[1, 2, 3, 4]])
+        np.testing.assert_allclose(boxes.conf, [0.5])
+        np.testing.assert_allclose(boxes.cls, [2])
+
+    def test_from_results_without_boxes(self):
+        self.assertEqual(len(Boxes.from_results(None)), 0)
+        self.assertEqual(len(Boxes.from_results(SimpleNamespace(data=np.zeros((0, 6))))), 0)
+
+    def test_to_json_rounds_values_and_adds_names(self):
+        boxes = make_boxes((1.04, 2.06, 3, 4, 0.123456, 1), (5, 6, 7, 8, 0.9, 3))
+
+        self.assertEqual(boxes.to_json({1: 'gun'}), [
+            {'cls': 1, 'name': 'gun', 'conf': 0.1235, 'xyxy': [1.0, 2.1, 3.0, 4.0]},
+            {'cls': 3, 'name': None, 'conf': 0.9, 'xyxy': [5.0, 6.0, 7.0, 8.0]},
+        ])
+
+    def test_to_json_round_trips_through_from_json(self):
+        boxes = make_boxes((1, 2, 3, 4, 0.5, 1))
+
+        restored = Boxes.from_json(boxes.to_json({}))
+
+        np.testing.assert_allclose(restored.xyxy, boxes.xyxy)
+        np.testing.assert_allclose(restored.conf, boxes.conf)
+        np.testing.assert_allclose(restored.cls, boxes.cls)
+
+    def test_indexing(self):
+        boxes = make_boxes((1, 2, 3, 4, 0.5, 1), (5, 6, 7, 8, 0.25, 0))
+
+        self.assertEqual(boxes[1], BoxPredict(cls=0.0, conf=0.25, xyxy=[5.0, 6.0, 7.0, 8.0]))
+        self.assertEqual(len(boxes[boxes.conf > 0.3]), 1)
+        np.testing.assert_allclose(boxes.shift(10, 20).xyxy[0], [11, 22, 13, 24])
+
+
+class BoxIoUTests(SimpleTestCase):
+    def test_pairwise_iou(self):
+        iou = box_iou([[0, 0, 10, 10]], [[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]])
+
+        np.testing.assert_allclose(iou, [[1.0, 1 / 3, 0.0]], rtol=1e-6)
+
+
+class IoUTrackerTests(SimpleTestCase):
+    def test_predict_moves_tracks_with_their_velocity(self):
+        tracker = IoUTracker()
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+        tracker.update(2, make_boxes((10, 0, 110, 100, 0.8, 1)))
+
+        boxes = tracker.predict(3)
+
+        np.testing.assert_allclose(boxes.xyxy, [[15, 0, 115, 100]])
+        np.testing.assert_allclose(boxes.conf, [0.8])
+        np.testing.assert_allclose(boxes.cls, [1])
+
+    def test_new_track_stands_still(self):
+        tracker = IoUTracker()
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+
+        np.testing.assert_allclose(tracker.predict(5).xyxy, [[0, 0, 100, 100]])
+
+    def test_detections_of_another_class_are_not_associated(self):
+        tracker = IoUTracker()
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+        tracker.update(1, make_boxes((10, 0, 110, 100, 0.9, 2)))
+
+        np.testing.assert_allclose(tracker.predict(2).xyxy, [[10, 0, 110, 100]])
+
+    def test_low_iou_detections_start_new_tracks(self):
+        tracker = IoUTracker(iou_threshold=0.3)
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+        tracker.update(1, make_boxes((90, 0, 190, 100, 0.9, 1)))
+
+        np.testing.assert_allclose(tracker.predict(2).xyxy, [[90, 0, 190, 100]])
+
+    def test_tracks_expire_after_max_age(self):
+        tracker = IoUTracker(max_age=3)
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+
+        self.assertEqual(len(tracker.predict(3)), 1)
+        self.assertEqual(len(tracker.predict(4)), 0)
+
+    def test_empty_detections_clear_the_tracks(self):
+        tracker = IoUTracker()
+        tracker.update(0, make_boxes((0, 0, 100, 100, 0.9, 1)))
+        tracker.update(1, Boxes.empty())
+
+        self.assertEqual(len(tracker.predict(2)), 0)
+
+
+class ResultCacheTests(SimpleTestCase):
+    def test_make_key_depends_on_model_and_options(self):
+        key = ResultCache.make_key('digest', 'v1', conf=0.25)
+
+        self.assertEqual(key, ResultCache.make_key('digest', 'v1', conf=0.25))
+        self.assertNotEqual(key, ResultCache.make_key('digest', 'v2', conf=0.25))
+        self.assertNotEqual(key, ResultCache.make_key('digest', 'v1', conf=0.5))
+
+    def test_get_returns_cached_entry(self):
+        cache = ResultCache()
+        entry = CacheEntry(boxes=[{'cls': 0}], cls_names={0: 'gun'}, artifact=b'jpeg')
+        cache.set('a', entry)
+
+        self.assertEqual(cache.get('a'), entry)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResultCache(max_entries=2)
+        cache.set('a', CacheEntry())
+        cache.set('b', CacheEntry())
+        cache.get('a')
+        cache.set('c', CacheEntry())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_entries_are_evicted_above_max_bytes(self):
+        # Every entry takes 100 bytes of artifact and 2 of boxes
+        cache = ResultCache(max_bytes=250)
+        for key in 'abc':
+            cache.set(key, CacheEntry(artifact=b'x' * 100))
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_replacing_an_entry_frees_its_bytes(self):
+        cache = ResultCache(max_bytes=250)
+        cache.set('a', CacheEntry(artifact=b'x' * 100))
+        cache.set('b', CacheEntry(artifact=b'x' * 100))
+        cache.set('b', CacheEntry(artifact=b'y' * 100))
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.get('b').artifact, b'y' * 100)
+
+    def test_large_artifacts_are_not_cached(self):
+        cache = ResultCache(max_artifact_bytes=10)
+        cache.set('a', CacheEntry(boxes=[1], artifact=b'x' * 11))
+
+        entry = cache.get('a')
+        self.assertEqual(entry.boxes, [1])
+        self.assertIsNone(entry.artifact)
+
+    def test_entries_expire_after_ttl(self):
+        cache = ResultCache(ttl=10)
+        with mock.patch('weapondetectapp.cache.time.monotonic', return_value=100.0):
+            cache.set('a', CacheEntry())
+        with mock.patch('weapondetectapp.cache.time.monotonic', return_value=109.0):
+            self.assertIsNotNone(cache.get('a'))
+        with mock.patch('weapondetectapp.cache.time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get('a'))
+
+    @mock.patch('builtins.print')
+    def test_unavailable_redis_falls_back_to_local_cache(self, print_mock):
+        cache = ResultCache(redis_url='redis://127.0.0.1:1/0', retry_after=60)
+        cache.set('a', CacheEntry(boxes=[1]))
+
+        self.assertEqual(cache.get('a').boxes, [1])
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache._remote())
+        # The outage is reported once
+        print_mock.assert_called_once()
+
+
+class ClassMetricsTests(SimpleTestCase):
+    def test_perfect_predictions(self):
+        metrics = class_metrics([make_boxes((0, 0, 10, 10, 0.9, 0))], [make_boxes((0, 0, 10, 10, 1, 0))], [0])
+
+        self.assertEqual(metrics, ClassMetrics(recall=1.0, ap50=1.0, true_boxes=1))
+
+    def test_recall_is_measured_at_the_confidence_threshold(self):
+        metrics = class_metrics(
+            [make_boxes((0, 0, 10, 10, 0.1, 0))], [make_boxes((0, 0, 10, 10, 1, 0))], [0], conf=0.25)
+
+        self.assertEqual(metrics.recall, 0.0)
+        self.assertEqual(metrics.ap50, 1.0)
+
+    def test_true_box_is_matched_once(self):
+        predictions = [make_boxes((0, 0, 10, 10, 0.9, 0), (0, 0, 10, 10, 0.8, 0))]
+
+        metrics = class_metrics(predictions, [make_boxes((0, 0, 10, 10, 1, 0))], [0])
+
+        self.assertEqual(metrics.recall, 1.0)
+        self.assertEqual(metrics.ap50, 1.0)
+
+    def test_confident_false_positive_lowers_ap(self):
+        predictions = [make_boxes((50, 50, 60, 60, 0.9, 0), (0, 0, 10, 10, 0.8, 0))]
+
+        metrics = class_metrics(predictions, [make_boxes((0, 0, 10, 10, 1, 0))], [0])
+
+        self.assertEqual(metrics.recall, 1.0)
+        self.assertAlmostEqual(metrics.ap50, 0.5)
+
+    def test_low_iou_prediction_is_a_miss(self):
+        metrics = class_metrics(
+            [make_boxes((5, 0, 15, 10, 0.9, 0))], [make_boxes((0, 0, 10, 10, 1, 0))], [0], iou_threshold=0.5)
+
+        self.assertEqual(metrics, ClassMetrics(recall=0.0, ap50=0.0, true_boxes=1))
+
+    def test_only_the_measured_classes_count(self):
+        predictions = [make_boxes((0, 0, 10, 10, 0.9, 0)), make_boxes((0, 0, 10, 10, 0.9, 2))]
+        truths = [make_boxes((0, 0, 10, 10, 1, 0), (20, 20, 30, 30, 1, 1)), make_boxes((0, 0, 10, 10, 1, 2))]
+
+        metrics = class_metrics(predictions, truths, [0, 2])
+
+        self.assertEqual(metrics, ClassMetrics(recall=1.0, ap50=1.0, true_boxes=2))
+
+    def test_class_without_true_boxes(self):
+        metrics = class_metrics([make_boxes((0, 0, 10, 10, 0.9, 0))], [Boxes.empty()], [0])
+
+        self.assertEqual(metrics, ClassMetrics())
+
+
+class ResolveQuantizedModelPathTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.weights_path = os.path.join(self.folder.name, 'best.pt')
+        with open(self.weights_path, 'wb') as f:
+            f.write(b'weights')
+
+    def save_manifest(self, **kwargs):
+        manifest = QuantizationManifest(
+            model='best_int8.onnx', mode='static', source_version=file_digest(self.weights_path),
+            class_name='gun', reference=ClassMetrics(recall=0.9), quantized=ClassMetrics(recall=0.88),
+            max_recall_drop=0.03, activated=True,
+        )
+        for name, value in kwargs.items():
+            setattr(manifest, name, value)
+        manifest.save(manifest_path(self.weights_path))
+
+    def test_activated_model_of_current_weights(self):
+        self.save_manifest()
+
+        self.assertEqual(resolve_quantized_model_path(self.weights_path),
+                         os.path.join(self.folder.name, 'best_int8.onnx'))
+        self.assertAlmostEqual(QuantizationManifest.load(manifest_path(self.weights_path)).recall_drop, 0.02)
+
+    @mock.patch('builtins.print')
+    def test_missing_manifest(self, print_mock):
+        self.assertIsNone(resolve_quantized_model_path(self.weights_path))
+
+    @mock.patch('builtins.print')
+    def test_model_that_failed_the_gate(self, print_mock):
+        self.save_manifest(activated=False)
+
+        self.assertIsNone(resolve_quantized_model_path(self.weights_path))
+
+    @mock.patch('builtins.print')
+    def test_model_of_other_weights(self, print_mock):
+        self.save_manifest(source_version='0' * 64)
+
+        self.assertIsNone(resolve_quantized_model_path(self.weights_path))
+
+
+class ResolveModelPathTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.weights_path = os.path.join(self.folder.name, 'best.pt')
+        with open(self.weights_path, 'wb') as f:
+            f.write(b'weights')
+        self.onnx_path = artifact_path(self.weights_path, 'onnx')
+        with open(self.onnx_path, 'wb') as f:
+            f.write(b'onnx')
+
+    def test_checked_model_of_current_weights(self):
+        mark_verified(self.weights_path, 'onnx')
+
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.onnx_path)
+
+    @mock.patch('builtins.print')
+    def test_unchecked_model(self, print_mock):
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.weights_path)
+
+    @mock.patch('builtins.print')
+    def test_model_checked_against_other_weights(self, print_mock):
+        mark_verified(self.weights_path, 'onnx')
+        with open(self.weights_path, 'wb') as f:
+            f.write(b'other weights')
+        os.utime(self.onnx_path)
+
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.weights_path)
+
+
+@mock.patch('builtins.print')
+class ExportDetectorCommandTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.weights_path = os.path.join(self.folder.name, 'best.pt')
+        with open(self.weights_path, 'wb') as f:
+            f.write(b'weights')
+        self.images = os.path.join(self.folder.name, 'images')
+        os.mkdir(self.images)
+
+        patcher = mock.patch(
+            'weapondetectapp.management.commands.export_detector.export_model', side_effect=self.export)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def export(self, weights_path, backend, **kwargs):
+        path = artifact_path(weights_path, backend)
+        with open(path, 'wb') as f:
+            f.write(b'onnx')
+        return path
+
+    def call(self, *args):
+        call_command('export_detector', '--weights', self.weights_path, '--images', self.images, *args,
+                     stdout=io.StringIO())
+
+    def test_skipped_check_does_not_activate_the_model(self, print_mock):
+        self.call('--skip-check')
+
+        self.assertTrue(os.path.exists(artifact_path(self.weights_path, 'onnx')))
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.weights_path)
+
+    def test_model_without_images_to_check_is_not_activated(self, print_mock):
+        with self.assertRaises(CommandError):
+            self.call()
+
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.weights_path)
+
+    @mock.patch('weapondetectapp.management.commands.export_detector.TerroristDetector')
+    def test_model_that_matches_pytorch_is_activated(self, detector_mock, print_mock):
+        write_image(os.path.join(self.images, 'a.jpg'))
+        detector_mock.list_images = TerroristDetector.list_images
+        detector_mock.return_value.predict_batch.return_value = [
+            SimpleNamespace(boxes=make_boxes((0, 0, 10, 10, 0.9, 1)))]
+
+        self.call()
+
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), artifact_path(self.weights_path, 'onnx'))
+
+    def test_reexport_deactivates_the_model_until_it_is_checked(self, print_mock):
+        mark_verified(self.weights_path, 'onnx')
+
+        self.call('--skip-check', '--force')
+
+        self.assertEqual(resolve_model_path(self.weights_path, 'onnx'), self.weights_path)
+
+
+class ImageShapeTests(SimpleTestCase):
+    def test_shape_is_read_without_leaving_the_file_open(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'image.png')
+            cv2.imwrite(path, np.zeros((20, 30, 3), dtype=np.uint8))
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                self.assertEqual(image_shape(path), (20, 30))
+                gc.collect()
+
+        self.assertFalse([warning for warning in caught if issubclass(warning.category, ResourceWarning)])
+
+
+class BenchmarkRegressionTests(SimpleTestCase):
+    def result(self, **kwargs):
+        values = dict(name='predict', resolution='640x480', runs=10, p50_ms=100.0, p95_ms=120.0,
+                      throughput=10.0, unit='images', peak_rss_mb=50.0)
+        values.update(kwargs)
+        return BenchmarkResult(**values)
+
+    def test_results_within_the_tolerance_pass(self):
+        baseline = {self.result().key: self.result()}
+
+        self.assertEqual(find_regressions([self.result(p50_ms=115.0, throughput=8.5, peak_rss_mb=70.0)], baseline), [])
+
+    def test_slowdown_and_memory_growth_are_reported(self):
+        baseline = {self.result().key: self.result()}
+
+        regressions = find_regressions([self.result(p95_ms=200.0, throughput=5.0, peak_rss_mb=100.0)], baseline)
+
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(all(regression.startswith('predict@640x480') for regression in regressions))
+
+    def test_results_without_baseline_are_skipped(self):
+        self.assertEqual(find_regressions([self.result(resolution='1920x1080', p50_ms=1e6)], {}), [])
+
+    def test_saved_results_load_by_key(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results.json')
+            save_results([self.result()], path, device='cpu')
+
+            self.assertEqual(load_results(path), {'predict@640x480': self.result()})
+
+
+class TilingTests(SimpleTestCase):
+    def test_make_tiles_covers_the_image_and_aligns_to_the_border(self):
+        self.assertEqual(make_tiles(1000, 700, tile_size=640, overlap=0.2), [
+            (0, 0, 640, 640), (360, 0, 1000, 640),
+            (0, 60, 640, 700), (360, 60, 1000, 700),
+        ])
+
+    def test_make_tiles_of_a_small_image(self):
+        self.assertEqual(make_tiles(300, 200, tile_size=640), [(0, 0, 300, 200)])
+
+    def test_select_tiles_near_regions(self):
+        tiles = make_tiles(1000, 700, tile_size=640, overlap=0.2)
+
+        # The region grown by half its size on each side reaches y=70, the lower tiles start at y=60
+        self.assertEqual(select_tiles(tiles, np.array([[10, 10, 50, 50]]), margin=0.5),
+                         [(0, 0, 640, 640), (0, 60, 640, 700)])
+        self.assertEqual(select_tiles(tiles, np.array([[900, 650, 950, 690]]), margin=0),
+                         [(360, 60, 1000, 700)])
+        self.assertEqual(select_tiles(tiles, np.zeros((0, 4))), [])
+
+    def test_cut_by_tile_marks_boxes_on_inner_borders(self):
+        xyxy = np.array([[360, 100, 400, 200], [500, 100, 600, 200], [900, 600, 1000, 640], [600, 0, 700, 100]])
+
+        cut = cut_by_tile(xyxy, (360, 0, 1000, 640), width=1000, height=700)
+
+        # Left and bottom borders of the tile are seams, top and right ones are the image border
+        self.assertEqual(cut.tolist(), [True, False, True, False])
+
+    def test_nms_keeps_the_most_confident_of_overlapping_boxes(self):
+        boxes = make_boxes((0, 0, 100, 100, 0.5, 0), (5, 5, 105, 105, 0.9, 0), (200, 200, 300, 300, 0.7, 0))
+
+        kept = nms(boxes, threshold=0.5)
+
+        np.testing.assert_allclose(kept.conf, [0.9, 0.7])
+
+    def test_nms_keeps_overlapping_boxes_of_other_classes(self):
+        boxes = make_boxes((0, 0, 100, 100, 0.9, 0), (0, 0, 100, 100, 0.8, 1))
+
+        self.assertEqual(len(nms(boxes)), 2)
+
+    def test_nms_ios_merges_cut_box_with_the_whole_one(self):
+        boxes = make_boxes((0, 0, 200, 100, 0.9, 0), (150, 0, 200, 100, 0.8, 0))
+
+        self.assertEqual(len(nms(boxes, metric='iou')), 2)
+        self.assertEqual(len(nms(boxes, metric='ios', cut=np.array([False, True]))), 1)
+
+    def test_nms_ios_keeps_small_box_inside_a_whole_one(self):
+        boxes = make_boxes((0, 0, 200, 100, 0.9, 0), (150, 0, 200, 100, 0.8, 0))
+
+        self.assertEqual(len(nms(boxes, metric='ios', cut=np.array([False, False]))), 2)
+        self.assertEqual(len(nms(boxes, metric='ios')), 1)
+
+    def test_nms_of_no_boxes(self):
+        self.assertEqual(len(nms(Boxes.empty())), 0)
+
+    def test_nms_rejects_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            nms(make_boxes((0, 0, 10, 10, 0.9, 0)), metric='giou')
+
+
+class MetricsTests(SimpleTestCase):
+    def test_exposition_of_counters_and_gauges(self):
+        metrics = MetricsRegistry()
+        requests = metrics.counter('requests_total', 'Handled requests', labelnames=('status',))
+        requests.inc(status='200')
+        requests.inc(2, status='500')
+        metrics.gauge('queue_depth', 'Queued tasks').set(3)
+
+        self.assertEqual(metrics.exposition(), (
+            '# HELP queue_depth Queued tasks\n'
+            '# TYPE queue_depth gauge\n'
+            'queue_depth 3\n'
+            '# HELP requests_total Handled requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{status="200"} 1\n'
+            'requests_total{status="500"} 2\n'
+        ))
+
+    def test_exposition_of_histograms(self):
+        metrics = MetricsRegistry()
+        seconds = metrics.histogram('seconds', 'Latency', labelnames=('stage',), buckets=(0.1, 1))
+        seconds.observe(0.05, stage='decode')
+        seconds.observe(0.5, stage='decode')
+        seconds.observe(2, stage='decode')
+
+        self.assertEqual(metrics.exposition().splitlines()[2:], [
+            'seconds_bucket{stage="decode",le="0.1"} 1',
+            'seconds_bucket{stage="decode",le="1"} 2',
+            'seconds_bucket{stage="decode",le="+Inf"} 3',
+            'seconds_sum{stage="decode"} 2.55',
+            'seconds_count{stage="decode"} 3',
+        ])
+        self.assertEqual(seconds.count(stage='decode'), 3)
+
+    def test_exposition_escapes_label_values(self):
+        metrics = MetricsRegistry()
+        metrics.counter('errors_total', 'Errors', labelnames=('message',)).inc(message='a "b"\\c\nd')
+
+        self.assertIn('errors_total{message="a \\"b\\"\\\\c\\nd"} 1', metrics.exposition())
+
+    def test_metrics_are_registered_once_by_name(self):
+        metrics = MetricsRegistry()
+        counter = metrics.counter('requests_total', 'Handled requests')
+
+        self.assertIs(metrics.counter('requests_total', 'Handled requests'), counter)
+        with self.assertRaises(ValueError):
+            metrics.gauge('requests_total', 'Handled requests')
+
+    def test_labels_must_match_labelnames(self):
+        counter = MetricsRegistry().counter('requests_total', 'Handled requests', labelnames=('status',))
+
+        with self.assertRaises(ValueError):
+            counter.inc(method='GET')
+
+    def test_record_stages_sums_spans_of_the_block(self):
+        with record_stages() as totals:
+            with span('decode'):
+                pass
+            with span('decode'):
+                pass
+
+        self.assertEqual(list(totals), ['decode'])
+        self.assertGreaterEqual(totals['decode'], 0.0)
+
+    def test_metrics_view(self):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE weapondetect_stage_seconds histogram', response.content.decode())
+
+    @override_settings(WEAPONDETECT_METRICS_ENABLED=False)
+    def test_metrics_view_disabled(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+class ConcatVideosTests(SimpleTestCase):
+    size = (64, 48)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def write_segment(self, name: str, frames: int, value: int) -> str:
+        path = os.path.join(self.folder.name, name)
+        out = open_video_writer(path, 25, self.size)
+        for _ in range(frames):
+            out.write(np.full((self.size[1], self.size[0], 3), value, dtype=np.uint8))
+        out.close()
+        return path
+
+    def read_frames(self, path: str):
+        reader = open_video_reader(path)
+        frames = []
+        while (frame := reader.read()) is not None:
+            frames.append(frame)
+        fps, size = reader.fps, reader.size
+        reader.close()
+        return frames, fps, size
+
+    def concat(self):
+        paths = [self.write_segment('0.mp4', 5, 0), self.write_segment('1.mp4', 7, 255)]
+        output_path = os.path.join(self.folder.name, 'joined.mp4')
+        concat_videos(paths, output_path)
+        return self.read_frames(output_path)
+
+    @skipUnless(has_pyav(), 'needs PyAV with libx264')
+    def test_segments_are_joined_in_order(self):
+        frames, fps, size = self.concat()
+
+        self.assertEqual(len(frames), 12)
+        self.assertEqual((fps, size), (Fraction(25), self.size))
+        # The packets are copied, so the frames keep the content of their segment
+        self.assertLess(frames[4].mean(), 32)
+        self.assertGreater(frames[5].mean(), 224)
+
+    @mock.patch('builtins.print')
+    @mock.patch('weapondetectapp.videoio.has_pyav', return_value=False)
+    def test_segments_are_joined_without_pyav(self, has_pyav_mock, print_mock):
+        frames, fps, size = self.concat()
+
+        self.assertEqual(len(frames), 12)
+        self.assertEqual(size, self.size)
+
+
+class VideoMetadataTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.path = os.path.join(self.folder.name, 'video.mp4')
+
+    def write_video(self, frames: int, fps: float):
+        out = open_video_writer(self.path, fps, (64, 48))
+        for _ in range(frames):
+            out.write(np.zeros((48, 64, 3), dtype=np.uint8))
+        out.close()
+
+    @skipUnless(has_pyav(), 'needs PyAV with libx264')
+    def test_metadata_is_read_with_pyav(self):
+        self.write_video(12, 30000 / 1001)
+
+        self.assertEqual(count_frames(self.path), 12)
+        self.assertAlmostEqual(video_fps(self.path), 29.97, places=2)
+
+    @mock.patch('builtins.print')
+    @mock.patch('weapondetectapp.videoio.has_pyav', return_value=False)
+    def test_metadata_is_read_without_pyav(self, has_pyav_mock, print_mock):
+        self.write_video(12, 25)
+
+        self.assertEqual(count_frames(self.path), 12)
+        self.assertEqual(video_fps(self.path), 25.0)
+
+    def test_unreadable_video(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a video')
+
+        self.assertEqual((count_frames(self.path), video_fps(self.path)), (0, 0.0))
+
+
+class GetDetectorTests(SimpleTestCase):
+    @mock.patch('weapondetectapp.utils.TerroristDetector')
+    @mock.patch('weapondetectapp.pool.get_inference_pool')
+    def test_pool_is_not_built_when_passed(self, get_inference_pool_mock, detector_mock):
+        get_detector(model_path='best.pt', pool=None)
+
+        get_inference_pool_mock.assert_not_called()
+        self.assertIsNone(detector_mock.call_args.kwargs['pool'])
+
+    @mock.patch('weapondetectapp.utils.TerroristDetector')
+    @mock.patch('weapondetectapp.pool.get_inference_pool')
+    def test_pool_is_built_by_default(self, get_inference_pool_mock, detector_mock):
+        get_detector(model_path='best.pt')
+
+        get_inference_pool_mock.assert_called_once()
+        self.assertIs(detector_mock.call_args.kwargs['pool'], get_inference_pool_mock.return_value)
+
+
+class QueueImagesTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('tester')
+        self.images = [Image.objects.create(user=user, image=f'images/tester/{i}.jpg', name=f'{i}.jpg')
+                       for i in range(3)]
+
+    @override_settings(WEAPONDETECT_BATCH_SIZE=2)
+    @mock.patch('weapondetectapp.views.process_predict_images.delay')
+    def test_images_are_sent_in_batches_after_commit(self, delay_mock):
+        with self.captureOnCommitCallbacks() as callbacks:
+            image_predicts = queue_images(self.images)
+            # The worker must not see the rows before they are committed
+            delay_mock.assert_not_called()
+
+        for callback in callbacks:
+            callback()
+
+        pks = [image_predict.pk for image_predict in image_predicts]
+        self.assertEqual(delay_mock.call_args_list, [mock.call(pks[:2]), mock.call(pks[2:])])
+        self.assertTrue(all(image_predict.status == ImagePredict.Status.QUEUED for image_predict in image_predicts))
+
+
+class ProcessPredictImagesTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('tester')
+        self.image_predicts = [
+            ImagePredict.objects.create(
+                image_original=Image.objects.create(user=user, image=f'images/tester/{i}.jpg'),
+                image_predict=f'images_predict/tester/{i}.jpg',
+            )
+            for i in range(2)
+        ]
+
+    @mock.patch('builtins.print')
+    @mock.patch('weapondetectapp.tasks._save_thumbnails')
+    @mock.patch('weapondetectapp.tasks.get_detector')
+    def test_broken_image_fails_only_itself(self, get_detector_mock, save_thumbnails_mock, print_mock):
+        detector = get_detector_mock.return_value
+        result = mock.Mock()
+        result.boxes_to_json.return_value = [{'cls': 0}]
+        # The batch leaves the second image to a single prediction, which fails
+        detector.predict_batch.return_value = [result, None]
+        detector.predict.side_effect = ValueError('broken image')
+
+        process_predict_images([image_predict.pk for image_predict in self.image_predicts])
+
+        done, failed = [ImagePredict.objects.get(pk=image_predict.pk) for image_predict in self.image_predicts]
+        self.assertEqual((done.status, done.boxes), (ImagePredict.Status.DONE, [{'cls': 0}]))
+        self.assertEqual(failed.status, ImagePredict.Status.FAILED)
+
+
+@override_settings(WEAPONDETECT_CACHE_ENABLED=False, WEAPONDETECT_PROGRESS_ENABLED=False,
+                   WEAPONDETECT_ALERTS_ENABLED=False, WEAPONDETECT_VIDEO_SEGMENT_FRAMES=100)
+class VideoStatusTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('tester')
+        self.video_predict = VideoPredict.objects.create(
+            video_original=Video.objects.create(user=user, video='videos/tester/v.mp4'),
+            video_predict='videos_predict/tester/v.mp4',
+        )
+        self.segments_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.segments_dir, ignore_errors=True)
+
+    def status(self) -> str:
+        return VideoPredict.objects.get(pk=self.video_predict.pk).status
+
+    def process(self):
+        process_predict_video('/media/v.mp4', self.video_predict.pk, '/media/out.mp4')
+
+    @mock.patch('weapondetectapp.tasks.count_frames', return_value=10)
+    @mock.patch('weapondetectapp.tasks.get_detector')
+    def test_single_run_is_done(self, get_detector_mock, count_frames_mock):
+        self.assertEqual(self.status(), VideoPredict.Status.QUEUED)
+
+        self.process()
+
+        self.assertEqual(self.status(), VideoPredict.Status.DONE)
+        self.assertEqual(VideoPredict.objects.get(pk=self.video_predict.pk).boxes['count'], 0)
+
+    @mock.patch('weapondetectapp.tasks.count_frames', return_value=10)
+    @mock.patch('weapondetectapp.tasks.get_detector')
+    def test_single_run_fails_when_prediction_fails(self, get_detector_mock, count_frames_mock):
+        get_detector_mock.return_value.predict_video.side_effect = ValueError('broken video')
+
+        with self.assertRaises(ValueError):
+            self.process()
+
+        self.assertEqual(self.status(), VideoPredict.Status.FAILED)
+
+    @mock.patch('weapondetectapp.tasks._save_video_track', side_effect=OSError('disk full'))
+    @mock.patch('weapondetectapp.tasks.count_frames', return_value=10)
+    @mock.patch('weapondetectapp.tasks.get_detector')
+    def test_single_run_fails_when_detections_cannot_be_saved(self, get_detector_mock, count_frames_mock,
+                                                              save_video_track_mock):
+        with self.assertRaises(OSError):
+            self.process()
+
+        self.assertEqual(self.status(), VideoPredict.Status.FAILED)
+
+    @mock.patch('weapondetectapp.tasks.concat_videos', side_effect=OSError('disk full'))
+    def test_failed_merge_fails_the_video_and_deletes_the_segments(self, concat_videos_mock):
+        with self.assertRaises(OSError):
+            merge_video_segments(['0.mp4'], '/media/out.mp4', self.segments_dir, self.video_predict.pk)
+
+        self.assertEqual(self.status(), VideoPredict.Status.FAILED)
+        self.assertFalse(os.path.exists(self.segments_dir))
+
+    @mock.patch('builtins.print')
+    def test_failed_segment_fails_the_video_and_deletes_the_segments(self, print_mock):
+        fail_video_segments(None, ValueError('broken segment'), None,
+                            video_predict_pk=self.video_predict.pk, segments_dir=self.segments_dir)
+
+        self.assertEqual(self.status(), VideoPredict.Status.FAILED)
+        self.assertFalse(os.path.exists(self.segments_dir))
+
+
+def write_image(path: str, size: int = 32) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, np.zeros((size, size, 3), dtype=np.uint8))
+    return path
+
+
+class DetectRequestSerializerTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('tester')
+        other = User.objects.create_user('other')
+        for user, name in ((self.user, 'images/tester/a.jpg'), (other, 'images/other/b.jpg')):
+            write_image(os.path.join(settings.MEDIA_ROOT, name))
+            Image.objects.create(user=user, image=name)
+
+    def validate(self, paths, user=None):
+        request = SimpleNamespace(user=user or self.user)
+        serializer = DetectRequestSerializer(data={'paths': paths}, context={'request': request})
+        return serializer.is_valid(), serializer
+
+    def test_own_image_is_resolved(self):
+        valid, serializer = self.validate([settings.MEDIA_URL + 'images/tester/a.jpg'])
+
+        self.assertTrue(valid, serializer.errors)
+        self.assertEqual(serializer.validated_data['paths'], [
+            (settings.MEDIA_URL + 'images/tester/a.jpg',
+             os.path.join(os.path.realpath(settings.MEDIA_ROOT), 'images/tester/a.jpg')),
+        ])
+
+    def test_image_of_another_user_is_rejected(self):
+        valid, serializer = self.validate(['images/other/b.jpg'])
+
+        self.assertFalse(valid)
+        self.assertIn('not one of yours', str(serializer.errors['paths']))
+
+    def test_path_outside_the_media_storage_is_rejected(self):
+        valid, serializer = self.validate(['../images/tester/a.jpg'])
+
+        self.assertFalse(valid)
+        self.assertIn('outside the media storage', str(serializer.errors['paths']))
+
+    def test_paths_need_an_authenticated_user(self):
+        serializer = DetectRequestSerializer(data={'paths': ['images/tester/a.jpg']})
+
+        self.assertFalse(serializer.is_valid())
+
+    def test_empty_request_is_rejected(self):
+        valid, _ = self.validate([])
+
+        self.assertFalse(valid)
+
+
+class ImageStatusViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester')
+        self.client.force_login(self.user)
+        self.image_predict = ImagePredict.objects.create(
+            image_original=Image.objects.create(user=self.user, image='images/tester/a.jpg'),
+            image_predict='images_predict/tester/a.jpg',
+        )
+
+    def test_ids_are_required(self):
+        self.assertEqual(self.client.get(reverse('image-status')).status_code, 400)
+
+    @override_settings(WEAPONDETECT_LIST_PAGE_SIZE=2)
+    def test_at_most_a_page_of_ids(self):
+        response = self.client.get(reverse('image-status'), {'ids': '1,2,3'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_statuses_of_own_predictions(self):
+        other = User.objects.create_user('other')
+        other_predict = ImagePredict.objects.create(
+            image_original=Image.objects.create(user=other, image='images/other/b.jpg'),
+            image_predict='images_predict/other/b.jpg',
+        )
+
+        response = self.client.get(
+            reverse('image-status'), {'ids': f'{self.image_predict.pk},{other_predict.pk}'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(image['id'], image['status']) for image in response.json()['images']],
+                         [(self.image_predict.pk, ImagePredict.Status.QUEUED)])
+
+
+@override_settings(WEAPONDETECT_MICROBATCH_ENABLED=False)
+class DetectAPIViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester')
+        _, image = cv2.imencode('.jpg', np.zeros((32, 32, 3), dtype=np.uint8))
+        self.image = image.tobytes()
+
+    async def detect(self, files):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.post(reverse('api-detect'), {'files': files})
+        lines = [line async for line in response.streaming_content] if response.streaming else []
+        return response, b''.join(lines)
+
+    @mock.patch('weapondetectapp.views.get_detector')
+    async def test_one_line_per_image_is_streamed(self, get_detector_mock):
+        result = mock.Mock()
+        result.boxes_to_json.return_value = [{'cls': 0, 'name': 'gun', 'conf': 0.9, 'xyxy': [1, 2, 3, 4]}]
+        get_detector_mock.return_value.predict_batch.return_value = [result]
+
+        response, content = await self.detect([
+            SimpleUploadedFile('a.jpg', self.image), SimpleUploadedFile('b.txt', b'not an image'),
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in content.splitlines()], [
+            {'index': 1, 'name': 'b.txt', 'error': 'File is not an image'},
+            {'index': 0, 'name': 'a.jpg', 'boxes': result.boxes_to_json.return_value},
+        ])
+
+    async def test_full_executor_rejects_the_request(self):
+        executor = InferenceExecutor(max_workers=1, max_pending=1)
+        self.addCleanup(executor.shutdown)
+        reservation = executor.reserve()
+
+        with mock.patch('weapondetectapp.views.get_inference_executor', return_value=executor):
+            response, _ = await self.detect([SimpleUploadedFile('a.jpg', self.image)])
+
+        self.assertEqual(response.status_code, 429)
+        reservation.release()
+        self.assertEqual(executor.pending, 0)
+
+
+class InferenceExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = InferenceExecutor(max_workers=1, max_pending=1)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_submit_fails_when_full_and_frees_the_slot_when_done(self):
+        event = threading.Event()
+        future = self.executor.submit(event.wait)
+
+        with self.assertRaises(ExecutorBusy):
+            self.executor.submit(event.wait)
+
+        event.set()
+        future.result()
+        self.executor.shutdown(wait=True)
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_reservation_holds_the_slot_for_all_its_tasks(self):
+        async def run():
+            async with self.executor.reserve() as reservation:
+                self.assertEqual(await reservation.run(sum, [1, 2]), 3)
+                self.assertEqual(await reservation.run(sum, [3, 4]), 7)
+                self.assertEqual(self.executor.pending, 1)
+                with self.assertRaises(ExecutorBusy):
+                    self.executor.reserve()
+
+        asyncio.run(run())
+
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_reservation_is_released_once(self):
+        reservation = self.executor.reserve()
+
+        reservation.release()
+        reservation.release()
+
+        self.assertEqual(self.executor.pending, 0)
+        with self.assertRaises(RuntimeError):
+            asyncio.run(reservation.run(int))
+
+    def test_abandoned_task_keeps_the_slot_until_it_ends(self):
+        event = threading.Event()
+        reservation = self.executor.reserve()
+
+        async def run():
+            # The client goes away while its task runs
+            task = asyncio.ensure_future(reservation.run(event.wait))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            reservation.release()
+
+        asyncio.run(run())
+        self.assertEqual(self.executor.pending, 1)
+
+        event.set()
+        # The slot is released by a callback of the task, after its thread ends
+        self.executor.shutdown(wait=True)
+        self.assertEqual(self.executor.pending, 0)
+
+
+class ReservedStreamTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = InferenceExecutor(max_workers=1, max_pending=1)
+        self.addCleanup(self.executor.shutdown)
+
+    async def lines(self, reservation):
+        async with reservation:
+            yield b'line'
+
+    def test_stream_never_started_is_released_on_close(self):
+        reservation = self.executor.reserve()
+        response = StreamingHttpResponse(ReservedStream(reservation, self.lines(reservation)))
+
+        response.close()
+
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_stream_never_started_is_released_when_dropped(self):
+        reservation = self.executor.reserve()
+        stream = ReservedStream(reservation, self.lines(reservation))
+
+        del stream
+        gc.collect()
+
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_consumed_stream_is_released(self):
+        reservation = self.executor.reserve()
+        stream = ReservedStream(reservation, self.lines(reservation))
+
+        async def consume():
+            return [line async for line in stream]
+
+        self.assertEqual(asyncio.run(consume()), [b'line'])
+        self.assertEqual(self.executor.pending, 0)
+
+
+class FakeDetector:
+    """
+    Detector recording its batches, the results are the sources themselves.
+    """
+
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.batches = []
+
+    def predict_batch(self, sources, batch_size=1):
+        self.batches.append(list(sources))
+        if self.broken.intersection(sources):
+            raise ValueError('broken image')
+        return [f'result of {source}' for source in sources]
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_full_batch_is_flushed_without_waiting(self):
+        detector = FakeDetector()
+        batcher = MicroBatcher(lambda: detector, max_batch_size=2, max_latency=10)
+
+        started = time.monotonic()
+        results = batcher.predict_many(['a', 'b', 'c', 'd'], timeout=5)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(results, ['result of a', 'result of b', 'result of c', 'result of d'])
+        self.assertEqual(detector.batches, [['a', 'b'], ['c', 'd']])
+
+    def test_partial_batch_is_flushed_after_max_latency(self):
+        detector = FakeDetector()
+        batcher = MicroBatcher(lambda: detector, max_batch_size=8, max_latency=0.01)
+
+        self.assertEqual(batcher.predict('a', timeout=5), 'result of a')
+        self.assertEqual(detector.batches, [['a']])
+
+    def test_broken_image_fails_only_itself(self):
+        detector = FakeDetector(broken=['b'])
+        batcher = MicroBatcher(lambda: detector, max_batch_size=2, max_latency=10)
+
+        results = batcher.predict_many(['a', 'b'], timeout=5)
+
+        self.assertEqual(results[0], 'result of a')
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(detector.batches, [['a', 'b'], ['a'], ['b']])
+
+    def test_detector_failure_fails_the_batch(self):
+        def get_detector():
+            raise OSError('no weights')
+
+        batcher = MicroBatcher(get_detector, max_batch_size=2, max_latency=10)
+
+        results = batcher.predict_many(['a', 'b'], timeout=5)
+
+        self.assertTrue(all(isinstance(result, OSError) for result in results))
+
+
+class SharedFrameRingTests(SimpleTestCase):
+    def setUp(self):
+        self.ring = SharedFrameRing(slots=2, slot_bytes=12)
+        self.addCleanup(self.ring.close)
+
+    def test_frame_is_shared_with_an_attached_ring(self):
+        frame = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+        slot, = self.ring.acquire(1)
+        descriptor = self.ring.write(slot, frame)
+
+        attached = SharedFrameRing(2, 12, name=self.ring.name)
+        try:
+            np.testing.assert_array_equal(attached.view(*descriptor), frame)
+        finally:
+            attached.close()
+
+    def test_slots_of_a_batch_are_taken_together(self):
+        self.ring.acquire(1)
+
+        with self.assertRaises(TimeoutError):
+            self.ring.acquire(2, timeout=0.01)
+        self.assertEqual(len(self.ring.acquire(1, timeout=0.01)), 1)
+
+    def test_released_slots_wake_a_waiting_batch(self):
+        slots = self.ring.acquire(2)
+        threading.Timer(0.05, self.ring.release, [slots]).start()
+
+        self.assertEqual(sorted(self.ring.acquire(2, timeout=5)), [0, 1])
+
+
+class InferencePoolTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A randomly initialized model finds boxes only at a very low threshold
+        cls.pool = InferencePool('yolov8n.yaml', workers=1, threads=1, slots=4, slot_bytes=64 * 64 * 3)
+        cls.addClassCleanup(cls.pool.close)
+        cls.frames = [np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)]
+
+    def test_batch_runs_with_the_options_of_the_caller(self):
+        low, = self.pool.predict_batch(self.frames, options={'conf': 0.0001})
+        default, = self.pool.predict_batch(self.frames)
+
+        self.assertGreater(len(low.boxes), 0)
+        # The options of a batch do not stay with the process
+        self.assertEqual(len(default.boxes), 0)
+        self.assertEqual(default.path, 'image0.jpg')
+        self.assertTrue(default.cls_names)
+
+    def test_unknown_options_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.pool.submit(self.frames, options={'imgsz': 320})
+
+
+class DrawBoundingBoxTests(SimpleTestCase):
+    def test_result_of_an_array_is_drawn_on_the_array(self):
+        detector = TerroristDetector('yolov8n.yaml')
+        image_predict = DetectorImagePredict(
+            source_predict=None, path='image0.jpg', name_file='image0.jpg', cls_names={1: 'gun'},
+            boxes=make_boxes((2, 2, 20, 20, 0.9, 1)), image=np.zeros((32, 48, 3), dtype=np.uint8),
+        )
+
+        with PILImage.open(detector.draw_bounding_box(image_predict)) as image:
+            self.assertEqual(image.size, (48, 32))
+            self.assertGreater(max(image.getextrema()[0]), 0)
+
+
+class CascadeTests(SimpleTestCase):
+    # Label maps of an exported main model and of a COCO gate model
+    MAIN_NAMES = {0: 'gun', 1: 'person'}
+    GATE_NAMES = {0: 'person', 1: 'bicycle'}
+
+    def setUp(self):
+        self.detector = TerroristDetector('yolov8n.yaml')
+        self.detector.cascade = True
+        self.detector.cascade_model_path = 'gate.onnx'
+        self.full_batches = []
+
+        patcher = mock.patch('weapondetectapp.utils.model_registry.get', return_value='gate model')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.detector._TerroristDetector__predict = self.predict
+
+    def predict(self, arrays, model=None, **options):
+        # Bright images show a person to the gate and a gun to the full pass
+        if model is None:
+            self.full_batches.append(len(arrays))
+        results = []
+        for i, array in enumerate(arrays):
+            rows = [[1, 1, 5, 5, 0.9, 0]] if array.any() else []
+            results.append(SimpleNamespace(
+                path=f'image{i}.jpg', names=self.GATE_NAMES if model else self.MAIN_NAMES,
+                boxes=SimpleNamespace(data=np.array(rows, dtype=np.float32).reshape(-1, 6)),
+            ))
+        return results
+
+    def test_only_images_with_people_get_the_full_pass(self):
+        person = np.full((8, 8, 3), 255, dtype=np.uint8)
+        empty = np.zeros((8, 8, 3), dtype=np.uint8)
+
+        escalated, skipped = self.detector.predict_batch([person, empty])
+
+        self.assertEqual(self.full_batches, [1])
+        self.assertEqual(escalated.boxes_to_json()[0]['name'], 'gun')
+        self.assertEqual(len(skipped.boxes), 0)
+        self.assertIsNone(skipped.source_predict)
+        self.assertEqual(skipped.cls_names, self.MAIN_NAMES)
+
+    def test_skipped_batch_takes_the_classes_of_the_detector(self):
+        skipped, = self.detector.predict_batch([np.zeros((8, 8, 3), dtype=np.uint8)])
+
+        self.assertEqual(self.full_batches, [])
+        self.assertEqual(len(skipped.boxes), 0)
+        self.assertEqual(skipped.cls_names, TerroristDetector.CLASS_NAMES)
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the Redis commands the progress store uses.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.lists = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.lists.pop(key, None)
+
+    def expire(self, key, ttl):
+        return True
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        values = self.hashes.setdefault(key, {})
+        values.update(mapping or {field: value})
+
+    def hsetnx(self, key, field, value):
+        values = self.hashes.setdefault(key, {})
+        if field in values:
+            return False
+        values[field] = value
+        return True
+
+    def hincrby(self, key, field, amount):
+        values = self.hashes.setdefault(key, {})
+        values[field] = int(values.get(field, 0)) + amount
+        return values[field]
+
+    def hgetall(self, key):
+        return {str(field).encode(): str(value).encode() for field, value in self.hashes.get(key, {}).items()}
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:end + 1]
+
+    def lrange(self, key, start, end):
+        values = self.lists.get(key, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        results = [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+def frame_predict(index, *rows, inferred=True) -> FramePredict:
+    image_predict = SimpleNamespace(boxes=make_boxes(*rows), cls_names=TerroristDetector.CLASS_NAMES)
+    return FramePredict(index, np.zeros((64, 64, 3), dtype=np.uint8), image_predict, inferred)
+
+
+class ProgressStoreTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('weapondetectapp.progress.redis.Redis.from_url', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = ProgressStore('redis://fake')
+
+    def test_segments_add_up(self):
+        self.store.start(1, total_frames=100)
+        self.store.advance(1, 30, [[0, 1, 0.9, 0, 0, 5, 5, True]])
+        self.store.advance(1, 20, [[40, 1, 0.8, 0, 0, 5, 5, True]])
+
+        progress = self.store.get(1)
+        self.assertEqual((progress.state, progress.frames_done, progress.percent), ('running', 50, 50.0))
+        self.assertEqual([row[0] for row in self.store.detections(1)], [0, 40])
+        self.assertEqual([row[0] for row in self.store.detections(1, start=1)], [40])
+
+    def test_detections_of_a_retried_frame_are_added_once(self):
+        self.store.start(1, total_frames=100)
+        self.store.advance(1, 10, [[5, 1, 0.9, 0, 0, 5, 5, True]])
+        self.store.advance(1, 10, [[5, 1, 0.9, 0, 0, 5, 5, True], [12, 1, 0.9, 0, 0, 5, 5, True]])
+
+        self.assertEqual([row[0] for row in self.store.detections(1)], [5, 12])
+
+    def test_finished_video(self):
+        self.store.start(1, total_frames=100)
+        self.store.finish(1, 'failed')
+
+        self.assertEqual(self.store.get(1).state, 'failed')
+        self.assertIsNone(self.store.get(2))
+
+
+class ProgressReporterTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('weapondetectapp.progress.redis.Redis.from_url', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = ProgressStore('redis://fake')
+        self.store.start(1, total_frames=10)
+
+    def test_only_inferred_detections_are_published(self):
+        reporter = ProgressReporter(self.store, 1, interval=60)
+        reporter(frame_predict(0, (0, 0, 5, 5, 0.9, 1)))
+        reporter(frame_predict(1, (0, 0, 5, 5, 0.9, 1), inferred=False))
+
+        # Nothing is sent before the interval
+        self.assertEqual(self.store.get(1).frames_done, 0)
+        reporter.flush()
+
+        self.assertEqual(self.store.get(1).frames_done, 2)
+        self.assertEqual([row[0] for row in self.store.detections(1)], [0])
+
+    def test_rollback_takes_back_the_reported_frames(self):
+        reporter = ProgressReporter(self.store, 1, interval=0)
+        reporter(frame_predict(0, (0, 0, 5, 5, 0.9, 1)))
+        reporter(frame_predict(1))
+        reporter.rollback()
+
+        self.assertEqual(self.store.get(1).frames_done, 0)
+
+        # The retry reports the same frames without duplicating their detections
+        retry = ProgressReporter(self.store, 1, interval=0)
+        retry(frame_predict(0, (0, 0, 5, 5, 0.9, 1)))
+        retry(frame_predict(1))
+
+        self.assertEqual(self.store.get(1).frames_done, 2)
+        self.assertEqual(len(self.store.detections(1)), 1)
+
+
+@override_settings(WEAPONDETECT_PROGRESS_ENABLED=False)
+class ReadProgressTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('tester')
+        self.video_predict = VideoPredict.objects.create(
+            video_original=Video.objects.create(user=user, video='videos/tester/v.mp4'),
+            video_predict='videos_predict/tester/v.mp4',
+        )
+
+    def read_state(self, status) -> str:
+        VideoPredict.objects.filter(pk=self.video_predict.pk).update(status=status)
+        return VideoProgressMixin.read_progress(self.video_predict.pk)['state']
+
+    def test_state_without_progress_entry_follows_the_status(self):
+        self.assertEqual(self.read_state(VideoPredict.Status.QUEUED), 'queued')
+        self.assertEqual(self.read_state(VideoPredict.Status.RUNNING), 'running')
+
+    def test_failed_video(self):
+        self.assertEqual(self.read_state(VideoPredict.Status.FAILED), 'failed')
+
+    def test_done_video_without_detections(self):
+        VideoPredict.objects.filter(pk=self.video_predict.pk).update(status=VideoPredict.Status.DONE, boxes=[])
+
+        progress = VideoProgressMixin.read_progress(self.video_predict.pk)
+        self.assertEqual((progress['state'], progress['percent']), ('done', 100.0))
+
+
+class WeaponAlertEmitterTests(SimpleTestCase):
+    GUN = (10, 10, 30, 30, 0.9, 1)
+
+    def setUp(self):
+        self.stream = mock.Mock()
+        # Two inferred frames in a row, five seconds of video between alerts
+        self.emitter = WeaponAlertEmitter(self.stream, user_id=1, fps=10, video_predict_pk=7, min_frames=2, cooldown=5)
+
+    def alerted_frames(self):
+        return [call.args[0].frame for call in self.stream.publish.call_args_list]
+
+    def test_single_frame_does_not_alert(self):
+        for index, rows in enumerate([[self.GUN], [], [self.GUN], []]):
+            self.emitter(frame_predict(index, *rows))
+
+        self.stream.publish.assert_not_called()
+
+    def test_weapon_on_consecutive_frames_alerts_once_per_cooldown(self):
+        for index in range(0, 120):
+            self.emitter(frame_predict(index, self.GUN))
+
+        # Frame 1 completes the streak, every next alert is 5 seconds (50 frames) later
+        self.assertEqual(self.alerted_frames(), [1, 51, 101])
+        alert = self.stream.publish.call_args_list[0].args[0]
+        self.assertEqual((alert.cls_name, alert.conf, alert.timestamp, alert.video_predict_pk), ('gun', 0.9, 0.1, 7))
+        self.assertTrue(alert.thumbnail)
+
+    def test_tracked_frames_do_not_count(self):
+        self.emitter(frame_predict(0, self.GUN))
+        self.emitter(frame_predict(1, self.GUN, inferred=False))
+        self.stream.publish.assert_not_called()
+
+        self.emitter(frame_predict(2, self.GUN))
+        self.assertEqual(self.alerted_frames(), [2])
+
+    def test_low_confidence_and_other_classes_do_not_count(self):
+        for index in range(10):
+            self.emitter(frame_predict(index, (10, 10, 30, 30, 0.3, 1), (10, 10, 30, 30, 0.9, 0)))
+
+        self.stream.publish.assert_not_called()
+
+
+class LatestFrameReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def write_video(self, frames: int, fps: int = 200) -> str:
+        path = os.path.join(self.folder.name, 'camera.mp4')
+        out = open_video_writer(path, fps, (64, 48))
+        for value in range(frames):
+            out.write(np.full((48, 64, 3), value * 20, dtype=np.uint8))
+        out.close()
+        return path
+
+    def test_slow_consumer_gets_the_newest_frame(self):
+        reader = LatestFrameReader(self.write_video(10), loop=False)
+        reader.start()
+        self.addCleanup(reader.stop)
+
+        # Nobody takes the frames while the file is replayed
+        deadline = time.monotonic() + 10
+        while not reader.ended and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        index, frame, _ = reader.read(timeout=0)
+        self.assertEqual((index, frame.shape), (9, (48, 64, 3)))
+        self.assertEqual((reader.frames_read, reader.frames_dropped), (10, 9))
+        self.assertIsNone(reader.read(timeout=0))
+
+    def test_every_frame_is_taken_by_a_fast_consumer(self):
+        reader = LatestFrameReader(self.write_video(5, fps=20), loop=False)
+        reader.start()
+        self.addCleanup(reader.stop)
+
+        indices = []
+        while (item := reader.read(timeout=5)) is not None:
+            indices.append(item[0])
+
+        self.assertEqual(indices, [0, 1, 2, 3, 4])
+        self.assertEqual(reader.frames_dropped, 0)
+
+    @mock.patch('builtins.print')
+    def test_stop_does_not_wait_for_the_reconnect(self, print_mock):
+        reader = LatestFrameReader(os.path.join(self.folder.name, 'missing.mp4'), reconnect_delay=60)
+        reader.start()
+        started = time.monotonic()
+        reader.stop()
+
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertTrue(reader.ended)
+
+
+class SegmentWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.now = 0.0
+        self.names = iter(f'2024010{i}-000000' for i in range(1, 10))
+
+        clock = mock.Mock(monotonic=lambda: self.now, strftime=lambda _: next(self.names))
+        patcher = mock.patch('weapondetectapp.camera.time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def frame(self, width=64):
+        return np.zeros((48, width, 3), dtype=np.uint8)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.folder.name) if name.endswith('.mp4'))
+
+    def test_full_segment_is_finished_and_old_ones_pruned(self):
+        writer = SegmentWriter(self.folder.name, segment_seconds=10, retention=2)
+        finished = []
+        for second in range(0, 40, 5):
+            self.now = second
+            finished.append(writer.write(self.frame(), 25))
+        finished.append(writer.close())
+
+        self.assertEqual([os.path.basename(path) for path in finished if path],
+                         ['20240101-000000.mp4', '20240102-000000.mp4', '20240103-000000.mp4', '20240104-000000.mp4'])
+        self.assertEqual(self.segments(), ['20240103-000000.mp4', '20240104-000000.mp4'])
+
+    def test_new_resolution_starts_a_new_segment(self):
+        writer = SegmentWriter(self.folder.name, segment_seconds=60)
+        writer.write(self.frame(), 25)
+
+        self.assertTrue(writer.write(self.frame(width=32), 25).endswith('20240101-000000.mp4'))
+        writer.close()
+        self.assertEqual(len(self.segments()), 2)
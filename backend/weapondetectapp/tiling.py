@@ -0,0 +1,143 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from weapondetectapp.boxes import Boxes
+
+
+Tile = Tuple[int, int, int, int]
+
+
+def _axis_starts(length: int, tile_size: int, stride: int) -> List[int]:
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    # The last tile is aligned to the border instead of hanging over it
+    starts.append(length - tile_size)
+    return starts
+
+
+def make_tiles(width: int, height: int, tile_size: int = 640, overlap: float = 0.2) -> List[Tile]:
+    """
+    Split an image into overlapping square tiles covering it completely.
+
+    Args:
+        width: Image width.
+        height: Image height.
+        tile_size: Side of a tile in pixels.
+        overlap: Share of a tile covered by its neighbour, so objects on a border are whole in one of them.
+
+    Returns:
+        Tiles as (x1, y1, x2, y2) in image coordinates.
+    """
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in _axis_starts(height, tile_size, stride)
+        for x in _axis_starts(width, tile_size, stride)
+    ]
+
+
+def select_tiles(tiles: Sequence[Tile], regions: np.ndarray, margin: float = 0.5) -> List[Tile]:
+    """
+    Keep the tiles that intersect any region of interest.
+
+    Args:
+        tiles: Tiles as (x1, y1, x2, y2).
+        regions: Nx4 array of regions as (x1, y1, x2, y2), e.g. person boxes of a low-resolution pass.
+        margin: Share of its size every region is grown by on each side, a weapon is held next to the person.
+
+    Returns:
+        Tiles intersecting at least one grown region.
+    """
+    if not len(tiles) or not len(regions):
+        return []
+
+    regions = np.asarray(regions, dtype=np.float32)
+    size = regions[:, 2:] - regions[:, :2]
+    grown = np.concatenate([regions[:, :2] - size * margin, regions[:, 2:] + size * margin], axis=1)
+
+    tiles_array = np.asarray(tiles, dtype=np.float32)
+    intersects = (
+        (tiles_array[:, None, 0] < grown[None, :, 2]) & (tiles_array[:, None, 2] > grown[None, :, 0])
+        & (tiles_array[:, None, 1] < grown[None, :, 3]) & (tiles_array[:, None, 3] > grown[None, :, 1])
+    )
+    return [tile for tile, keep in zip(tiles, intersects.any(axis=1)) if keep]
+
+
+def cut_by_tile(xyxy: np.ndarray, tile: Tile, width: int, height: int, margin: float = 2.0) -> np.ndarray:
+    """
+    Find the boxes of a tile that touch one of its borders inside the image, i.e. a seam.
+
+    Such a box may be only the part of an object that is inside the tile.
+
+    Args:
+        xyxy: Nx4 boxes in image coordinates.
+        tile: Tile the boxes were predicted on, as (x1, y1, x2, y2).
+        width: Image width.
+        height: Image height.
+        margin: Distance in pixels from a border that still counts as touching it.
+
+    Returns:
+        Boolean mask of the cut boxes.
+    """
+    x1, y1, x2, y2 = tile
+    xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+    return (
+        ((x1 > 0) & (xyxy[:, 0] <= x1 + margin))
+        | ((y1 > 0) & (xyxy[:, 1] <= y1 + margin))
+        | ((x2 < width) & (xyxy[:, 2] >= x2 - margin))
+        | ((y2 < height) & (xyxy[:, 3] >= y2 - margin))
+    )
+
+
+def nms(boxes: Boxes, threshold: float = 0.5, metric: str = 'iou', cut: np.ndarray | None = None) -> Boxes:
+    """
+    Suppress overlapping boxes of the same class, keeping the most confident one.
+
+    Args:
+        boxes: Boxes to filter.
+        threshold: Overlap above which the less confident box is dropped.
+        metric: 'iou' for intersection over union, 'ios' for intersection over the smaller box,
+            which also merges a box cut by a tile border with the whole box from the neighbouring tile.
+        cut: Mask of the boxes cut by a tile border, see cut_by_tile. With it 'ios' is only used
+            for pairs with a cut box and all other pairs are compared by IoU, so a small object
+            next to or in front of a bigger one of the same class is not swallowed by it.
+
+    Returns:
+        Kept boxes, most confident first.
+    """
+    if metric not in ('iou', 'ios'):
+        raise ValueError(f'Unknown overlap metric {metric}, expected iou or ios')
+    if not len(boxes):
+        return boxes
+
+    order = np.argsort(-boxes.conf, kind='stable')
+    xyxy = boxes.xyxy[order]
+    cls = boxes.cls[order]
+    areas = np.prod(np.clip(xyxy[:, 2:] - xyxy[:, :2], 0, None), axis=1)
+    if metric == 'ios':
+        ios_pairs = np.ones(len(order), dtype=bool) if cut is None else np.asarray(cut, dtype=bool)[order]
+
+    keep = []
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+
+        rest = np.arange(i + 1, len(order))
+        rest = rest[~suppressed[rest] & (cls[rest] == cls[i])]
+        if not len(rest):
+            continue
+
+        top_left = np.maximum(xyxy[i, :2], xyxy[rest, :2])
+        bottom_right = np.minimum(xyxy[i, 2:], xyxy[rest, 2:])
+        inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+        overlap = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        if metric == 'ios':
+            ios = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-9)
+            overlap = np.where(ios_pairs[i] | ios_pairs[rest], ios, overlap)
+        suppressed[rest[overlap > threshold]] = True
+
+    return boxes[order[keep]]
@@ -0,0 +1,134 @@
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from weapondetectapp.boxes import Boxes
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Compute pairwise IoU of two sets of boxes.
+
+    Args:
+        boxes_a: Array of shape (N, 4) with xyxy boxes.
+        boxes_b: Array of shape (M, 4) with xyxy boxes.
+
+    Returns:
+        Array of shape (N, M) with IoU values.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).prod(axis=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).prod(axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+
+@dataclass
+class Track:
+    """
+    cls: Box class
+    conf: Confidence score of the last detection
+
+    xyxy: Coordinates of the box at the last detection
+    velocity: Change of the coordinates per frame
+    frame_index: Index of the frame of the last detection
+    """
+    cls: float
+    conf: float
+
+    xyxy: np.ndarray
+    velocity: np.ndarray
+    frame_index: int
+
+
+class IoUTracker:
+    """
+    Lightweight tracker carrying boxes forward between inferred frames.
+
+    Detections are associated with existing tracks of the same class by IoU,
+    and each track moves with the constant velocity measured between its last
+    two detections.
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_age: int = 30) -> None:
+        """
+        Args:
+            iou_threshold: Minimum IoU to associate a detection with a track.
+            max_age: Number of frames a track is carried forward without a detection.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.tracks: List[Track] = []
+
+    def update(self, frame_index: int, boxes: Boxes) -> None:
+        """
+        Replace the tracks with the detections of an inferred frame.
+
+        Args:
+            frame_index: Index of the inferred frame.
+            boxes: Bounding boxes detected on the frame.
+        """
+        previous = self.tracks
+        self.tracks = []
+        if not len(boxes):
+            return
+
+        detections = boxes.xyxy
+        iou = box_iou(detections, np.array([track.xyxy for track in previous])) \
+            if previous else np.zeros((len(boxes), 0), dtype=np.float32)
+
+        # Greedy association, best IoU first
+        matched = {}
+        for flat_index in np.argsort(-iou, axis=None):
+            i, j = np.unravel_index(flat_index, iou.shape)
+            if iou[i, j] < self.iou_threshold:
+                break
+            if i in matched or j in matched.values() or boxes.cls[i] != previous[j].cls:
+                continue
+            matched[i] = j
+
+        for i in range(len(boxes)):
+            velocity = np.zeros(4, dtype=np.float32)
+            if i in matched:
+                track = previous[matched[i]]
+                elapsed = frame_index - track.frame_index
+                if elapsed > 0:
+                    velocity = (detections[i] - track.xyxy) / elapsed
+
+            self.tracks.append(Track(
+                cls=float(boxes.cls[i]),
+                conf=float(boxes.conf[i]),
+                xyxy=detections[i],
+                velocity=velocity,
+                frame_index=frame_index,
+            ))
+
+    def predict(self, frame_index: int) -> Boxes:
+        """
+        Get the boxes of a frame that was not inferred.
+
+        Args:
+            frame_index: Index of the frame.
+
+        Returns:
+            Bounding boxes carried forward from the last inferred frame.
+        """
+        tracks = [track for track in self.tracks if frame_index - track.frame_index <= self.max_age]
+        if not tracks:
+            return Boxes.empty()
+
+        elapsed = np.array([frame_index - track.frame_index for track in tracks], dtype=np.float32)
+        return Boxes(
+            cls=[track.cls for track in tracks],
+            conf=[track.conf for track in tracks],
+            xyxy=np.stack([track.xyxy for track in tracks]) +
+            np.stack([track.velocity for track in tracks]) * elapsed[:, None],
+        )
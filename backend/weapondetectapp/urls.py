@@ -1,15 +1,33 @@
 from django.urls import path
 from weapondetectapp.views import (
+    AlertStreamView,
+    DetectAPIView,
+    ImageUploadAPIView,
+    VideoUploadAPIView,
     ImageListView,
+    ImageStatusView,
     VideoListView,
+    VideoProgressView,
+    VideoProgressStreamView,
     ImageUploadView,
     VideoUploadView,
+    MetricsView,
 )
 
 urlpatterns = [
     path("", ImageListView.as_view(), name="image-list"),
     path("image/", ImageListView.as_view(), name="image-list"),
+    path("image/status/", ImageStatusView.as_view(), name="image-status"),
     path("video/", VideoListView.as_view(), name="video-list"),
+    path("video/progress/", VideoProgressView.as_view(), name="video-progress"),
+    path("video/progress/stream/", VideoProgressStreamView.as_view(), name="video-progress-stream"),
+    path("alerts/stream/", AlertStreamView.as_view(), name="alert-stream"),
     path("upload_image/", ImageUploadView.as_view(), name="upload-image"),
     path("upload_video/", VideoUploadView.as_view(), name="upload-video"),
+
+    path("api/detect/", DetectAPIView.as_view(), name="api-detect"),
+    path("api/upload/image/", ImageUploadAPIView.as_view(), name="api-upload-image"),
+    path("api/upload/video/", VideoUploadAPIView.as_view(), name="api-upload-video"),
+
+    path("metrics", MetricsView.as_view(), name="metrics"),
 ]
@@ -1,39 +1,44 @@
 import io
 import os
+import time
 import cv2
 import numpy as np
-from typing import List, Dict, Generator
+from concurrent.futures import Future
+from typing import Callable, List, Dict, Generator, Sequence, Tuple
 from dataclasses import dataclass, field
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 
-from ultralytics import YOLO
+from weapondetectapp.boxes import BoxPredict, Boxes
+from weapondetectapp.cache import CacheEntry, ResultCache, file_digest
+from weapondetectapp.metrics import observe_stage, registry as metrics_registry, span
+from weapondetectapp.registry import ModelHandle, model_registry
+from weapondetectapp.rendering import BoxRenderer
+from weapondetectapp.tiling import cut_by_tile, make_tiles, nms, select_tiles
+from weapondetectapp.video import FramePredict, VideoPipeline, VideoStats
 
 
-@dataclass
-class BoxPredict:
-    """
-    cls: Box class
-    conf: Confidence score
-
-    xyxy: Coordinates of two floats of the bounding boxes
-    """
-    cls: float
-    conf: float
-
-    xyxy: List[float]
+IMAGES = metrics_registry.counter(
+    'weapondetect_images_total', 'Images processed by the detection tasks and API', labelnames=('status',))
+CASCADE_STAGE_SECONDS = metrics_registry.histogram(
+    'weapondetect_cascade_stage_seconds', 'Time of one batch in a cascade stage', labelnames=('stage',))
+CASCADE_IMAGES = metrics_registry.counter(
+    'weapondetect_cascade_images_total', 'Images by whether the person gate escalated them to the full pass',
+    labelnames=('outcome',))
 
 
 @dataclass
 class ImagePredict:
     """
     source_predict: Predict source object
+    image: BGR array the image was predicted from, None if it was read from path
 
     path: Path to the image
     name_file: Image name
     cls_names: Dict of classes and their names
 
-    boxes: List of bounding box objects
+    boxes: Bounding boxes
     save_dir: Path to the folder where the image with the bounding box will be saved
+    cache_key: Key of the image in the result cache
     """
     source_predict: object
 
@@ -41,8 +46,35 @@ class ImagePredict:
     name_file: str
     cls_names: Dict[float, str]
 
-    boxes: List[BoxPredict] = field(default_factory=list)
+    boxes: Boxes = field(default_factory=Boxes.empty)
+    image: np.ndarray | None = field(default=None, repr=False, compare=False)
     save_dir: str | None = field(default=None)
+    cache_key: str | None = field(default=None)
+
+    def boxes_to_json(self) -> List[Dict]:
+        """
+        Get the bounding boxes as JSON-serializable dicts.
+
+        Returns:
+            List of dicts with class, class name, confidence score and coordinates.
+        """
+        return self.boxes.to_json(self.cls_names)
+
+
+def save_thumbnail(path_to_image: str, path_to_save: str, size: Tuple[int, int] = (320, 320)) -> None:
+    """
+    Save a downscaled JPEG copy of an image.
+
+    Args:
+        path_to_image: Path to the image.
+        path_to_save: Path to save the thumbnail.
+        size: Maximum width and height of the thumbnail.
+    """
+    with Image.open(path_to_image) as img:
+        # Let the JPEG decoder skip the resolution it does not need
+        img.draft('RGB', size)
+        img.thumbnail(size)
+        img.convert('RGB').save(path_to_save, format='JPEG', quality=85)
 
 
 class TerroristDetector:
@@ -54,8 +86,30 @@ class TerroristDetector:
         2: 'person'
     }
 
-    def __init__(self, model_path: str = 'weapondetectapp/weights/best.pt') -> None:
-        self.__model = YOLO(model_path)
+    BOX_COLORS = {
+        0: 'purple',
+        1: 'red',
+        2: 'green',
+    }
+    DEFAULT_BOX_COLOR = 'white'
+
+    # Classes whose boxes in the downscaled pass mark the tiles worth predicting
+    TILE_GATE_CLASSES = ['person', 'gun']
+    # Classes of the cascade gate that send an image to the full pass
+    CASCADE_GATE_CLASSES = ['person']
+
+    def __init__(
+        self,
+        model_path: str = 'weapondetectapp/weights/best.pt',
+        warmup: bool = False,
+        cache: ResultCache | None = None,
+        pool: 'InferencePool | None' = None,
+    ) -> None:
+        # Models are shared per process, so building a detector does not reload the weights
+        # Exported models do not carry their task, so it is set explicitly
+        self.__model = model_registry.get(model_path, warmup=warmup, task='detect')
+        self.cache = cache  # results of already seen files
+        self.pool = pool  # inference processes batches are sent to instead of the local model
         self.conf: float = 0.25  # confidence threshold
 
         self.save_txt: bool = False  # save labels to *.txt
@@ -66,12 +120,26 @@ class TerroristDetector:
 
         self.line_width: int = 2  # bounding box thickness (pixels)
 
-    def __predict(self, file_path: str) -> List:
+        self.tile_size: int | None = None  # side of a tile for large images, None disables tiling
+        self.tile_overlap: float = 0.2  # share of a tile covered by its neighbour
+        self.tile_min_side: int = 1920  # longer image side from which the image is tiled
+        self.tile_gate: bool = True  # only predict the tiles around boxes of the downscaled pass
+
+        self.cascade: bool = False  # run a cheap person gate and the full pass only on images with people
+        self.cascade_imgsz: int = 320  # input size of the gate pass
+        self.cascade_model_path: str | None = None  # smaller gate model, None runs the main model at cascade_imgsz
+
+        self.renderer = BoxRenderer(self.BOX_COLORS, self.DEFAULT_BOX_COLOR, self.line_width)
+
+    def __predict(self, file_path: str | np.ndarray | Image.Image | List,
+                  model: ModelHandle | None = None, **options) -> List:
         """
         Predicts image class and returns prediction info.
 
         Args:
-            file_path: Path to the image.
+            file_path: Path to the image, image object or list of image arrays forming one batch.
+            model: Model to predict with, defaults to the detector model.
+            options: Prediction arguments overriding the detector settings.
 
         Returns:
             Predict source object or empty list if the file cannot be read.
@@ -80,40 +148,49 @@ class TerroristDetector:
             Exception: If the file cannot be read.
         """
         try:
-            results = self.__model(
+            results = (model or self.__model)(
                 file_path,
-                conf=self.conf,
+                **{
+                    'conf': self.conf,
 
-                save_txt=self.save_txt,
-                save_conf=self.save_conf,
-                save=self.save,
+                    'save_txt': self.save_txt,
+                    'save_conf': self.save_conf,
+                    'save': self.save,
 
-                augment=self.augment,
+                    'augment': self.augment,
 
-                line_width=self.line_width,
+                    'line_width': self.line_width,
+                    **options,
+                },
             )
+            self.__observe_speed(results)
             return results
 
         except Exception as e:
             print(f'File cannot be read: {e}')
             return []
 
-    def predict(self, file_path: str) -> ImagePredict:
+    @staticmethod
+    def __observe_speed(results: List) -> None:
+        # Ultralytics times its own stages and spreads the batch time evenly over the images
+        for stage in ('preprocess', 'inference', 'postprocess'):
+            seconds = sum((getattr(result, 'speed', None) or {}).get(stage, 0.0) for result in results) / 1000
+            if results:
+                observe_stage(stage, seconds)
+
+    def __to_image_predict(self, object_, path: str | None = None) -> ImagePredict:
         """
-        Get information about the image and its bounding box.
+        Build image predict object from a source predict object.
 
         Args:
-            file_path: Path to the file.
+            object_: Source predict object.
+            path: Path to the image, overrides the path known to the source predict object.
 
         Returns:
             Image predict object.
         """
-        source_predict = self.__predict(file_path)
-
-        object_ = source_predict[0]
-
         # Get attributes from source predict object
-        path = object_.path
+        path = path or object_.path
         name_file = os.path.basename(path)
         cls_names = object_.names
 
@@ -128,35 +205,381 @@ class TerroristDetector:
         if hasattr(object_, 'save_dir'):
             imagePredict.save_dir = object_.save_dir
 
-        # Creatint bounding box objects
-        boxes = object_.boxes
-        box_objects: List[BoxPredict] = []
-        for box in boxes:
-            try:
-                # Get attributes from bounding box object
-                cls = box.cls.item()
-                conf = box.conf.item()
-                xyxy = box.xyxy.tolist()[0]
-
-                box_objects.append(
-                    BoxPredict(
-                        cls=cls,
-                        conf=conf,
-                        xyxy=xyxy
-                    )
-                )
-            except Exception as e:
-                print(e)
-
-        imagePredict.boxes = box_objects
+        # Copy all bounding boxes off the device at once
+        imagePredict.boxes = Boxes.from_results(object_.boxes)
         return imagePredict
 
-    def predict_folder_with_images(self, path_with_data: str) -> Generator[ImagePredict, None, None]:
+    @property
+    def model_version(self) -> str:
+        return self.__model.version
+
+    def cache_key(self, file_path: str, **options) -> str | None:
+        """
+        Get the result cache key of a file.
+
+        Args:
+            file_path: Path to the file.
+            options: Extra options that change the result.
+
+        Returns:
+            Cache key or None if the cache is disabled or the source is not a file.
+        """
+        if self.cache is None or not isinstance(file_path, (str, os.PathLike)) \
+                or not os.path.isfile(file_path):
+            return None
+
+        if self.cascade:
+            # Images the gate lets through get different boxes than with the full pass only
+            options.update(cascade_imgsz=self.cascade_imgsz, cascade_model=self.cascade_model_path)
+
+        return self.cache.make_key(
+            file_digest(file_path),
+            self.model_version,
+            conf=self.conf,
+            augment=self.augment,
+            **options,
+        )
+
+    def __from_cache_entry(self, path: str, entry: CacheEntry, cache_key: str) -> ImagePredict:
+        return ImagePredict(
+            source_predict=None,
+            path=path,
+            name_file=os.path.basename(path),
+            cls_names=entry.cls_names,
+            boxes=Boxes.from_json(entry.boxes),
+            cache_key=cache_key,
+        )
+
+    def __cache_image_predict(self, image_predict: ImagePredict, cache_key: str | None,
+                              artifact: bytes | None = None) -> None:
+        if cache_key is None:
+            return
+
+        image_predict.cache_key = cache_key
+        self.cache.set(cache_key, CacheEntry(
+            boxes=image_predict.boxes_to_json(),
+            cls_names=image_predict.cls_names,
+            artifact=artifact,
+        ))
+
+    def predict(self, file_path: str) -> ImagePredict:
+        """
+        Get information about the image and its bounding box.
+
+        Args:
+            file_path: Path to the file.
+
+        Returns:
+            Image predict object.
+        """
+        tiled = bool(self.tile_size) and self.__needs_tiles(file_path)
+        cache_key = self.cache_key(file_path, **self.__tile_options(tiled))
+        if cache_key is not None:
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                return self.__from_cache_entry(file_path, entry, cache_key)
+
+        if tiled:
+            image_predict = self.predict_tiled(file_path)
+            self.__cache_image_predict(image_predict, cache_key)
+            return image_predict
+
+        image_predict = self.__predict_sources([file_path], [file_path], 1)[0]
+        self.__cache_image_predict(image_predict, cache_key)
+        return image_predict
+
+    def predict_batch(
+        self,
+        paths_or_arrays: Sequence[str | np.ndarray],
+        batch_size: int = 8,
+        tiled: bool = True,
+    ) -> List[ImagePredict]:
+        """
+        Predicts classes for many images, running them through the model in batches.
+
+        Args:
+            paths_or_arrays: Paths to the images or BGR image arrays.
+            batch_size: Number of images in one forward pass.
+            tiled: Predict large images tile by tile if tiling is enabled.
+
+        Returns:
+            Image predict objects in the same order as the input.
+        """
+        image_predicts: List[ImagePredict | None] = [None] * len(paths_or_arrays)
+        large = [bool(tiled and self.tile_size) and self.__needs_tiles(source) for source in paths_or_arrays]
+
+        # Take already seen files from the result cache
+        cache_keys: List[str | None] = []
+        for i, source in enumerate(paths_or_arrays):
+            cache_key = None if isinstance(source, np.ndarray) \
+                else self.cache_key(source, **self.__tile_options(large[i]))
+            cache_keys.append(cache_key)
+            if cache_key is not None:
+                entry = self.cache.get(cache_key)
+                if entry is not None:
+                    image_predicts[i] = self.__from_cache_entry(str(source), entry, cache_key)
+
+        misses = [i for i, image_predict in enumerate(image_predicts) if image_predict is None]
+
+        # Large images are split into tiles one at a time, the rest are batched as usual
+        for i in misses:
+            if large[i]:
+                image_predicts[i] = self.predict_tiled(paths_or_arrays[i], batch_size, path=f'image{i}.jpg')
+                self.__cache_image_predict(image_predicts[i], cache_keys[i])
+        misses = [i for i in misses if not large[i]]
+
+        sources = [paths_or_arrays[i] for i in misses]
+        names = [f'image{i}.jpg' if isinstance(paths_or_arrays[i], np.ndarray) else str(paths_or_arrays[i])
+                 for i in misses]
+        for i, image_predict in zip(misses, self.__predict_sources(sources, names, batch_size)):
+            image_predicts[i] = image_predict
+            self.__cache_image_predict(image_predict, cache_keys[i])
+
+        # Arrays have no file to draw on, results of the pool and of tiles do not carry them either
+        for source, image_predict in zip(paths_or_arrays, image_predicts):
+            if isinstance(source, np.ndarray):
+                image_predict.image = source
+
+        return image_predicts
+
+    def __predict_sources(self, sources: Sequence[str | np.ndarray], names: Sequence[str],
+                          batch_size: int, cascade: bool = True) -> List[ImagePredict]:
+        """
+        Run images through the model in batches, bypassing the result cache.
+
+        Args:
+            sources: Paths to the images or BGR image arrays.
+            names: Paths reported in the image predict objects.
+            batch_size: Number of images in one forward pass.
+            cascade: Let the person gate skip images if the cascade is enabled.
+
+        Returns:
+            Image predict objects in the same order as the input.
+        """
+        chunks = [range(start, min(start + batch_size, len(sources))) for start in range(0, len(sources), batch_size)]
+
+        if self.pool is not None:
+            # Send every batch at once so the inference processes work on them in parallel
+            futures = [
+                self.pool.submit([sources[i] for i in chunk], [names[i] for i in chunk], self.__pool_options(cascade))
+                for chunk in chunks
+            ]
+            return [image_predict for future in futures for image_predict in future.result()]
+
+        image_predicts = []
+        for chunk in chunks:
+
+            # Decode the images so ultralytics stacks them into one batch
+            arrays: List[np.ndarray] = []
+            with span('decode'):
+                for i in chunk:
+                    source = sources[i]
+                    if isinstance(source, np.ndarray):
+                        arrays.append(source)
+                        continue
+
+                    array = cv2.imread(str(source))
+                    if array is None:
+                        raise ValueError(f'File cannot be read: {source}')
+                    arrays.append(array)
+
+            if cascade and self.cascade:
+                image_predicts.extend(self.__predict_cascade(arrays, [names[i] for i in chunk]))
+                continue
+
+            source_predict = self.__predict(arrays)
+            if len(source_predict) != len(arrays):
+                raise ValueError('Batch cannot be predicted')
+
+            for i, object_ in zip(chunk, source_predict):
+                image_predicts.append(self.__to_image_predict(object_, names[i]))
+
+        return image_predicts
+
+    def __pool_options(self, cascade: bool = True) -> Dict:
+        # The processes run their own detectors, the settings of this one go with every batch
+        return dict(conf=self.conf, augment=self.augment, cascade=cascade and self.cascade)
+
+    def __predict_cascade(self, arrays: List[np.ndarray], names: List[str]) -> List[ImagePredict]:
+        """
+        Predict a batch with a cheap person gate first and the full pass only for the images with people.
+
+        Images without people keep the boxes of the gate pass if it ran the main model,
+        and get no boxes if it ran a separate gate model.
+
+        Args:
+            arrays: BGR image arrays of one batch.
+            names: Paths reported in the image predict objects.
+
+        Returns:
+            Image predict objects in the same order as the input.
+        """
+        gate_model = model_registry.get(self.cascade_model_path, task='detect') if self.cascade_model_path else None
+
+        started = time.perf_counter()
+        gate_predict = self.__predict(
+            arrays, model=gate_model, imgsz=self.cascade_imgsz, augment=False, save=False, save_txt=False)
+        if len(gate_predict) != len(arrays):
+            raise ValueError('Batch cannot be predicted')
+        CASCADE_STAGE_SECONDS.observe(time.perf_counter() - started, stage='gate')
+
+        image_predicts = [self.__to_image_predict(object_, name) for object_, name in zip(gate_predict, names)]
+        escalated, skipped = [], []
+        for i, image_predict in enumerate(image_predicts):
+            gate_classes = [cls for cls, name in image_predict.cls_names.items() if name in self.CASCADE_GATE_CLASSES]
+            if np.isin(image_predict.boxes.cls, gate_classes).any():
+                escalated.append(i)
+            elif gate_model is not None:
+                skipped.append(i)
+
+        CASCADE_IMAGES.inc(len(escalated), outcome='escalated')
+        CASCADE_IMAGES.inc(len(arrays) - len(escalated), outcome='skipped')
+
+        # Exported models carry their label map only in their results, so the images the gate model
+        # skipped take the one of the full pass, or the classes of the detector if it did not run
+        cls_names = self.CLASS_NAMES
+        if escalated:
+            started = time.perf_counter()
+            source_predict = self.__predict([arrays[i] for i in escalated])
+            if len(source_predict) != len(escalated):
+                raise ValueError('Batch cannot be predicted')
+            CASCADE_STAGE_SECONDS.observe(time.perf_counter() - started, stage='full')
+
+            for i, object_ in zip(escalated, source_predict):
+                image_predicts[i] = self.__to_image_predict(object_, names[i])
+            cls_names = image_predicts[escalated[0]].cls_names
+
+        for i in skipped:
+            image_predicts[i].source_predict = None
+            image_predicts[i].cls_names = cls_names
+            image_predicts[i].boxes = Boxes.empty()
+        return image_predicts
+
+    def __tile_options(self, tiled: bool) -> Dict:
+        # Tiled results differ from plain ones and from each other, so the tiling goes into the cache key
+        if not tiled:
+            return {}
+        return dict(
+            tile_size=self.tile_size,
+            tile_overlap=self.tile_overlap,
+            tile_min_side=self.tile_min_side,
+            tile_gate=self.tile_gate,
+        )
+
+    def __needs_tiles(self, source: str | np.ndarray) -> bool:
+        if isinstance(source, np.ndarray):
+            height, width = source.shape[:2]
+        else:
+            try:
+                # Only the header is read to get the size
+                with Image.open(source) as img:
+                    width, height = img.size
+            except Exception:
+                return False
+        return max(width, height) >= self.tile_min_side
+
+    def predict_tiled(self, source: str | np.ndarray, batch_size: int = 8, path: str | None = None) -> ImagePredict:
+        """
+        Predict a large image tile by tile, so small objects are seen at full resolution.
+
+        The whole image is predicted downscaled first. With the gate enabled only the
+        tiles around its person and gun boxes are predicted again, otherwise all tiles
+        are. Boxes of the full image and of the tiles are merged with IoU NMS, and boxes
+        cut by a seam between tiles also by intersection over the smaller box.
+
+        Args:
+            source: Path to the image or BGR image array.
+            batch_size: Number of tiles in one forward pass.
+            path: Path reported for an image array.
+
+        Returns:
+            Image predict object.
+        """
+        if isinstance(source, np.ndarray):
+            image, path = source, path or 'image.jpg'
+        else:
+            with span('decode'):
+                image, path = cv2.imread(str(source)), str(source)
+            if image is None:
+                raise ValueError(f'File cannot be read: {source}')
+
+        height, width = image.shape[:2]
+        overview = self.__predict_sources([image], [path], 1)[0]
+
+        tiles = make_tiles(width, height, self.tile_size, self.tile_overlap)
+        if self.tile_gate:
+            gate_classes = [cls for cls, name in overview.cls_names.items() if name in self.TILE_GATE_CLASSES]
+            tiles = select_tiles(tiles, overview.boxes.xyxy[np.isin(overview.boxes.cls, gate_classes)])
+
+        # The tiles are already picked around people, the cascade gate would only repeat that
+        tile_predicts = self.__predict_sources(
+            [image[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles], [path] * len(tiles), batch_size, cascade=False)
+
+        tile_boxes = [tile_predict.boxes.shift(*tile[:2]) for tile, tile_predict in zip(tiles, tile_predicts)]
+        cut = np.concatenate([np.zeros(len(overview.boxes), dtype=bool)] + [
+            cut_by_tile(boxes.xyxy, tile, width, height) for tile, boxes in zip(tiles, tile_boxes)])
+        overview.boxes = nms(Boxes.concatenate([overview.boxes] + tile_boxes), metric='ios', cut=cut)
+        overview.source_predict = None
+        return overview
+
+    def submit_batch(self, frames: Sequence[np.ndarray], batch_size: int = 8) -> Future:
+        """
+        Start predicting a batch of frames without waiting for the result.
+
+        With an inference pool the batch runs in another process while the
+        caller goes on; without one it is predicted right away.
+
+        Args:
+            frames: BGR image arrays.
+            batch_size: Number of images in one forward pass.
+
+        Returns:
+            Future resolved with the image predict objects of the frames.
+        """
+        if self.pool is not None and frames:
+            return self.pool.submit(frames, options=self.__pool_options())
+
+        future: Future = Future()
+        try:
+            # Video frames are never tiled, it would multiply the cost of every frame
+            future.set_result(self.predict_batch(frames, batch_size, tiled=False) if frames else [])
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @classmethod
+    def list_images(cls, path: str, recursive: bool = False) -> List[str]:
+        """
+        Find the images in a folder.
+
+        Args:
+            path: Path to the folder.
+            recursive: Also look into the subfolders.
+
+        Returns:
+            Sorted image paths.
+        """
+        if recursive:
+            paths = [os.path.join(root, file) for root, _, files in os.walk(path) for file in files]
+        else:
+            paths = [os.path.join(path, file) for file in os.listdir(path)]
+
+        return sorted(
+            path for path in paths
+            if os.path.splitext(path)[1].lower() in cls.IMAGE_EXTENSIONS and os.path.isfile(path)
+        )
+
+    def predict_folder_with_images(
+        self,
+        path_with_data: str,
+        batch_size: int = 8,
+    ) -> Generator[ImagePredict, None, None]:
         """
         Predicts classes for all images in a folder.
 
         Args:
             path_with_data: Path to a folder with images.
+            batch_size: Number of images in one forward pass.
 
         Returns:
             List of predict source objects or empty list if the folder is empty.
@@ -165,16 +588,13 @@ class TerroristDetector:
             Exception: If the folder is empty.
         """
 
-        file_list = os.listdir(path_with_data)
-        image_list = [file for file in file_list if os.path.splitext(
-            file)[1].lower() in self.IMAGE_EXTENSIONS]
+        image_paths = self.list_images(path_with_data)
 
-        if len(image_list) == 0:
+        if len(image_paths) == 0:
             raise Exception('Folder is empty')
 
-        for image in image_list:
-            image_path = os.path.join(path_with_data, image)
-            yield self.predict(image_path)
+        for start in range(0, len(image_paths), batch_size):
+            yield from self.predict_batch(image_paths[start:start + batch_size], batch_size)
 
     def draw_bounding_box(self, image_predict: ImagePredict) -> io.BytesIO:
         """
@@ -186,57 +606,45 @@ class TerroristDetector:
         Returns:
             Image with bounding box and label in byte stream.
         """
-        try:
-            image = Image.open(image_predict.path)
-        except:
-            image_array: np.ndarray = image_predict.source_predict.orig_img
-            image = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
-            image = Image.fromarray(image)
+        if image_predict.image is not None:
+            # The path of an array is made up, a file of that name is not the image
+            image = Image.fromarray(cv2.cvtColor(image_predict.image, cv2.COLOR_BGR2RGB))
+        else:
+            try:
+                image = Image.open(image_predict.path)
+            except Exception:
+                if image_predict.source_predict is None:
+                    raise ValueError(f'Image cannot be read: {image_predict.path}')
+                image_array: np.ndarray = image_predict.source_predict.orig_img
+                image = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+                image = Image.fromarray(image)
 
         # Open the image
         with image as img:
-            # Create a drawing context
-            draw = ImageDraw.Draw(img)
-
-            # Draw each bounding box
-            for box in image_predict.boxes:
-
-                if box.cls == 0:
-                    color_box = 'purple'
-
-                elif box.cls == 1:
-                    color_box = 'red'
-
-                elif box.cls == 2:
-                    color_box = 'green'
+            with span('draw'):
+                self.renderer.draw_on_image(img, image_predict.boxes, image_predict.cls_names)
 
-                else:
-                    color_box = 'white'
-
-                # Extract the coordinates
-                x1, y1, x2, y2 = box.xyxy
-
-                # Draw the box
-                draw.rectangle((x1, y1, x2, y2),
-                               outline=color_box, width=self.line_width)
+            # Save the image to a byte stream
+            with span('encode'):
+                buffer = io.BytesIO()
+                img.save(buffer, format='JPEG')
+                buffer.seek(0)
 
-                # Label the box
-                text = f'{image_predict.cls_names[box.cls]} {box.conf:.2f}'
-                text = text[:1].upper() + text[1:]
-                x_text = x1 + self.line_width
-                y_text = y1 + self.line_width
+            return buffer
 
-                draw.text(
-                    (x_text, y_text), text, fill=color_box, width=self.line_width*2,
-                    font=ImageFont.truetype("weapondetectapp/weights/arial.ttf", 20), fill_opacity=1,
-                )
+    def draw_bounding_box_on_array(self, frame: np.ndarray, image_predict: ImagePredict) -> np.ndarray:
+        """
+        Draw bounding boxes and labels straight onto a BGR frame.
 
-            # Save the image to a byte stream
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG')
-            buffer.seek(0)
+        Args:
+            frame: BGR image array, modified in place.
+            image_predict: Image predict object.
 
-            return buffer
+        Returns:
+            The same frame with the bounding boxes drawn on it.
+        """
+        with span('draw'):
+            return self.renderer.draw_on_array(frame, image_predict.boxes, image_predict.cls_names)
 
     def save_image_from_buffer(self, buffer: io.BytesIO, path_to_save: str) -> None:
         """
@@ -246,84 +654,143 @@ class TerroristDetector:
             buffer: Image in byte stream.
             path_to_save: Path to save the image.
         """
-        with open(path_to_save, 'wb') as f:
+        with span('storage_write'), open(path_to_save, 'wb') as f:
             f.write(buffer.read())
 
-    def predict_and_draw_boxes_on_existing_image(self, path_to_image: str) -> None:
+    def save_annotated_image(self, image_predict: ImagePredict, path_to_save: str) -> None:
+        """
+        Save image with bounding boxes, reusing the cached annotated image if there is one.
+
+        Args:
+            image_predict: Image predict object.
+            path_to_save: Path to save the image.
+        """
+        if image_predict.cache_key is not None:
+            entry = self.cache.get(image_predict.cache_key)
+            if entry is not None and entry.artifact is not None:
+                self.save_image_from_buffer(io.BytesIO(entry.artifact), path_to_save)
+                return
+
+        buffer = self.draw_bounding_box(image_predict)
+        self.__cache_image_predict(image_predict, image_predict.cache_key, buffer.getvalue())
+        self.save_image_from_buffer(buffer, path_to_save)
+
+    def predict_and_draw_boxes_on_existing_image(self, path_to_image: str) -> ImagePredict:
         """
         Draw bounding boxes on existing image.
 
         Args:
             path_to_image: Path to the image.
+
+        Returns:
+            Image predict object.
         """
         image_predict = self.predict(path_to_image)
-        buffer = self.draw_bounding_box(image_predict)
-        self.save_image_from_buffer(buffer, path_to_image)
+        self.save_annotated_image(image_predict, path_to_image)
+        return image_predict
+
+    def predict_and_draw_boxes_on_existing_images(self, paths_to_images: Sequence[str], batch_size: int = 8) -> None:
+        """
+        Draw bounding boxes on existing images, predicting them in batches.
+
+        Args:
+            paths_to_images: Paths to the images.
+            batch_size: Number of images in one forward pass.
+        """
+        for image_predict in self.predict_batch(paths_to_images, batch_size):
+            self.save_annotated_image(image_predict, image_predict.path)
+
+    def predict_video(
+        self,
+        input_path: str,
+        output_path: str,
+        start_frame: int = 0,
+        end_frame: int | None = None,
+        batch_size: int = 8,
+        stride: int = 1,
+        motion_threshold: float | None = None,
+        on_frame: Callable[[FramePredict], None] | None = None,
+        preset: str = 'balanced',
+        keep_audio: bool = True,
+        hwaccel: str | None = None,
+    ) -> VideoStats:
+        """
+        Draw bounding boxes on a video, or a range of its frames, and save it to another file.
 
-    def predict_video_and_draw_boxes_on_existing_video(self, path_to_video: str) -> None:
+        Args:
+            input_path: Path to the source video.
+            output_path: Path to save the annotated video.
+            start_frame: Index of the first frame to process.
+            end_frame: Index of the frame to stop before, None to process until the end.
+            batch_size: Number of frames in one forward pass.
+            stride: Run the model on every stride-th frame and track boxes in between.
+            motion_threshold: Also run the model when the frame changes more than this (0-255).
+            on_frame: Callable invoked with every processed frame.
+            preset: Encoder preset: fast, balanced or small.
+            keep_audio: Copy the audio track of the source when the whole video is processed.
+            hwaccel: Hardware decoder device type, None decodes on the CPU.
+
+        Returns:
+            Statistics of the run.
+        """
+        pipeline = VideoPipeline(
+            self,
+            batch_size=batch_size,
+            stride=stride,
+            motion_threshold=motion_threshold,
+            on_frame=on_frame,
+            preset=preset,
+            keep_audio=keep_audio,
+            hwaccel=hwaccel,
+        )
+        return pipeline.run(input_path, output_path, start_frame, end_frame)
+
+    def predict_video_and_draw_boxes_on_existing_video(
+        self,
+        path_to_video: str,
+        batch_size: int = 8,
+        stride: int = 1,
+        motion_threshold: float | None = None,
+        on_frame: Callable[[FramePredict], None] | None = None,
+        preset: str = 'balanced',
+        keep_audio: bool = True,
+        hwaccel: str | None = None,
+    ) -> VideoStats:
         """
         Draw bounding boxes on existing video and save.
 
         Args:
             path_to_video: Path to the video.
+            batch_size: Number of frames in one forward pass.
+            stride: Run the model on every stride-th frame and track boxes in between.
+            motion_threshold: Also run the model when the frame changes more than this (0-255).
+            on_frame: Callable invoked with every processed frame.
+            preset: Encoder preset: fast, balanced or small.
+            keep_audio: Copy the audio track of the source.
+            hwaccel: Hardware decoder device type, None decodes on the CPU.
+
+        Returns:
+            Statistics of the run.
         """
 
         new_name = os.path.basename(path_to_video)
         video_path = os.path.join(os.path.dirname(
             path_to_video), f'new_{new_name}')
 
-        # Create a video capture object
-        cap = cv2.VideoCapture(path_to_video)
-
-        # Get the video's frame rate
-        fps = cap.get(cv2.CAP_PROP_FPS)
-
-        # Get the video's frame size
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-        # Create a video writer object
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
-
-        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        # Read the video
-        while cap.isOpened():
-            ret, frame = cap.read()
-
-            if not ret:
-                break
-
-            # Convert the frame to RGB
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Convert the frame to Image
-            frame = Image.fromarray(frame)
-
-            # Predict the classes
-            frame_predict = self.predict(frame)
-
-            # Draw the bounding boxes
-            buffer = self.draw_bounding_box(frame_predict)
-
-            # Convert the byte stream to Image
-            buffer = Image.open(buffer)
-
-            src = np.array(buffer)
-
-            # Convert the frame back to OpenCV format
-            frame = cv2.cvtColor(src, cv2.COLOR_BGR2RGB)
-
-            # Write the frame to the output video file
-            out.write(frame)
-
-            num_frames -= 1
-
-        # Release the video capture and writer objects
-        cap.release()
-        out.release()
+        stats = self.predict_video(
+            path_to_video,
+            video_path,
+            batch_size=batch_size,
+            stride=stride,
+            motion_threshold=motion_threshold,
+            on_frame=on_frame,
+            preset=preset,
+            keep_audio=keep_audio,
+            hwaccel=hwaccel,
+        )
 
         # Delete the original video and rename the new one
         os.remove(path_to_video)
         os.rename(video_path, path_to_video)
+
+        return stats
@@ -0,0 +1,460 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, replace
+from typing import Callable, Deque, List, Tuple
+
+import cv2
+import numpy as np
+
+from weapondetectapp.metrics import registry, span
+from weapondetectapp.tracking import IoUTracker
+from weapondetectapp.videoio import FrameBufferPool, VideoReader, VideoWriter, open_video_reader, open_video_writer
+
+
+FRAMES = registry.counter('weapondetect_video_frames_total', 'Video frames annotated and encoded')
+
+
+# Marks the end of a stream in the pipeline queues
+_END = object()
+
+
+@dataclass
+class FramePredict:
+    """
+    index: Frame index in the video
+    frame: BGR frame with the bounding boxes drawn on it
+    image_predict: Image predict object of the frame
+    inferred: Whether the boxes were detected on this frame or carried forward by the tracker
+    """
+    index: int
+    frame: np.ndarray
+    image_predict: object
+    inferred: bool = True
+
+
+@dataclass
+class DetectionTrack:
+    """
+    Columnar per-frame detections of a video, one row per box.
+
+    frame: Frame index of every box
+    cls: Box class
+    conf: Confidence score
+    xyxy: Coordinates of the bounding boxes, shape (N, 4)
+    inferred: Whether the box was detected or carried forward by the tracker
+    """
+    frame: np.ndarray
+    cls: np.ndarray
+    conf: np.ndarray
+    xyxy: np.ndarray
+    inferred: np.ndarray
+
+    FIELDS = ('frame', 'cls', 'conf', 'xyxy', 'inferred')
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[int, float, float, List[float], bool]]) -> 'DetectionTrack':
+        """
+        Build a track from (frame, cls, conf, xyxy, inferred) rows.
+        """
+        return cls(
+            frame=np.array([row[0] for row in rows], dtype=np.int32),
+            cls=np.array([row[1] for row in rows], dtype=np.int16),
+            conf=np.array([row[2] for row in rows], dtype=np.float32),
+            xyxy=np.array([row[3] for row in rows], dtype=np.float32).reshape(-1, 4),
+            inferred=np.array([row[4] for row in rows], dtype=bool),
+        )
+
+    @classmethod
+    def concatenate(cls, tracks: List['DetectionTrack']) -> 'DetectionTrack':
+        if not tracks:
+            return cls.from_rows([])
+        return cls(**{
+            name: np.concatenate([getattr(track, name) for track in tracks])
+            for name in cls.FIELDS
+        })
+
+    def to_rows(self) -> List[list]:
+        """
+        Get the track as JSON-serializable [frame, cls, conf, x1, y1, x2, y2, inferred] rows.
+        """
+        return [
+            [int(frame), int(cls_), round(float(conf), 4),
+             *(round(float(value), 1) for value in xyxy), bool(inferred)]
+            for frame, cls_, conf, xyxy, inferred
+            in zip(self.frame, self.cls, self.conf, self.xyxy, self.inferred)
+        ]
+
+    @classmethod
+    def from_json_rows(cls, rows: List[list]) -> 'DetectionTrack':
+        return cls.from_rows([(row[0], row[1], row[2], row[3:7], row[7]) for row in rows])
+
+    def save(self, path: str) -> None:
+        # Write through a file object so numpy does not append its own extension
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **{name: getattr(self, name) for name in self.FIELDS})
+
+    @classmethod
+    def load(cls, path: str) -> 'DetectionTrack':
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in cls.FIELDS})
+
+
+class TrackRecorder:
+    """
+    Frame callback collecting the boxes of every processed frame into a detection track.
+    """
+
+    def __init__(self) -> None:
+        self.tracks: List[DetectionTrack] = []
+
+    def __call__(self, frame_predict: FramePredict) -> None:
+        boxes = frame_predict.image_predict.boxes
+        if not len(boxes):
+            return
+        self.tracks.append(DetectionTrack(
+            frame=np.full(len(boxes), frame_predict.index, dtype=np.int32),
+            cls=boxes.cls.astype(np.int16),
+            conf=boxes.conf,
+            xyxy=boxes.xyxy,
+            inferred=np.full(len(boxes), frame_predict.inferred, dtype=bool),
+        ))
+
+    @property
+    def track(self) -> DetectionTrack:
+        return DetectionTrack.concatenate(self.tracks)
+
+
+@dataclass
+class VideoStats:
+    """
+    frames: Number of processed frames
+    inferred_frames: Number of frames run through the model
+    seconds: Wall time of the whole run
+    inference_seconds: Time spent in the model
+    """
+    frames: int = 0
+    inferred_frames: int = 0
+    seconds: float = 0.0
+    inference_seconds: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.seconds if self.seconds else 0.0
+
+
+def count_frames(path: str) -> int:
+    """
+    Get the number of frames of a video from its container metadata.
+
+    Args:
+        path: Path to the video.
+
+    Returns:
+        Number of frames, 0 if unknown.
+    """
+    try:
+        reader = open_video_reader(path)
+    except ValueError:
+        return 0
+    try:
+        return reader.frames
+    finally:
+        reader.close()
+
+
+def video_fps(path: str) -> float:
+    """
+    Get the frame rate of a video from its container metadata.
+
+    Args:
+        path: Path to the video.
+
+    Returns:
+        Frames per second, 0 if unknown.
+    """
+    try:
+        reader = open_video_reader(path)
+    except ValueError:
+        return 0.0
+    try:
+        return float(reader.fps)
+    finally:
+        reader.close()
+
+
+@dataclass
+class _StageError:
+    error: BaseException | None = None
+
+
+class VideoPipeline:
+    """
+    Video detection engine with decode, batched inference and encode stages.
+
+    Decoding and encoding run in their own threads connected to the inference
+    stage by bounded queues, so they overlap with the model instead of waiting
+    for it. Annotations are drawn straight onto the decoded frame.
+
+    With a stride above one, or a motion threshold, only keyframes go through
+    the model and the boxes of the frames in between are carried forward by
+    an IoU tracker.
+    """
+    # Size of the grayscale thumbnail used to measure motion between frames
+    MOTION_SIZE = (64, 36)
+
+    def __init__(
+        self,
+        detector: 'TerroristDetector',
+        batch_size: int = 8,
+        queue_size: int = 32,
+        on_frame: Callable[[FramePredict], None] | None = None,
+        stride: int = 1,
+        motion_threshold: float | None = None,
+        preset: str = 'balanced',
+        keep_audio: bool = True,
+        hwaccel: str | None = None,
+    ) -> None:
+        """
+        Args:
+            detector: Terrorist detector used for inference and drawing.
+            batch_size: Number of frames in one forward pass.
+            queue_size: Maximum number of frames waiting between two stages.
+            on_frame: Callable invoked with every processed frame before it is encoded.
+            stride: Run the model on every stride-th frame.
+            motion_threshold: Also run the model on a frame whose mean absolute
+                difference from the last keyframe (0-255) is above this value.
+            preset: Encoder preset, one of videoio.ENCODER_PRESETS.
+            keep_audio: Copy the audio track of the source when the whole video is processed.
+            hwaccel: Hardware decoder device type, None decodes on the CPU.
+        """
+        self.detector = detector
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.on_frame = on_frame
+        self.stride = max(1, stride)
+        self.motion_threshold = motion_threshold
+        self.preset = preset
+        self.keep_audio = keep_audio
+        self.hwaccel = hwaccel
+
+    @staticmethod
+    def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+        # Never block forever, another stage may have failed
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _decode(self, reader: VideoReader, buffers: FrameBufferPool, frames: queue.Queue, start_frame: int,
+                end_frame: int | None, stop: threading.Event, failure: _StageError) -> None:
+        try:
+            index = start_frame
+            keyframe_thumbnail = None
+            while not stop.is_set() and (end_frame is None or index < end_frame):
+                buffer = buffers.acquire(reader.shape, stop)
+                if buffer is None:
+                    return
+                with span('video_decode'):
+                    frame = reader.read(buffer)
+                if frame is None:
+                    break
+
+                is_keyframe = index % self.stride == 0
+                if self.motion_threshold is not None:
+                    thumbnail = cv2.resize(
+                        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), self.MOTION_SIZE,
+                        interpolation=cv2.INTER_AREA,
+                    )
+                    if keyframe_thumbnail is None or is_keyframe or \
+                            cv2.absdiff(thumbnail, keyframe_thumbnail).mean() > self.motion_threshold:
+                        is_keyframe = True
+                        keyframe_thumbnail = thumbnail
+
+                if not self._put(frames, (index, frame, is_keyframe), stop):
+                    return
+                index += 1
+        except BaseException as e:
+            failure.error = e
+            stop.set()
+        finally:
+            self._put(frames, _END, stop)
+
+    def _encode(self, out: VideoWriter, buffers: FrameBufferPool, encoded: queue.Queue,
+                stop: threading.Event, failure: _StageError) -> None:
+        try:
+            while True:
+                item = self._get(encoded, stop)
+                if item is _END:
+                    return
+                with span('video_encode'):
+                    out.write(item)
+                # The encoder has its own copy of the frame, the array can be decoded into again
+                buffers.release(item)
+                FRAMES.inc()
+        except BaseException as e:
+            failure.error = e
+            stop.set()
+
+    def _next_batch(self, frames: queue.Queue, stop: threading.Event) -> Tuple[List, bool]:
+        """
+        Collect up to batch_size decoded frames.
+
+        Returns:
+            Decoded (index, frame, is_keyframe) tuples and whether the stream has ended.
+        """
+        batch = []
+        while len(batch) < self.batch_size:
+            item = self._get(frames, stop)
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _submit(self, batch: List[Tuple[int, np.ndarray, bool]],
+                stats: VideoStats) -> Tuple[List[Tuple[int, np.ndarray, bool]], Future]:
+        # The first frame of a run always has to be detected
+        if not self._started:
+            batch[0] = (*batch[0][:2], True)
+            self._started = True
+
+        keyframes = [frame for _, frame, is_keyframe in batch if is_keyframe]
+
+        started = time.perf_counter()
+        future = self.detector.submit_batch(keyframes, batch_size=self.batch_size)
+        stats.inference_seconds += time.perf_counter() - started
+        stats.inferred_frames += len(keyframes)
+        return batch, future
+
+    def _resolve(self, batch: List[Tuple[int, np.ndarray, bool]], future: Future,
+                 tracker: IoUTracker, stats: VideoStats) -> List[FramePredict]:
+        started = time.perf_counter()
+        image_predicts = iter(future.result())
+        stats.inference_seconds += time.perf_counter() - started
+
+        frame_predicts = []
+        for index, frame, is_keyframe in batch:
+            if is_keyframe:
+                image_predict = next(image_predicts)
+                tracker.update(index, image_predict.boxes)
+                self._last_keyframe_predict = image_predict
+            else:
+                image_predict = replace(
+                    self._last_keyframe_predict,
+                    source_predict=None,
+                    boxes=tracker.predict(index),
+                )
+            frame_predicts.append(FramePredict(
+                index=index, frame=frame, image_predict=image_predict, inferred=is_keyframe))
+        return frame_predicts
+
+    def run(
+        self,
+        input_path: str,
+        output_path: str,
+        start_frame: int = 0,
+        end_frame: int | None = None,
+    ) -> VideoStats:
+        """
+        Detect objects on the frames of a video and write the annotated video.
+
+        Args:
+            input_path: Path to the source video.
+            output_path: Path to save the annotated video.
+            start_frame: Index of the first frame to process.
+            end_frame: Index of the frame to stop before, None to process until the end.
+
+        Returns:
+            Statistics of the run.
+        """
+        started = time.perf_counter()
+        stats = VideoStats()
+        tracker = IoUTracker(max_age=self.stride * 2)
+        self._last_keyframe_predict = None
+        self._started = False
+
+        # With an inference pool several batches are in flight at once, one per process
+        pool = getattr(self.detector, 'pool', None)
+        window = pool.workers if pool is not None else 1
+        in_flight: Deque = deque()
+
+        reader = open_video_reader(input_path, start_frame, self.hwaccel)
+        # A segment gets its audio when the segments are joined
+        whole_video = not start_frame and end_frame is None
+        try:
+            out = open_video_writer(
+                output_path, reader.fps, reader.size, self.preset,
+                audio_source=input_path if self.keep_audio and whole_video else None,
+            )
+        except BaseException:
+            reader.close()
+            raise
+
+        # Enough arrays for every frame that can be queued, batched, in flight or encoded at once
+        buffers = FrameBufferPool(2 * self.queue_size + (window + 2) * self.batch_size + 2)
+
+        frames: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        encoded: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        decode_failure, encode_failure = _StageError(), _StageError()
+
+        decoder = threading.Thread(
+            target=self._decode, args=(reader, buffers, frames, start_frame, end_frame, stop, decode_failure),
+            daemon=True)
+        encoder = threading.Thread(
+            target=self._encode, args=(out, buffers, encoded, stop, encode_failure), daemon=True)
+        decoder.start()
+        encoder.start()
+
+        try:
+            ended = False
+            while not ended and not stop.is_set():
+                batch, ended = self._next_batch(frames, stop)
+                if batch:
+                    in_flight.append(self._submit(batch, stats))
+
+                # Results are taken in order, so the tracker sees the frames in sequence
+                while in_flight and (len(in_flight) >= window or ended) and not stop.is_set():
+                    for frame_predict in self._resolve(*in_flight.popleft(), tracker, stats):
+                        self.detector.draw_bounding_box_on_array(
+                            frame_predict.frame, frame_predict.image_predict)
+                        if self.on_frame is not None:
+                            self.on_frame(frame_predict)
+                        if not self._put(encoded, frame_predict.frame, stop):
+                            break
+                        stats.frames += 1
+
+            self._put(encoded, _END, stop)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            decoder.join()
+            encoder.join()
+
+            reader.close()
+            out.close()
+
+        for failure in (decode_failure, encode_failure):
+            if failure.error is not None:
+                raise failure.error
+
+        stats.seconds = time.perf_counter() - started
+        return stats
@@ -0,0 +1,449 @@
+import threading
+from fractions import Fraction
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+# libx264 settings of every encoder preset; at the same quality slower presets give smaller files
+ENCODER_PRESETS: Dict[str, Dict[str, str]] = {
+    'fast': {'preset': 'ultrafast', 'crf': '23'},
+    'balanced': {'preset': 'veryfast', 'crf': '23'},
+    'small': {'preset': 'slow', 'crf': '23'},
+}
+
+_warned = set()
+
+
+def has_pyav() -> bool:
+    """
+    Check that PyAV is installed with an H.264 encoder.
+    """
+    if av is None or 'libx264' not in av.codecs_available:
+        if 'pyav' not in _warned:
+            _warned.add('pyav')
+            print('PyAV with libx264 is not installed, videos are written with OpenCV as MPEG-4 Part 2 '
+                  'that most browsers cannot play')
+        return False
+    return True
+
+
+def _to_rate(fps: float | Fraction) -> Fraction:
+    if isinstance(fps, Fraction):
+        return fps
+    # 29.97 and friends are stored as 30000/1001
+    return Fraction(fps or 25).limit_denominator(1001)
+
+
+class FrameBufferPool:
+    """
+    Frame arrays recycled between the decoder and the encoder.
+
+    Frames are decoded into a free array and the array is given back once the
+    annotated frame is encoded, so a run allocates at most max_buffers
+    frames instead of one per decoded frame.
+    """
+
+    def __init__(self, max_buffers: int) -> None:
+        """
+        Args:
+            max_buffers: Maximum number of arrays, must cover every frame that can be in flight at once.
+        """
+        self.max_buffers = max_buffers
+        self.allocated = 0
+        self._free: List[np.ndarray] = []
+        self._condition = threading.Condition()
+
+    def acquire(self, shape: Tuple[int, ...], stop: threading.Event) -> np.ndarray | None:
+        """
+        Take a free array, allocating a new one while under the limit.
+
+        Args:
+            shape: Shape of the frame.
+            stop: Event that stops waiting for a free array.
+
+        Returns:
+            uint8 array or None if stopped.
+        """
+        with self._condition:
+            while not stop.is_set():
+                for i, buffer in enumerate(self._free):
+                    if buffer.shape == shape:
+                        return self._free.pop(i)
+                if self.allocated < self.max_buffers:
+                    self.allocated += 1
+                    return np.empty(shape, dtype=np.uint8)
+                self._condition.wait(0.1)
+        return None
+
+    def release(self, buffer: np.ndarray) -> None:
+        with self._condition:
+            self._free.append(buffer)
+            self._condition.notify()
+
+
+class VideoReader:
+    """
+    Sequential BGR frame reader of a video, starting at any frame.
+
+    fps: Frame rate
+    size: (width, height) of the frames
+    frames: Number of frames from the container metadata, 0 if unknown
+    """
+    fps: Fraction
+    size: Tuple[int, int]
+    frames: int = 0
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.size[1], self.size[0], 3
+
+    def read(self, out: np.ndarray | None = None) -> np.ndarray | None:
+        """
+        Decode the next frame.
+
+        Args:
+            out: Array to decode into, a new one is allocated if None.
+
+        Returns:
+            BGR frame or None at the end of the video.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class PyAVReader(VideoReader):
+    """
+    Frame reader decoding with FFmpeg through PyAV, with threaded or hardware decoding.
+    """
+
+    def __init__(self, path: str, start_frame: int = 0, hwaccel: str | None = None) -> None:
+        """
+        Args:
+            path: Path to the video.
+            start_frame: Index of the first frame to read.
+            hwaccel: Hardware decoder device type, e.g. cuda, vaapi or videotoolbox, None decodes on the CPU.
+        """
+        options = {}
+        if hwaccel is not None:
+            from av.codec.hwaccel import HWAccel
+
+            options['hwaccel'] = HWAccel(device_type=hwaccel, allow_software_fallback=True)
+        try:
+            self._container = av.open(path, **options)
+        except av.error.FFmpegError as e:
+            raise ValueError(f'Video cannot be read: {path}') from e
+        if not self._container.streams.video:
+            self._container.close()
+            raise ValueError(f'Video cannot be read: {path}')
+
+        self._stream = self._container.streams.video[0]
+        self._stream.thread_type = 'AUTO'
+        self.fps = self._stream.average_rate or self._stream.guessed_rate or Fraction(25)
+        self.size = (self._stream.codec_context.width, self._stream.codec_context.height)
+        self.frames = self._stream.frames
+        if not self.frames and self._stream.duration:
+            # Containers like WebM and MKV store only the duration
+            self.frames = round(self._stream.duration * self._stream.time_base * self.fps)
+        elif not self.frames and self._container.duration:
+            self.frames = round(Fraction(self._container.duration, av.time_base) * self.fps)
+
+        self._start_pts = self._stream.start_time or 0
+        self._skip_until = start_frame
+        if start_frame:
+            # Seek to the keyframe before the first frame and decode up to it
+            seconds = start_frame / self.fps
+            self._container.seek(
+                self._start_pts + int(seconds / self._stream.time_base), stream=self._stream, backward=True)
+        self._frames = self._container.decode(self._stream)
+
+    def _index(self, frame) -> int:
+        # Frame index of a constant frame rate video from its presentation time
+        return round((frame.pts - self._start_pts) * self._stream.time_base * self.fps)
+
+    def read(self, out: np.ndarray | None = None) -> np.ndarray | None:
+        for frame in self._frames:
+            if self._skip_until:
+                if frame.pts is not None and self._index(frame) < self._skip_until:
+                    continue
+                self._skip_until = 0
+
+            # The converted frame is owned by FFmpeg, its rows may be padded to the line size
+            bgr = frame.reformat(format='bgr24')
+            plane = bgr.planes[0]
+            width, height = bgr.width, bgr.height
+            view = np.frombuffer(plane, np.uint8).reshape(height, plane.line_size)[:, :width * 3]
+            view = view.reshape(height, width, 3)
+            if out is None or out.shape != view.shape:
+                return view.copy()
+            np.copyto(out, view)
+            return out
+        return None
+
+    def close(self) -> None:
+        self._container.close()
+
+
+class OpenCVReader(VideoReader):
+    """
+    Frame reader decoding with OpenCV, used when PyAV is not installed.
+    """
+
+    def __init__(self, path: str, start_frame: int = 0) -> None:
+        self._cap = cv2.VideoCapture(path)
+        if not self._cap.isOpened():
+            raise ValueError(f'Video cannot be read: {path}')
+        if start_frame:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        self.fps = _to_rate(self._cap.get(cv2.CAP_PROP_FPS))
+        self.size = (int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.frames = max(0, int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    def read(self, out: np.ndarray | None = None) -> np.ndarray | None:
+        ret, frame = self._cap.read(out)
+        return frame if ret else None
+
+    def close(self) -> None:
+        self._cap.release()
+
+
+def open_video_reader(path: str, start_frame: int = 0, hwaccel: str | None = None) -> VideoReader:
+    """
+    Open a video for reading with PyAV, or with OpenCV if PyAV is not installed.
+
+    Args:
+        path: Path to the video.
+        start_frame: Index of the first frame to read.
+        hwaccel: Hardware decoder device type for PyAV, None decodes on the CPU.
+
+    Returns:
+        Video reader.
+
+    Raises:
+        ValueError: If the video cannot be read.
+    """
+    if has_pyav():
+        return PyAVReader(path, start_frame, hwaccel)
+    return OpenCVReader(path, start_frame)
+
+
+class _AudioMuxer:
+    """
+    Copy the audio packets of a source into an output container, interleaved with the video.
+    """
+
+    def __init__(self, output, source_path: str) -> None:
+        self._input = av.open(source_path)
+        self._packets = None
+        self._pending = None
+        self.stream = None
+        if self._input.streams.audio:
+            source_stream = self._input.streams.audio[0]
+            self.stream = output.add_stream_from_template(source_stream)
+            self._packets = self._input.demux(source_stream)
+        self._output = output
+
+    def mux_until(self, seconds: float | None) -> None:
+        """
+        Write the audio packets that start before a time, all of the rest if None.
+        """
+        if self._packets is None:
+            return
+        while True:
+            packet = self._pending or next(self._packets, None)
+            self._pending = None
+            if packet is None:
+                self._packets = None
+                return
+            # Demuxing ends with an empty flush packet
+            if packet.dts is None:
+                continue
+            if seconds is not None and packet.pts is not None and packet.pts * packet.time_base > seconds:
+                self._pending = packet
+                return
+            packet.stream = self.stream
+            self._output.mux(packet)
+
+    def close(self) -> None:
+        self._input.close()
+
+
+class VideoWriter:
+    """
+    Writer of BGR frames to a video file.
+    """
+
+    def write(self, frame: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class PyAVWriter(VideoWriter):
+    """
+    H.264 writer through PyAV producing an MP4 browsers play inline.
+
+    The moov atom is moved to the front (faststart), so playback starts before
+    the whole file is downloaded. The audio track of audio_source is copied
+    without re-encoding.
+    """
+
+    def __init__(self, path: str, fps: float | Fraction, size: Tuple[int, int], preset: str = 'balanced',
+                 audio_source: str | None = None, codec: str = 'libx264') -> None:
+        """
+        Args:
+            path: Path to save the video.
+            fps: Frame rate.
+            size: (width, height) of the frames.
+            preset: Encoder preset, one of ENCODER_PRESETS.
+            audio_source: Video whose audio track is copied, None writes no audio.
+            codec: H.264 encoder, e.g. h264_nvenc or h264_videotoolbox for a hardware one.
+        """
+        if preset not in ENCODER_PRESETS:
+            raise ValueError(f'Unknown encoder preset {preset}, expected one of {", ".join(ENCODER_PRESETS)}')
+
+        self.rate = _to_rate(fps)
+        # yuv420p needs even dimensions, the last row or column of odd-sized frames is cut off
+        self.size = (size[0] & ~1, size[1] & ~1)
+        self._crop = self.size != tuple(size)
+        self._frames = 0
+
+        self._output = av.open(path, 'w', format='mp4', options={'movflags': '+faststart'})
+        self._stream = self._output.add_stream(codec, rate=self.rate)
+        self._stream.width, self._stream.height = self.size
+        self._stream.pix_fmt = 'yuv420p'
+        self._stream.codec_context.time_base = 1 / self.rate
+        if codec == 'libx264':
+            self._stream.options = dict(ENCODER_PRESETS[preset])
+
+        self._audio = _AudioMuxer(self._output, audio_source) if audio_source else None
+
+    def write(self, frame: np.ndarray) -> None:
+        if self._crop:
+            frame = np.ascontiguousarray(frame[:self.size[1], :self.size[0]])
+        video_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+        video_frame.pts = self._frames
+        video_frame.time_base = self._stream.codec_context.time_base
+        self._frames += 1
+
+        if self._audio is not None:
+            self._audio.mux_until(self._frames / self.rate)
+        for packet in self._stream.encode(video_frame):
+            self._output.mux(packet)
+
+    def close(self) -> None:
+        try:
+            for packet in self._stream.encode(None):
+                self._output.mux(packet)
+            if self._audio is not None:
+                self._audio.mux_until(None)
+        finally:
+            if self._audio is not None:
+                self._audio.close()
+            self._output.close()
+
+
+class OpenCVWriter(VideoWriter):
+    """
+    MPEG-4 Part 2 writer through OpenCV, used when PyAV is not installed.
+    """
+
+    def __init__(self, path: str, fps: float | Fraction, size: Tuple[int, int]) -> None:
+        self._out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), float(fps), tuple(size))
+
+    def write(self, frame: np.ndarray) -> None:
+        self._out.write(frame)
+
+    def close(self) -> None:
+        self._out.release()
+
+
+def open_video_writer(path: str, fps: float | Fraction, size: Tuple[int, int], preset: str = 'balanced',
+                      audio_source: str | None = None, codec: str = 'libx264') -> VideoWriter:
+    """
+    Open a video for writing as H.264 with PyAV, or as MPEG-4 Part 2 with OpenCV if PyAV is not installed.
+
+    Args:
+        path: Path to save the video.
+        fps: Frame rate.
+        size: (width, height) of the frames.
+        preset: Encoder preset, one of ENCODER_PRESETS.
+        audio_source: Video whose audio track is copied, None writes no audio. Needs PyAV.
+        codec: H.264 encoder of PyAV.
+
+    Returns:
+        Video writer.
+    """
+    if has_pyav():
+        return PyAVWriter(path, fps, size, preset, audio_source, codec)
+    return OpenCVWriter(path, fps, size)
+
+
+def concat_videos(paths: List[str], output_path: str, audio_source: str | None = None) -> None:
+    """
+    Join videos with the same frame rate, frame size and codec into one, in order.
+
+    With PyAV the encoded packets are copied as they are, without decoding
+    or re-encoding any frame, and the audio track of audio_source is added.
+    Without PyAV the frames are decoded and encoded again with OpenCV.
+
+    Args:
+        paths: Paths to the videos.
+        output_path: Path to save the joined video.
+        audio_source: Video whose audio track is copied, None writes no audio.
+    """
+    if not has_pyav():
+        out = None
+        try:
+            for path in paths:
+                reader = OpenCVReader(path)
+                if out is None:
+                    out = OpenCVWriter(output_path, reader.fps, reader.size)
+                while (frame := reader.read()) is not None:
+                    out.write(frame)
+                reader.close()
+        finally:
+            if out is not None:
+                out.close()
+        return
+
+    output = av.open(output_path, 'w', format='mp4', options={'movflags': '+faststart'})
+    audio = None
+    try:
+        stream = None
+        offset = 0
+        for path in paths:
+            with av.open(path) as source:
+                source_stream = source.streams.video[0]
+                if stream is None:
+                    stream = output.add_stream_from_template(source_stream)
+                    if audio_source:
+                        audio = _AudioMuxer(output, audio_source)
+                end = offset
+                for packet in source.demux(source_stream):
+                    if packet.dts is None:
+                        continue
+                    # Shift the timestamps of every video after the ones before it
+                    packet.pts += offset
+                    packet.dts += offset
+                    end = max(end, packet.pts + (packet.duration or 0))
+                    if audio is not None:
+                        audio.mux_until(float(packet.pts * packet.time_base))
+                    packet.stream = stream
+                    output.mux(packet)
+                offset = end
+        if audio is not None:
+            audio.mux_until(None)
+    finally:
+        if audio is not None:
+            audio.close()
+        output.close()
@@ -1,39 +1,235 @@
-import os
+import asyncio
+import json
+import weakref
+from dataclasses import asdict
+from typing import AsyncGenerator, AsyncIterator, List, Tuple
 
-from django.core.files.base import ContentFile
+import cv2
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.forms.models import BaseModelForm
 from django.db import transaction
-from django.http import HttpResponse
+from django.db.models import Prefetch
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
-from django.views.generic import CreateView, ListView
+from django.utils.functional import classproperty
+from django.views.generic import CreateView, ListView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.views import redirect_to_login
 
-from weapondetectapp.models import Image, Video, ImagePredict, VideoPredict
-from weapondetectapp.utils import TerroristDetector
-from weapondetectapp.tasks import process_predict_video
+from drf_spectacular.utils import OpenApiResponse, extend_schema
+from rest_framework.exceptions import Throttled
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
 
-class ImageListView(LoginRequiredMixin, ListView):
-    model = Image, ImagePredict
+from weapondetectapp.alerts import get_alert_stream
+from weapondetectapp.batching import get_batcher
+from weapondetectapp.executor import ExecutorBusy, Reservation, get_inference_executor
+from weapondetectapp.metrics import registry, span
+from weapondetectapp.models import (
+    Image,
+    Video,
+    ImagePredict,
+    VideoPredict,
+    reserve_file,
+    write_uploaded_file,
+)
+from weapondetectapp.progress import VideoProgress, get_progress_store
+from weapondetectapp.registry import get_detector
+from weapondetectapp.serializers import DetectRequestSerializer, DetectResultSerializer
+from weapondetectapp.tasks import process_predict_images, process_predict_video
+from weapondetectapp.utils import IMAGES
+
+
+def queue_images(images: List[Image]) -> List[ImagePredict]:
+    """
+    Create the predictions of uploaded images and send them to the worker in batches.
+    """
+    image_predicts = []
+    for image in images:
+        # Обработчик сам запишет результат в зарезервированный файл
+        image_predict = ImagePredict(
+            image_original=image,
+            boxes=[],
+        )
+        reserve_file(image_predict.image_predict, image.name)
+        image_predict.save()
+
+        image_predicts.append(image_predict)
+
+    # Отправляем изображения в обработчик батчами
+    image_predict_pks = [image_predict.pk for image_predict in image_predicts]
+    batch_size = settings.WEAPONDETECT_BATCH_SIZE
+    for start in range(0, len(image_predict_pks), batch_size):
+        chunk = image_predict_pks[start:start + batch_size]
+        transaction.on_commit(
+            lambda chunk=chunk: process_predict_images.delay(chunk)
+        )
+
+    return image_predicts
+
+
+def queue_videos(videos: List[Video]) -> List[VideoPredict]:
+    """
+    Create the predictions of uploaded videos and send them to the worker.
+    """
+    video_predicts = []
+    for video in videos:
+        # Обработчик сам запишет результат в зарезервированный файл
+        video_predict = VideoPredict(
+            video_original=video,
+            boxes=[],
+        )
+        reserve_file(video_predict.video_predict, video.name)
+        video_predict.save()
+
+        # Отправляем путь видео в обработчик
+        transaction.on_commit(
+            lambda video=video, video_predict=video_predict: process_predict_video.delay(
+                video.video.path,
+                video_predict.pk,
+                video_predict.video_predict.path,
+            )
+        )
+
+        video_predicts.append(video_predict)
+
+    return video_predicts
+
+
+class AsyncLoginRequiredMixin:
+    """
+    LoginRequiredMixin for async views.
+
+    The session user is loaded in a thread, so the check does not run a
+    blocking database query on the event loop.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView with async handlers, DRF 3.14 only calls sync ones.
+
+    Authentication, permissions and throttling may query the database, so
+    they run in a thread; the handler runs on the event loop and has to read
+    request.data in a thread as well, parsing consumes the request body.
+    """
+
+    @classproperty
+    def view_is_async(cls) -> bool:
+        return True
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class CursorPaginationMixin:
+    """
+    Keyset pagination by primary key, newest first.
+
+    Each page is one indexed range query, so its cost does not grow with the
+    number of uploads the way OFFSET pagination does.
+    """
+    cursor_param = "cursor"
+
+    def get_page_size(self) -> int:
+        return settings.WEAPONDETECT_LIST_PAGE_SIZE
+
+    def paginate_by_cursor(self, queryset):
+        cursor = self.request.GET.get(self.cursor_param, "")
+        if cursor.isdigit():
+            queryset = queryset.filter(pk__lt=int(cursor))
+
+        page_size = self.get_page_size()
+        page = list(queryset.order_by("-pk")[:page_size + 1])
+
+        next_cursor = page[page_size - 1].pk if len(page) > page_size else None
+        return page[:page_size], next_cursor
+
+    def get_context_data(self, **kwargs):
+        page, next_cursor = self.paginate_by_cursor(self.object_list)
+        context = super().get_context_data(object_list=page, **kwargs)
+        context["next_cursor"] = next_cursor
+        context["is_first_page"] = self.cursor_param not in self.request.GET
+        return context
+
+
+class ImageListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    model = Image
     template_name = "image_list.html"
     context_object_name = "images"
 
     def get_queryset(self):
         return Image.objects\
             .filter(user=self.request.user)\
-            .order_by("-uploaded_at")
+            .prefetch_related(
+                Prefetch("image_original", queryset=ImagePredict.objects.order_by("-pk"))
+            )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["user"] = self.request.user
-        context["images_predict"] = ImagePredict.objects.filter(
-            image_original__in=self.get_queryset()).order_by("-pk")
         return context
 
     def get_success_url(self):
         return reverse_lazy("image-list")
 
 
-class VideoListView(LoginRequiredMixin, ListView):
+class ImageStatusView(AsyncLoginRequiredMixin, View):
+    async def get(self, request, *args, **kwargs) -> JsonResponse:
+        # Страница опрашивает только свои карточки, поэтому ids обязательны и их не больше размера страницы
+        ids = [pk for pk in request.GET.get("ids", "").split(",") if pk.isdigit()]
+        if not ids:
+            return JsonResponse({"error": "Pass the ids of the predictions"}, status=400)
+        if len(ids) > settings.WEAPONDETECT_LIST_PAGE_SIZE:
+            return JsonResponse(
+                {"error": f"Pass at most {settings.WEAPONDETECT_LIST_PAGE_SIZE} ids"}, status=400)
+
+        image_predicts = ImagePredict.objects.filter(
+            image_original__user=request.user, pk__in=ids)
+
+        return JsonResponse({
+            "images": [
+                {
+                    "id": image_predict.pk,
+                    "status": image_predict.status,
+                    "url": image_predict.image_predict.url,
+                    "thumbnail_url": image_predict.thumbnail.url if image_predict.thumbnail else None,
+                }
+                async for image_predict in image_predicts
+            ]
+        })
+
+
+class VideoListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = Video
     template_name = "video_list.html"
     context_object_name = "videos"
@@ -41,21 +237,144 @@ class VideoListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         return Video.objects\
             .filter(user=self.request.user)\
-            .order_by("-uploaded_at")
+            .prefetch_related(
+                Prefetch("video_original", queryset=VideoPredict.objects.order_by("-pk"))
+            )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["user"] = self.request.user
-        context["videos_predict"] = VideoPredict.objects.filter(
-            video_original__in=self.get_queryset()).order_by("-pk")
-        for i in context["videos_predict"]:
-            print(i.video_predict)
         return context
 
     def get_success_url(self):
         return reverse_lazy("video-list")
 
 
+class VideoProgressMixin:
+    """
+    Progress of the user's videos, read from the progress store.
+
+    Videos without a progress entry are either waiting in the queue or were
+    processed before the entry expired, their state is taken from the status
+    of the VideoPredict object.
+    """
+
+    async def get_video_predict_pks(self, request) -> List[int]:
+        ids = [pk for pk in request.GET.get("ids", "").split(",") if pk.isdigit()]
+        video_predicts = VideoPredict.objects.filter(video_original__user=request.user, pk__in=ids)
+        return [pk async for pk in video_predicts.values_list("pk", flat=True)]
+
+    @staticmethod
+    def read_progress(video_predict_pk: int, start: int = 0) -> dict:
+        store = get_progress_store()
+        progress = store.get(video_predict_pk) if store is not None else None
+        if progress is None:
+            status = VideoPredict.objects.filter(pk=video_predict_pk).values_list("status", flat=True).first()
+            # Состояния прогресса совпадают со статусами VideoPredict
+            progress = VideoProgress(state=status or VideoPredict.Status.QUEUED.value)
+            detections = []
+        else:
+            detections = store.detections(video_predict_pk, start)
+        return {
+            "id": video_predict_pk,
+            **progress.to_json(),
+            "detections_start": start,
+            "detections": detections,
+        }
+
+
+class VideoProgressView(AsyncLoginRequiredMixin, VideoProgressMixin, View):
+    async def get(self, request, *args, **kwargs) -> JsonResponse:
+        # Обнаружения отдаются начиная с индекса after, чтобы не пересылать уже полученные
+        after = request.GET.get("after", "0")
+        start = int(after) if after.isdigit() else 0
+        pks = await self.get_video_predict_pks(request)
+        read_progress = sync_to_async(self.read_progress, thread_sensitive=False)
+        return JsonResponse({
+            "videos": [await read_progress(pk, start) for pk in pks]
+        })
+
+
+class VideoProgressStreamView(AsyncLoginRequiredMixin, VideoProgressMixin, View):
+    """
+    Server-sent events with the progress and new detections of the user's videos.
+
+    An event is sent for every video once per WEAPONDETECT_PROGRESS_INTERVAL
+    until it is done or failed. The stream is closed after
+    WEAPONDETECT_PROGRESS_STREAM_SECONDS and the browser reconnects.
+    """
+
+    async def get(self, request, *args, **kwargs) -> StreamingHttpResponse:
+        pks = await self.get_video_predict_pks(request)
+        response = StreamingHttpResponse(self.events(pks), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Не даём nginx буферизовать поток
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def events(self, pks: List[int]) -> AsyncGenerator[bytes, None]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.WEAPONDETECT_PROGRESS_STREAM_SECONDS
+        read_progress = sync_to_async(self.read_progress, thread_sensitive=False)
+        starts = {pk: 0 for pk in pks}
+
+        yield b"retry: 5000\n\n"
+        while starts and loop.time() < deadline:
+            for pk in list(starts):
+                progress = await read_progress(pk, starts[pk])
+                starts[pk] += len(progress["detections"])
+                yield f"data: {json.dumps(progress)}\n\n".encode()
+                if progress["state"] in ("done", "failed"):
+                    del starts[pk]
+            if starts:
+                await asyncio.sleep(settings.WEAPONDETECT_PROGRESS_INTERVAL)
+
+
+class AlertStreamView(AsyncLoginRequiredMixin, View):
+    """
+    Server-sent events with the weapon alerts of the user's videos and cameras as they are found.
+
+    The event id is the id of the alert in the Redis stream, so a reconnecting
+    browser sends it back in Last-Event-ID and receives the alerts it missed.
+    """
+
+    async def get(self, request, *args, **kwargs) -> StreamingHttpResponse:
+        stream = get_alert_stream()
+        if stream is None:
+            raise Http404
+
+        user_id = await sync_to_async(lambda: request.user.pk)()
+        last_id = request.headers.get("Last-Event-ID") or await sync_to_async(
+            stream.last_id, thread_sensitive=False)()
+
+        response = StreamingHttpResponse(self.events(stream, user_id, last_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Не даём nginx буферизовать поток
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    async def events(stream, user_id: int, last_id: str) -> AsyncGenerator[bytes, None]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.WEAPONDETECT_ALERTS_STREAM_SECONDS
+        # Чтение блокируется до секунды, поэтому выполняется в отдельном потоке
+        read = sync_to_async(stream.read, thread_sensitive=False)
+
+        yield b"retry: 5000\n\n"
+        while loop.time() < deadline:
+            alerts = await read(last_id)
+            if alerts is None:
+                await asyncio.sleep(5)
+                continue
+            if not alerts:
+                # Комментарий не даёт прокси закрыть простаивающее соединение
+                yield b": keepalive\n\n"
+            for entry_id, alert in alerts:
+                last_id = entry_id
+                if alert.user_id == user_id:
+                    yield f"id: {entry_id}\nevent: alert\ndata: {json.dumps(asdict(alert))}\n\n".encode()
+
+
 class ImageUploadView(LoginRequiredMixin, CreateView):
     template_name = "image_upload.html"
     model = Image
@@ -71,11 +390,12 @@ class ImageUploadView(LoginRequiredMixin, CreateView):
             for image in images
             if image.name != form.instance.image.name
         ]
-        Image.objects.bulk_create(image_objects)
-
         first_file_img_name = form.instance.image.name
 
-        form = super().form_valid(form)
+        # Файлы записываются в хранилище при сохранении объектов
+        with span("storage_write"):
+            Image.objects.bulk_create(image_objects)
+            form = super().form_valid(form)
 
         cur_image = Image.objects.filter(
             user=self.request.user,
@@ -83,36 +403,7 @@ class ImageUploadView(LoginRequiredMixin, CreateView):
         ).order_by("-uploaded_at").first()
 
         image_objects.append(cur_image)
-
-        for image in image_objects:
-            abs_path = os.path.join(
-                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-                "uploads",
-                f"{image.get_path()}"
-            )
-            with open(abs_path, 'rb') as f:
-                content_file = ContentFile(f.read())
-                cur_image_predict = ImagePredict(
-                    image_original=image,
-                    boxes=[],
-                )
-                cur_image_predict.image_predict.save(
-                    f"{image.name}",
-                    content_file
-                )
-                cur_image_predict.save()
-
-            # Отправляем путь изображения в обработчик
-            t_path = os.path.join(
-                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-                "uploads",
-                f"{cur_image_predict.image_predict}"
-            )
-            print(t_path)
-            t = TerroristDetector()
-            t.predict_and_draw_boxes_on_existing_image(
-                t_path
-            )
+        queue_images(image_objects)
 
         return form
 
@@ -132,11 +423,12 @@ class VideoUploadView(LoginRequiredMixin, CreateView):
             for video in videos
             if video.name != form.instance.video.name
         ]
-        Video.objects.bulk_create(video_objects)
-
         first_file_video_name = form.instance.video.name
 
-        form = super().form_valid(form)
+        # Файлы записываются в хранилище при сохранении объектов
+        with span("storage_write"):
+            Video.objects.bulk_create(video_objects)
+            form = super().form_valid(form)
 
         cur_video = Video.objects.filter(
             user=self.request.user,
@@ -144,38 +436,223 @@ class VideoUploadView(LoginRequiredMixin, CreateView):
         ).order_by("-uploaded_at").first()
 
         video_objects.append(cur_video)
-        print(video_objects)
-
-        for video in video_objects:
-            abs_path = os.path.join(
-                os.path.dirname(os.path.dirname(
-                    os.path.abspath(__file__))),
-                "uploads",
-                f"{video.video.name}"
-            )
-            with open(abs_path, 'rb') as f:
-                content_file = ContentFile(f.read())
-                cur_video_predict = VideoPredict(
-                    video_original=video,
-                    boxes=[],
-                )
-                cur_video_predict.video_predict.save(
-                    f"{video.name}",
-                    content_file
-                )
-                cur_video_predict.save()
-
-            # Отправляем путь видео в обработчик
-            t_path = os.path.join(
-                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-                "uploads",
-                f"{cur_video_predict.video_predict}"
-            )
-            print(t_path)
-            t = TerroristDetector()
-            # t.predict_video_and_draw_boxes_on_existing_video(
-            #     t_path
-            # )
-            process_predict_video.delay(t_path)
+        queue_videos(video_objects)
 
         return form
+
+
+class UploadAPIView(AsyncLoginRequiredMixin, View):
+    """
+    Upload many files in one request without holding a thread per request.
+
+    Files are written to the storage in chunks off the event loop and
+    queued for the worker; the response lists the created predictions.
+    """
+    model = Image
+    field_name = "image"
+
+    async def post(self, request, *args, **kwargs) -> JsonResponse:
+        # Разбор multipart читает тело запроса, поэтому выполняем его в потоке
+        files = await sync_to_async(request.FILES.getlist)("files")
+        if not files:
+            return JsonResponse({"error": "Pass at least one file"}, status=400)
+
+        user = await sync_to_async(lambda: request.user)()
+        objects = []
+        for file in files:
+            obj = self.model(user=user, name=file.name)
+            try:
+                await write_uploaded_file(
+                    getattr(obj, self.field_name), file, settings.WEAPONDETECT_UPLOAD_CHUNK_SIZE)
+            except ValidationError as e:
+                # Файлы, записанные до неподходящего, никому не принадлежат
+                for written in objects:
+                    await asyncio.to_thread(getattr(written, self.field_name).delete, save=False)
+                return JsonResponse({"error": e.messages[0]}, status=400)
+            objects.append(obj)
+
+        predicts = await sync_to_async(self.queue, thread_sensitive=False)(objects)
+        return JsonResponse({"ids": [predict.pk for predict in predicts]}, status=202)
+
+    @transaction.atomic
+    def queue(self, objects: List[Image | Video]) -> List[ImagePredict | VideoPredict]:
+        for obj in objects:
+            obj.save()
+        return queue_images(objects) if self.model is Image else queue_videos(objects)
+
+
+class ImageUploadAPIView(UploadAPIView):
+    model = Image
+    field_name = "image"
+
+
+class VideoUploadAPIView(UploadAPIView):
+    model = Video
+    field_name = "video"
+
+
+class ReservedStream:
+    """
+    Streaming content running in an executor reservation.
+
+    The content releases the reservation when it ends, but a generator that
+    is never started never runs its cleanup, e.g. when the client goes away
+    before the first line. So the reservation is also released when the
+    response is closed, and at the latest when the stream is dropped.
+    """
+
+    def __init__(self, reservation: Reservation, content: AsyncGenerator[bytes, None]) -> None:
+        self.reservation = reservation
+        self.content = content
+        weakref.finalize(self, reservation.release)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.content.__aiter__()
+
+    def close(self) -> None:
+        # StreamingHttpResponse.close() calls it
+        self.reservation.release()
+
+
+class DetectAPIView(AsyncAPIView):
+    """
+    Detect objects on many images in one request.
+
+    Images are sent as multipart "files" and/or as "paths" of images already
+    in the media storage. They are run through the model in batches and one
+    JSON line is streamed back per image as soon as its batch is done.
+    """
+    parser_classes = MultiPartParser, FormParser, JSONParser
+    permission_classes = IsAuthenticated,
+
+    @extend_schema(
+        request={
+            "multipart/form-data": DetectRequestSerializer,
+            "application/json": DetectRequestSerializer,
+        },
+        responses={
+            (200, "application/x-ndjson"): OpenApiResponse(
+                response=DetectResultSerializer,
+                description="One JSON object per line and per image",
+            ),
+        },
+    )
+    async def post(self, request, *args, **kwargs) -> StreamingHttpResponse:
+        # Разбор тела запроса и проверка путей блокируют, выполняем их в потоке
+        serializer = await sync_to_async(self.validate_request)(request)
+
+        # Занимаем место в очереди инференса сразу, а если его нет, отказываем не дожидаясь
+        try:
+            reservation = get_inference_executor().reserve()
+        except ExecutorBusy:
+            raise Throttled(detail="Inference queue is full")
+
+        sources = [(file.name, file) for file in serializer.validated_data.get("files", [])]
+        sources += serializer.validated_data.get("paths", [])
+
+        response = StreamingHttpResponse(
+            ReservedStream(reservation, self.stream_results(reservation, sources)),
+            content_type="application/x-ndjson",
+        )
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def validate_request(request) -> DetectRequestSerializer:
+        serializer = DetectRequestSerializer(data=request.data, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    @staticmethod
+    def read_source(source) -> str | np.ndarray | None:
+        """
+        Get a path or decoded BGR array the detector can take.
+
+        Returns:
+            Path, image array or None if an uploaded file is not an image.
+        """
+        if isinstance(source, str):
+            return source
+        data = np.frombuffer(source.read(), dtype=np.uint8)
+        return cv2.imdecode(data, cv2.IMREAD_COLOR) if data.size else None
+
+    async def stream_results(self, reservation: Reservation,
+                             sources: List[Tuple[str, object]]) -> AsyncGenerator[bytes, None]:
+        batch_size = settings.WEAPONDETECT_BATCH_SIZE
+
+        # All batches of the request run in the slot reserved when it was accepted
+        async with reservation:
+            for start in range(0, len(sources), batch_size):
+                chunk = list(enumerate(sources[start:start + batch_size], start))
+                for line in await reservation.run(self.detect_chunk, chunk):
+                    yield line
+
+    def detect_chunk(self, chunk: List[Tuple[int, Tuple[str, object]]]) -> List[bytes]:
+        """
+        Decode and detect one batch of images, runs in the inference executor.
+
+        Returns:
+            One JSON line per image.
+        """
+        lines = []
+        # Uploaded files are decoded one batch at a time to bound memory
+        images = []
+        for index, (name, source) in chunk:
+            with span("decode"):
+                image = self.read_source(source)
+            if image is None:
+                lines.append(self.to_line({"index": index, "name": name, "error": "File is not an image"}))
+                continue
+            images.append((index, name, image))
+
+        if not images:
+            return lines
+
+        batcher = get_batcher()
+        if batcher is not None:
+            # Small requests from concurrent clients share forward passes
+            results = batcher.predict_many([image for _, _, image in images])
+        else:
+            results = self.predict_images(
+                get_detector(), [image for _, _, image in images], settings.WEAPONDETECT_BATCH_SIZE)
+
+        for (index, name, _), result in zip(images, results):
+            if isinstance(result, Exception):
+                lines.append(self.to_line({"index": index, "name": name, "error": str(result)}))
+                IMAGES.inc(status="failed")
+            else:
+                lines.append(self.to_line({"index": index, "name": name, "boxes": result.boxes_to_json()}))
+                IMAGES.inc(status="done")
+        return lines
+
+    @staticmethod
+    def predict_images(detector, images: List[str | np.ndarray], batch_size: int) -> List:
+        try:
+            return detector.predict_batch(images, batch_size)
+        except Exception:
+            # One broken file must not fail the whole batch
+            results = []
+            for image in images:
+                try:
+                    results.append(detector.predict_batch([image], 1)[0])
+                except Exception as e:
+                    results.append(e)
+            return results
+
+    @staticmethod
+    def to_line(data: dict) -> bytes:
+        return (json.dumps(data) + "\n").encode()
+
+
+class MetricsView(View):
+    """
+    Metrics of this process in the Prometheus text format.
+
+    Every server and worker process keeps its own metrics, so each one has
+    to be scraped; Celery workers report theirs through task events.
+    """
+
+    async def get(self, request, *args, **kwargs) -> HttpResponse:
+        if not settings.WEAPONDETECT_METRICS_ENABLED:
+            raise Http404
+        return HttpResponse(registry.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")